@@ -306,4 +306,21 @@ class Generator(Base):
 	def __str__(self):
 		return "<Generator ('%s')>" % (self.message)
 
+class SyncState(Base):
+	"""The state of the rule-synchronization: The sequence-number from the snowman-server which
+	the local cache is up to date with. There is at most one row in this table."""
+	__tablename__ = 'syncstate'
+	
+	id = Column(Integer, primary_key=True)
+	sequence = Column(Integer)
+	
+	def __init__(self, sequence):
+		self.sequence = sequence
+	
+	def __repr__(self):
+		return "<SyncState ('%d')>" % (self.sequence)
+	
+	def __str__(self):
+		return "<SyncState ('%d')>" % (self.sequence)
+
 Session._initialize()
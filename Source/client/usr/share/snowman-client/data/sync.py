@@ -7,13 +7,14 @@ import socket
 
 from util.logger import initialize
 
-from data.models import Session, Rule, RuleSet, RuleClass, RuleReference, RuleReferenceType, Generator, EventFilter, DetectionFilter, Suppress, SuppressAddress
+from data.models import Session, Rule, RuleSet, RuleClass, RuleReference, RuleReferenceType, Generator, EventFilter, DetectionFilter, Suppress, SuppressAddress, SyncState
 from util.config import Config
+from util.transport import PersistentTransport
 
 class SnowmanServer:
 	"""This class is responsible for the communication with the central snowman server.
 	It connects, authenticates and maintains the connection while the synchronizations are
-	running."""
+	running. All the requests of a session is sent over a single persistent connection."""
 
 	class ConnectionError(Exception):
 		"""Exception which is raised when anything regarding the connection to the central server fails."""
@@ -22,9 +23,13 @@ class SnowmanServer:
 	
 	def __init__(self):
 		self.server = None
+		self.transport = None
 		self.connected = False
 		self.token = None
 		self.id = None
+		
+		# Set to False by the rule-synchronization if the filters does not need to be synchronized.
+		self.filtersChanged = True
 
 	def connect(self):
 		"""Method which tries to connect to the central snowman-server, and authenticate with it.
@@ -43,7 +48,8 @@ class SnowmanServer:
 		# Try to connect and authenticate with the server. If a socket error happens, the
 		#   server is considered unreachable.
 		try:
-			self.server = xmlrpclib.Server(serveraddress)
+			self.transport = PersistentTransport()
+			self.server = xmlrpclib.Server(serveraddress, transport=self.transport)
 			response = self.server.authenticate(self.sensorname, self.secret)
 		except socket.error as e:
 			logger.error("Could not connect to %s!" % serveraddress)
@@ -80,6 +86,8 @@ class SnowmanServer:
 		
 		# If successfull, clear the session-info.
 		if(response['status']):
+			self.transport.close()
+			self.transport = None
 			self.server = None
 			self.connected = False
 			self.token = None
@@ -293,16 +301,48 @@ class SnowmanServer:
 		logger.info("RuleSet synchronization is finished.")
 		
 	def synchronizeRules(self):
+		"""Brings the rules in the local cache up to date with the central server. If the local
+		cache is synchronized before, only the rules changed on the server since then is requested.
+		A full synchronization is done if the cache is never synchronized, if the server no longer
+		knows the changes since the last synchronization, or if the server does not support it."""
+		logger = logging.getLogger(__name__)
+		
+		s = Session.session()
+		state = s.query(SyncState).first()
+		sequence = state.sequence if state != None else None
+		s.close()
+		
+		if(sequence != None):
+			try:
+				response = self.server.getChangesSince(self.token, sequence)
+			except xmlrpclib.Fault as e:
+				logger.warning("The server could not report the changed rules: %s" % e.faultString)
+				response = {'status': False, 'message': e.faultString}
+			
+			if(response['status'] == False):
+				logger.warning("Could not get the changed rules from the server: %s" % response['message'])
+			elif(response['full']):
+				logger.info("The changes since the last synchronization is no longer known by the server")
+			else:
+				self.synchronizeChangedRules(response)
+				return
+		
+		self.synchronizeAllRules()
+	
+	def synchronizeAllRules(self):
 		"""Collects lists of rules this sensor should have, compares it with what currently
 		lies in the local cache, and request missing/changed rules from the central server."""
 		logger = logging.getLogger(__name__)
-		maxRuleRequests = int(Config.get("sync", "maxRulesInRequest"))
 	
 		s = Session.session()
 		
 		logger.info("Starting to synchronize the Rules")
 		logger.debug("Collecting the SID/rev pairs from the server")
 		
+		# Forget the sequence-number, so that an interrupted synchronization is followed by
+		#   a full synchronization.
+		self.setSequence(s, None)
+		
 		# Collect sid/rev pairs from the central server.
 		response = self.server.getRuleRevisions(self.token)
 		if(response['status'] == False):
@@ -323,6 +363,56 @@ class SnowmanServer:
 				s.delete(r)
 		s.commit()
 		
+		self.downloadRules(s, list(rulerevisions))
+		
+		# Older servers does not give a sequence-number, and is always fully synchronized.
+		self.setSequence(s, response.get('sequence'))
+		self.filtersChanged = True
+		
+		logger.info("Finished synchronizing the rules from the server")
+		s.close()
+	
+	def synchronizeChangedRules(self, changes):
+		"""Updates the local cache with the changes given by getChangesSince: The removed rules
+		is deleted, and the changed rules is downloaded if the local cache does not already have
+		the same revision in the same ruleset."""
+		logger = logging.getLogger(__name__)
+		chunkSize = int(Config.get("sync", "maxRulesInRequest"))
+		
+		s = Session.session()
+		
+		changed = changes['changed']
+		sids = [int(sid) for sid in changed] + [int(sid) for sid in changes['removed']]
+		logger.info("Starting to synchronize %d changed Rules" % len(sids))
+		
+		deleted = 0
+		for i in range(0, len(sids), chunkSize):
+			for r in s.query(Rule).filter(Rule.SID.in_(sids[i:i + chunkSize])).all():
+				current = changed.get(str(r.SID))
+				if(current != None and int(r.rev) == int(current['rev']) and r.ruleset != None and r.ruleset.name == current['ruleset']):
+					changed.pop(str(r.SID))
+					logger.debug("Rule %d is already up to date" % r.SID)
+				else:
+					logger.debug("Rule %d is deleted, as it is going to be updated or removed." % r.SID)
+					s.delete(r)
+					deleted += 1
+		s.commit()
+		
+		self.downloadRules(s, list(changed))
+		self.setSequence(s, changes['sequence'])
+		
+		# The filters refer to the rules, so they are synchronized if any rules have changed.
+		self.filtersChanged = (changes['filters'] or deleted > 0 or len(changed) > 0)
+		
+		logger.info("Finished synchronizing the changed rules from the server")
+		s.close()
+	
+	def downloadRules(self, s, rulerevisions):
+		"""Requests the rules with the SID's in rulerevisions from the central server, in chunks
+		of [sync] maxRulesInRequest rules, and stores them in the local cache trough the session s."""
+		logger = logging.getLogger(__name__)
+		maxRuleRequests = int(Config.get("sync", "maxRulesInRequest"))
+		
 		logger.debug("Starting to download %d rules from the server" % len(rulerevisions))
 		
 		# Grab Ruleclasses, rulesets and rulereferencetypes from the local cache, to 
@@ -367,9 +457,19 @@ class SnowmanServer:
 				
 				rulerevisions.remove(r)
 			s.commit()
-		
-		logger.info("Finished synchronizing the rules from the server")
-		s.close()
+	
+	def setSequence(self, s, sequence):
+		"""Stores the sequence-number the local cache is synchronized up to, or forgets it if
+		sequence is None."""
+		state = s.query(SyncState).first()
+		if(sequence == None):
+			if(state != None):
+				s.delete(state)
+		elif(state == None):
+			s.add(SyncState(sequence))
+		else:
+			state.sequence = sequence
+		s.commit()
 
 	def synchronizeFilters(self):
 		"""Collects all filters (EventFilter, DetectionFilter and Suppress) from
@@ -378,6 +478,10 @@ class SnowmanServer:
 		the Rule-sync is not in place."""
 
 		logger = logging.getLogger(__name__)
+		if(not self.filtersChanged):
+			logger.info("The filters is not changed since the last synchronization")
+			return
+		
 		logger.info("Starting to synchronize Filters")
 		s = Session.session()
 		
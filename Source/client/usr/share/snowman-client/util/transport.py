@@ -0,0 +1,89 @@
+#!/usr/bin/python
+"""The xmlrpclib-transport used by the client to talk to the snowman-server."""
+
+import httplib
+import socket
+import xmlrpclib
+
+class PersistentTransport(xmlrpclib.SafeTransport):
+	"""An HTTPS-transport which keeps a single connection open, and sends all the requests
+	trough it, so that a synchronization needs only one TLS-handshake. If the server have closed
+	the connection while it was idle, a new connection is opened, and the request is sent once
+	more. The connection is closed with close().
+	
+	The transport accepts gzip-compressed responses. Requests larger than encode_threshold bytes
+	is compressed as well, but only after the server have sent a compressed response, as servers
+	without compression-support would not understand them."""
+
+	connectionClass = httplib.HTTPSConnection
+	encode_threshold = 1400
+
+	def __init__(self):
+		xmlrpclib.SafeTransport.__init__(self)
+		self.connection = None
+		self.connectionHost = None
+		self.gzipRequests = False
+
+	def getConnection(self, host):
+		"""Returns the open connection to host, or opens a new one. Returns a tuple of the
+		connection, and whether it is reused."""
+		if(self.connection != None and self.connectionHost == host):
+			return (self.connection, True)
+
+		self.close()
+		chost, self._extra_headers, x509 = self.get_host_info(host)
+		self.connection = self.connectionClass(chost, **(x509 or {}))
+		self.connectionHost = host
+		return (self.connection, False)
+
+	def close(self):
+		"""Closes the connection, if it is open."""
+		if(self.connection != None):
+			self.connection.close()
+			self.connection = None
+			self.connectionHost = None
+
+	def request(self, host, handler, request_body, verbose = 0):
+		"""Sends an XML-RPC request, and returns the unmarshalled response. Only a request sent
+		on a reused connection is retried, as it may have failed because the server closed the
+		idle connection at the same time."""
+		gzipped = False
+		if(self.gzipRequests and len(request_body) > self.encode_threshold):
+			request_body = xmlrpclib.gzip_encode(request_body)
+			gzipped = True
+		
+		while True:
+			connection, reused = self.getConnection(host)
+			try:
+				connection.putrequest("POST", handler, skip_accept_encoding = True)
+				connection.putheader("User-Agent", self.user_agent)
+				connection.putheader("Content-Type", "text/xml")
+				connection.putheader("Accept-Encoding", "gzip")
+				if(gzipped):
+					connection.putheader("Content-Encoding", "gzip")
+				connection.putheader("Content-Length", str(len(request_body)))
+				connection.endheaders()
+				connection.send(request_body)
+				response = connection.getresponse()
+				data = response.read()
+			except (socket.error, httplib.HTTPException):
+				self.close()
+				if(reused):
+					continue
+				raise
+
+			if(response.getheader("connection", "").lower() == "close"):
+				self.close()
+
+			if(response.status != 200):
+				self.close()
+				raise xmlrpclib.ProtocolError(host + handler, response.status, response.reason, response.msg)
+
+			if(response.getheader("content-encoding", "").lower() == "gzip"):
+				data = xmlrpclib.gzip_decode(data)
+				self.gzipRequests = True
+
+			parser, unmarshaller = self.getparser()
+			parser.feed(data)
+			parser.close()
+			return unmarshaller.close()
@@ -1,26 +1,61 @@
 #!/usr/bin/python
+"""
+The XML-RPC server used by both snowmand and snowmanclientd. It serves XML-RPC over HTTPS,
+with a fixed number of worker-threads:
+
+ - The main loop accepts the connections, and puts them in a bounded queue. When the queue
+   is full, the loop waits for a free place before accepting more connections, so that the
+   clients waits in the listen-backlog of the socket instead of getting a new thread each.
+ - [xmlrpc-server] workers threads handles the connections from the queue. A connection is kept
+   open (HTTP/1.1 keep-alive) for the next request from the same client, until it is idle for
+   [xmlrpc-server] keepAliveTimeout seconds, so that a client doing several calls does only one
+   TLS-handshake.
+ - When the server is stopped, no new connections is accepted, and the connections already
+   accepted is served (for at most [xmlrpc-server] shutdownTimeout seconds) before it returns.
+ - Requests and responses may be gzip-compressed (Content-Encoding: gzip). A response larger
+   than [xmlrpc-server] gzipThreshold bytes is compressed if the client accepts it, and others
+   is sent as before, so that clients without compression-support still works.
+
+The options is read from the [xmlrpc-server] section if they are present, and the defaults in
+RPCServer is used otherwise.
+"""
 import SocketServer
-import BaseHTTPServer
-import SimpleHTTPServer
 import SimpleXMLRPCServer
 
-import socket, os
+import logging
+import os
+import Queue
+import select
+import signal
+import socket
+import struct
+import threading
+import time
+import xmlrpclib
 from OpenSSL import SSL
-from threading import Event, currentThread, Thread, Condition
-from thread import start_new_thread as start
 from DocXMLRPCServer import DocXMLRPCServer, DocXMLRPCRequestHandler
 
 from util.config import Config
 
 class RPCHandler(DocXMLRPCRequestHandler):
 	"""The RPC-Handler we use for our XML-RPC server.
-	It it very similar to DocXMLRPCRequestHandler but it uses HTTPS for transporting XML data.
+	It it very similar to DocXMLRPCRequestHandler but it uses HTTPS for transporting XML data,
+	keeps the connection open between the requests, and compresses the larger responses.
 	"""
+	protocol_version = "HTTP/1.1"
+
 	def setup(self):
+		self.encode_threshold = self.server.gzipThreshold
 		self.connection = self.request
 		self.rfile = socket._fileobject(self.request, "rb", self.rbufsize)
 		self.wfile = socket._fileobject(self.request, "wb", self.wbufsize)
 
+		# An idle connection is closed after keepAliveTimeout seconds. The timeout is set on the
+		#   socket itself, as the SSL-connection does not support socket-timeouts.
+		timeout = struct.pack("ll", self.server.keepAliveTimeout, 0)
+		self.request.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeout)
+		self.request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeout)
+
 	def address_string(self):
 		"getting 'FQDN' from host seems to stall on some ip addresses, so... just (quickly!) return raw host address"
 		host, port = self.client_address
@@ -29,11 +64,14 @@ class RPCHandler(DocXMLRPCRequestHandler):
 
 	def do_POST(self):
 		"""Handles the HTTPS POST request.
-		It was copied out from SimpleXMLRPCServer.py and modified to shutdown the socket cleanly.
+		It was copied out from SimpleXMLRPCServer.py and modified to keep the connection open.
 		"""
 		try:
 			# get arguments
 			data = self.rfile.read(int(self.headers["content-length"]))
+			data = self.decode_request_content(data)
+			if data is None:
+				return # the error-response is already sent
 			# In previous versions of SimpleXMLRPCServer, _dispatch
 			# could be overridden in this class, instead of in
 			# SimpleXMLRPCDispatcher. To maintain backwards compatibility,
@@ -43,18 +81,22 @@ class RPCHandler(DocXMLRPCRequestHandler):
 		except: # This should only happen if the module is buggy
 			# internal error, report as HTTP server error
 			self.send_response(500)
+			self.send_header("Content-length", "0")
+			self.sendConnectionHeader()
 			self.end_headers()
 		else:
 			# got a valid XML RPC response
 			self.send_response(200)
 			self.send_header("Content-type", "text/xml")
+			if self.encode_threshold is not None and len(response) > self.encode_threshold:
+				if self.accept_encodings().get("gzip", 0):
+					response = xmlrpclib.gzip_encode(response)
+					self.send_header("Content-Encoding", "gzip")
 			self.send_header("Content-length", str(len(response)))
+			self.sendConnectionHeader()
 			self.end_headers()
 			self.wfile.write(response)
-
-			# shut down the connection
-			self.wfile.flush()
-			self.connection.shutdown() # Modified here!
+		self.wfile.flush()
 
 	def do_GET(self):
 		"""Handles the HTTP GET request.
@@ -67,17 +109,14 @@ class RPCHandler(DocXMLRPCRequestHandler):
 			self.report_404()
 			return
 
-		response = self.server.generate_html_documentation()
 		response = "<h1>Nothing to see</h1><p>There is nothing to see here. Move along."
 		self.send_response(200)
 		self.send_header("Content-type", "text/html")
 		self.send_header("Content-length", str(len(response)))
+		self.sendConnectionHeader()
 		self.end_headers()
 		self.wfile.write(response)
-
-		# shut down the connection
 		self.wfile.flush()
-		self.connection.shutdown() # Modified here!
 
 	def report_404 (self):
 		# Report a 404 error
@@ -85,44 +124,88 @@ class RPCHandler(DocXMLRPCRequestHandler):
 		response = 'No such page'
 		self.send_header("Content-type", "text/plain")
 		self.send_header("Content-length", str(len(response)))
+		self.sendConnectionHeader()
 		self.end_headers()
 		self.wfile.write(response)
-		# shut down the connection
 		self.wfile.flush()
-		self.connection.shutdown() # Modified here!
 
-class RPCThreading():
-	"""Mix-in class to handle each request in a new thread."""
-	# Decides how threads will act upon termination of the main process
-	daemon_threads = True
+	def sendConnectionHeader(self):
+		"""Tells the client that the connection is closed after this response, if the client
+		asked for it, or if the server is shutting down."""
+		if self.server.stopping.is_set():
+			self.close_connection = 1
+		if self.close_connection:
+			self.send_header("Connection", "close")
+
+class RPCWorkerPool():
+	"""Mix-in class to handle the requests in a fixed number of worker-threads, which takes the
+	connections from a bounded queue."""
+
+	def startWorkers(self, workers, queueSize):
+		self.requestQueue = Queue.Queue(queueSize)
+		self.workers = []
+		for i in range(workers):
+			t = threading.Thread(target = self.worker, name = "rpc-worker-%d" % i)
+			t.daemon = True
+			t.start()
+			self.workers.append(t)
+
+	def worker(self):
+		"""Handles the connections in the queue, until it gets None."""
+		while True:
+			item = self.requestQueue.get()
+			if item == None:
+				return
+			self.process_request_thread(*item)
 
 	def process_request_thread(self, request, client_address):
-		"""Same as in BaseServer but as a thread.
+		"""Same as in BaseServer but in a worker.
 		In addition, exception handling is done here.
 		"""
+		logger = logging.getLogger(__name__)
 		try:
 			self.finish_request(request, client_address)
 			self.close_request(request)
-		except (socket.error, SSL.SysCallError), why:
-			print 'socket.error finishing request from "%s"; Error: %s' % (client_address, str(why))
+		except (socket.error, SSL.Error), why:
+			logger.debug('socket.error finishing request from "%s"; Error: %s' % (client_address, str(why)))
 			self.close_request(request)
 		except:
 			self.handle_error(request, client_address)
 			self.close_request(request)
 
 	def process_request(self, request, client_address):
-		"""Start a new thread to process the request."""
-		t = Thread(target = self.process_request_thread, args = (request, client_address))
-		if self.daemon_threads:
-			t.setDaemon(1)
-		t.start()
+		"""Puts the connection in the queue. If the queue is full, this waits until a worker takes
+		a connection from it, or the server is stopped."""
+		while not self.stopping.is_set():
+			try:
+				self.requestQueue.put((request, client_address), timeout = 1.0)
+				return
+			except Queue.Full:
+				pass
+		self.close_request(request)
+
+	def stopWorkers(self, timeout):
+		"""Lets the workers finish the connections in the queue, and waits for them to stop for at
+		most timeout seconds. Returns True if all of them have stopped."""
+		deadline = time.time() + timeout
+		for t in self.workers:
+			try:
+				self.requestQueue.put(None, timeout = max(0, deadline - time.time()))
+			except Queue.Full:
+				return False
+		for t in self.workers:
+			t.join(max(0, deadline - time.time()))
+		return not any([t.is_alive() for t in self.workers])
+
+class RPCServer(RPCWorkerPool, DocXMLRPCServer):
+	# The defaults of the options in the [xmlrpc-server] section.
+	defaults = {"workers": 16, "queueSize": 64, "keepAliveTimeout": 5, "shutdownTimeout": 30, "gzipThreshold": 1400}
 
-class RPCServer(RPCThreading, DocXMLRPCServer):
 	def __init__(self, registerInstance, server_address, logRequests=True):
 		"""Secure Documenting XML-RPC server.
 		It it very similar to DocXMLRPCServer but it uses HTTPS for transporting XML data.
 		"""
-		DocXMLRPCServer.__init__(self, server_address, RPCHandler, logRequests)
+		DocXMLRPCServer.__init__(self, server_address, RPCHandler, logRequests, bind_and_activate=False)
 		self.logRequests = logRequests
 
 		# stuff for doc server
@@ -144,42 +227,82 @@ class RPCServer(RPCThreading, DocXMLRPCServer):
 		SocketServer.BaseServer.__init__(self, server_address, RPCHandler)
 		self.register_instance(registerInstance) # for some reason, have to register instance down here!
 
-		# SSL socket stuff
+		self.keepAliveTimeout = self.getOption("keepAliveTimeout")
+		self.shutdownTimeout = self.getOption("shutdownTimeout")
+		self.gzipThreshold = self.getOption("gzipThreshold")
+		if self.gzipThreshold < 0:
+			self.gzipThreshold = None
+		self.stopping = threading.Event()
+
+		# The connections waiting for a worker is first kept in the listen-backlog, and then in
+		#   the queue.
+		self.request_queue_size = self.getOption("queueSize")
+		self.socket = self.createSocket()
+		self.server_bind()
+		self.server_activate()
+
+	def getOption(self, name):
+		"""Returns the option name from the [xmlrpc-server] section, or its default."""
+		if Config.parser.has_option("xmlrpc-server", name):
+			return int(Config.get("xmlrpc-server", name))
+		return self.defaults[name]
+
+	def createSocket(self):
+		"""Creates the SSL-socket of the server."""
 		ctx = SSL.Context(SSL.SSLv23_METHOD)
 		keyfile = os.path.join(Config.djangoroot, Config.get("xmlrpc-server", "keyfile"))
 		certfile = os.path.join(Config.djangoroot, Config.get("xmlrpc-server", "certfile"))
 		ctx.use_privatekey_file(keyfile)
 		ctx.use_certificate_file(certfile)
-		self.socket = SSL.Connection(ctx, socket.socket(self.address_family, self.socket_type))
-		self.server_bind()
-		self.server_activate()
+		return SSL.Connection(ctx, socket.socket(self.address_family, self.socket_type))
 
-		# requests count and condition, to allow for keyboard quit via CTL-C
-		self.requests = 0
-		self.rCondition = Condition()
+	def close_request(self, request):
+		"""Shuts the SSL-connection down cleanly before closing it."""
+		try:
+			request.shutdown()
+		except (socket.error, SSL.Error):
+			pass
+		request.close()
 
 	def startup(self):
-		'run until quit signaled from keyboard...'
+		"""Serves requests until stop is called, a SIGTERM is recieved (if the server runs in the
+		main thread), or the server is interrupted from the keyboard. The requests already accepted
+		is then finished before the method returns."""
+		logger = logging.getLogger(__name__)
+
+		if threading.current_thread().name == "MainThread":
+			signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+		self.startWorkers(self.getOption("workers"), self.getOption("queueSize"))
 		print 'server starting; hit CTRL-C to quit...'
-		while True:
-			try:
-				self.rCondition.acquire()
-				start(self.handle_request, ()) # we do this async, because handle_request blocks!
-				while not self.requests:
-					self.rCondition.wait(timeout=3.0)
-				if self.requests: self.requests -= 1
-				self.rCondition.release()
-			except KeyboardInterrupt:
-				print "quit signaled, i'm done."
-				return
+		try:
+			while not self.stopping.is_set():
+				try:
+					readable = select.select([self.socket], [], [], 1.0)[0]
+				except select.error:
+					# Interrupted by a signal.
+					continue
+				if not readable:
+					continue
+
+				try:
+					request, client_address = self.get_request()
+				except (socket.error, SSL.Error), why:
+					logger.debug("Could not accept a connection: %s" % str(why))
+					continue
+				self.process_request(request, client_address)
+		except KeyboardInterrupt:
+			print "quit signaled, i'm done."
+
+		self.stop()
+		self.socket.close()
+		if not self.stopWorkers(self.shutdownTimeout):
+			logger.warning("Stopped the XML-RPC server with requests still running")
+		logger.info("The XML-RPC server is stopped")
 
-	def get_request(self):
-		request, client_address = self.socket.accept()
-		self.rCondition.acquire()
-		self.requests += 1
-		self.rCondition.notifyAll()
-		self.rCondition.release()
-		return (request, client_address)
+	def stop(self):
+		"""Asks the server to stop. Can be called from any thread, and from signal-handlers."""
+		self.stopping.set()
 
 	def listMethods(self):
 		'return list of method names (strings)'
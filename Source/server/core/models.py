@@ -1,23 +1,25 @@
 import datetime
+import hashlib
 import logging
 import os
-import re
 import socket
+import time
 import xmlrpclib
 
-from django.db import models
+from django.db import connection, models, transaction
 from django.contrib.auth.models import User
 from django.utils.timezone import utc
 
 from util.config import Config
 from util.configfile import ConfigFile
 from util.constants import dbObjects
-from util.tools import Replace, Timeout
-from util.patterns import ConfigPatterns
+from util.tools import TimeoutTransport, chunks, parallelMap
+from util.ruletokenizer import tokenizeRule
 
 from srm.settings import DATABASES
 
 from core.exceptions import MissingObjectError
+from update.exceptions import BadFormatError
 
 """This module contains the data models for the core data.
 This includes Rules and revisions, Rulesets, RuleClasses,
@@ -54,6 +56,11 @@ class Rule(models.Model):
 	ruleSet = models.ForeignKey('RuleSet', related_name='rules')
 	ruleClass = models.ForeignKey('RuleClass', related_name='rules')
 	priority = models.IntegerField(null=True)
+	fingerprint = models.CharField(max_length=40, null=True, default=None)
+	
+	# The current revision (the latest active revision) of the rule. It is kept up to date by
+	#   updateCurrentRevisions, so that the revision can be fetched together with the rule.
+	currentRevision = models.ForeignKey('RuleRevision', null=True, default=None, related_name='+', on_delete=models.SET_NULL)
 
 	def __repr__(self):
 		return "<Rule SID:%d, Active:%s, Set:%s, Class:%s Priority:%s>" % (self.SID, 
@@ -63,8 +70,37 @@ class Rule(models.Model):
 		return "<Rule SID:%d>" % (self.SID)
 	
 	def getCurrentRevision(self):
-		"""This method returns the most recent active rule-revision"""
+		"""This method returns the most recent active rule-revision. The revision is read trough 
+		currentRevision, so fetch the rules with select_related("currentRevision") to avoid a query
+		per rule."""
+		if(self.currentRevision_id != None):
+			return self.currentRevision
 		return self.revisions.filter(active=True).last()
+	
+	@staticmethod
+	def updateCurrentRevisions(ruleIDs = None, chunkSize = 500):
+		"""Sets currentRevision of the rules to their latest active revision (the active revision
+		with the highest primary-key). If ruleIDs (a list of Rule primary-keys) is given, only 
+		theese rules are updated, one chunk at the time. Otherwise all the rules are updated."""
+		
+		quote = connection.ops.quote_name
+		ruleTable = quote(Rule._meta.db_table)
+		revisionTable = quote(RuleRevision._meta.db_table)
+		
+		statement = "UPDATE %s SET %s = (SELECT MAX(r.%s) FROM %s r WHERE r.%s = %s.%s AND r.%s = %%s)" % (
+				ruleTable, quote(Rule._meta.get_field("currentRevision").column),
+				quote(RuleRevision._meta.pk.column), revisionTable, 
+				quote(RuleRevision._meta.get_field("rule").column), ruleTable, quote(Rule._meta.pk.column),
+				quote(RuleRevision._meta.get_field("active").column))
+		
+		cursor = connection.cursor()
+		if ruleIDs == None:
+			cursor.execute(statement, [True])
+			return
+		
+		for chunk in chunks(list(ruleIDs), chunkSize):
+			cursor.execute("%s WHERE %s IN (%s)" % (statement, quote(Rule._meta.pk.column), ", ".join(["%s"] * len(chunk))), 
+					[True] + chunk)
 
 	
 	def updateRule(self, raw, rev = None, msg = None):
@@ -79,14 +115,13 @@ class Rule(models.Model):
 
 		logger = logging.getLogger(__name__)
 
-		if rev is None or msg is None:
-			# At least one parameter is missing, parse rulestring:
-			# Construct a regex to match all elements a raw rulestring 
-			# must have in order to be considered a valid rule
-			# (sid, rev, message and classtype):
-			result = re.match(ConfigPatterns.RULE, raw)
-			rev = rev or result.group(3)
-			msg = msg or result.group(4)
+		# Tokenize the rulestring, to get the rev/msg if they are not passed, and
+		#   to get the rulestring without any inline filters.
+		parsed = tokenizeRule(raw)
+		if parsed == None:
+			raise BadFormatError("Not a valid rule: %s" % raw)
+		rev = rev or parsed.rev
+		msg = msg or parsed.msg
 		
 		# Try to grab the latest revision from the database
 		try:
@@ -106,29 +141,30 @@ class Rule(models.Model):
 			else:
 				activate = False
 			
-			# Remove filters from raw string before storage:
-			replace = Replace("")			
-			filters = ""
-			
-			raw = re.sub(r'detection_filter:.*?;', replace, raw)
-			filters += replace.matched or ""
-			raw = re.sub(r'threshold:.*?;', replace, raw)
-			filters += replace.matched or ""
-			
-			raw = " ".join(raw.split())
+			# Store the raw string without filters:
+			raw = parsed.raw
+			filters = parsed.filters
 			rev = RuleRevision.objects.create(rule=self, rev=int(rev), active=activate, msg=msg, raw=raw, filters=filters)
 			logger.debug("Updated rule-revision:" + str(rev))
 			
 			# Delete old revisions:
-			if maxRevisions > 0:
-				while self.revisions.count() > maxRevisions:
-					rev_min = self.revisions.all().aggregate(models.Min("rev"))["rev__min"]
-					self.revisions.get(rev=rev_min).delete()
+			RuleRevision.compactRevisions(maxRevisions, [self.pk])
 
 			return rev
 		
 		return None
 	
+	@staticmethod
+	def calculateFingerprint(raw, msg, classtype, ruleset, priority, active, gid = 1):
+		"""This method calculates the fingerprint of a rule, as it is recieved in an update. The
+		fingerprint is a sha1-hash of the rulestring (with normalized whitespace) and the 
+		metadata stored about the rule. If a rule is recieved with the same fingerprint as the 
+		one stored in the Rule object, nothing about the rule has changed since the last update."""
+		
+		content = "\n".join([" ".join(raw.split()), msg, classtype, ruleset, str(priority), 
+				str(active), str(gid)])
+		return hashlib.sha1(content).hexdigest()
+	
 	@staticmethod
 	def getRuleRevisions():
 		"""This method is to get a list over the latest rules/revisions. 
@@ -239,25 +275,104 @@ class RuleRevision(models.Model):
 	def __str__(self):
 		return "<RuleRevision SID:%d, rev:%d, active:%s raw:'%s', msg:'%s'>" % (self.rule.SID, self.rev, str(self.active), self.raw, self.msg)
 	
+	def save(self, *args, **kwargs):
+		"""Saves the revision, and updates the current revision of its rule. (Revisions created
+		with bulk_create must have their rules updated with Rule.updateCurrentRevisions)."""
+		super(RuleRevision, self).save(*args, **kwargs)
+		Rule.updateCurrentRevisions([self.rule_id])
+	
 	def getReferences(self):
 		"""Returns a list of all the references that is related to this rule."""
 		referenceList = []
 		for ref in self.references.all():
 			referenceList.append((ref.referenceType.name, ref.reference))
 		return referenceList 
+	
+	@staticmethod
+	def compactRevisions(maxRevisions, ruleIDs = None, chunkSize = 500):
+		"""This method deletes the oldest revisions of every rule having more than maxRevisions
+		revisions, so that only the maxRevisions revisions with the highest rev is kept. The 
+		current revision of a rule (the latest active revision) is never deleted, and is counted
+		as one of the revisions to keep, so Rule.currentRevision is still valid afterwards.
+		
+		If ruleIDs (a list of Rule primary-keys) is given, only theese rules are compacted.
+		Otherwise all the rules are. The revisions is deleted in chunks, with a few bulk 
+		DELETE-statements per chunk.
+		
+		Returns a tuple (number of deleted revisions, seconds used)."""
+		
+		logger = logging.getLogger(__name__)
+		start = time.time()
+		if maxRevisions <= 0:
+			return (0, 0.0)
+		
+		# Find the rules which have too many revisions.
+		if ruleIDs == None:
+			scopes = [RuleRevision.objects.all()]
+		else:
+			scopes = [RuleRevision.objects.filter(rule__in = chunk) for chunk in chunks(ruleIDs, chunkSize)]
+		rules = []
+		for scope in scopes:
+			counts = scope.values("rule").annotate(revisionCount=models.Count("pk")).filter(revisionCount__gt = maxRevisions)
+			rules.extend(counts.values_list("rule", flat=True))
+		
+		deleted = 0
+		for chunk in chunks(rules, chunkSize):
+			revisions = list(RuleRevision.objects.filter(rule__in = chunk).values_list("pk", "rule", "active").order_by("rule", "-rev", "-pk"))
+			
+			# The current revision of a rule is the last active revision that was created.
+			current = {}
+			for pk, rule, active in revisions:
+				if(active and pk > current.get(rule, 0)):
+					current[rule] = pk
+			
+			# Keep the current revision, and the newest revisions until the limit is reached.
+			kept = dict([(rule, 1) for rule in current])
+			obsolete = []
+			for pk, rule, active in revisions:
+				if(current.get(rule) == pk):
+					continue
+				kept[rule] = kept.get(rule, 0) + 1
+				if(kept[rule] > maxRevisions):
+					obsolete.append(pk)
+			
+			# Delete the references and update-relations of the revisions, and then the revisions 
+			#   themselves. The raw deletes avoids loading every object into memory, as .delete() 
+			#   would do to collect the cascades.
+			through = RuleRevision.update.related.field.rel.through
+			for part in chunks(obsolete, chunkSize):
+				RuleReference.objects.filter(rulerevision__in = part)._raw_delete(RuleReference.objects.db)
+				through.objects.filter(rulerevision__in = part)._raw_delete(through.objects.db)
+				RuleRevision.objects.filter(pk__in = part)._raw_delete(RuleRevision.objects.db)
+			deleted += len(obsolete)
+		
+		seconds = time.time() - start
+		logger.info("Deleted %d old rule-revisions in %.2f seconds" % (deleted, seconds))
+		return (deleted, seconds)
 
 class RuleSet(models.Model):
 	"""A RuleSet is a set of rules. All Rule objects must have
 	a reference to the ruleset in which they belong. The RuleSet-
 	object contains metainfo for the set: Name, description, and 
 	whether it is active or not. A ruleset can also be part of
-	another ruleset in a hierarchical structure. Name must be unique."""
+	another ruleset in a hierarchical structure. Name must be unique.
+	
+	The hierarchy is also stored in RuleSetHierarchy, which is kept
+	up to date when a ruleset is saved, so that the descendants of a
+	set can be found without walking the tree."""
 
 	name = models.CharField(max_length=100, unique=True)
 	parent = models.ForeignKey('RuleSet', null=True, related_name='childSets')
 	description = models.TextField()
 	active = models.BooleanField()
 
+	def __init__(self, *args, **kwargs):
+		super(RuleSet, self).__init__(*args, **kwargs)
+		# The parent and active-status as they are stored in the database (and in RuleSetHierarchy
+		#   and Sensor.effectiveRuleSets).
+		self.savedParentID = self.parent_id
+		self.savedActive = self.active
+
 	def __repr__(self):
 		if(self.parent):
 			return "<RuleSet name:%s, parent:%s, active:%s description:'%s'>" % (self.name, self.parent.name, str(self.active), self.description)
@@ -267,48 +382,186 @@ class RuleSet(models.Model):
 	def __str__(self):
 		return "<RuleSet name:%s>" % (self.name)
 	
+	def __nonzero__(self):
+		"""A RuleSet object is always true. Without this, a truth-test (which django does on
+		every select_related object) would fall back to __len__, and count the rules."""
+		return True
+	
 	def __len__(self):
-		noRules = self.rules.count()
-		for ruleSet in self.childSets.all():
-			noRules += len(ruleSet)
-		return noRules
+		return RuleSet.getRuleCounts([self])[self.pk]["rules"]
+	
+	def save(self, *args, **kwargs):
+		"""Saves the ruleset, and updates RuleSetHierarchy if the ruleset is new or have got
+		a new parent. (RuleSets created with bulk_create must be added to the hierarchy with
+		RuleSetHierarchy.addRoots). The effective rulesets of the sensors is updated if the 
+		ruleset is moved or (de)activated."""
+		with transaction.atomic():
+			new = (self.pk == None)
+			super(RuleSet, self).save(*args, **kwargs)
+			
+			if(new):
+				RuleSetHierarchy.objects.create(ancestor=self, descendant=self, depth=0)
+			if(new or self.parent_id != self.savedParentID):
+				RuleSetHierarchy.move(self)
+			if(new or self.parent_id != self.savedParentID or self.active != self.savedActive):
+				Sensor.updateEffectiveRuleSetsOf(self)
+			
+			self.savedParentID = self.parent_id
+			self.savedActive = self.active
 	
 	def getRuleRevisions(self, active):
+		"""Returns a dictionary {SID: {'rule': Rule, 'rev': RuleRevision}} of the rules in this
+		ruleset, and in its active child-rulesets (and their active children). If active is not
+		None, only the rules with that active-status is included."""
 		revisions = {}
 		
-		# Collect the rules in this ruleSet
-		for rule in self.rules.all():
-			if(active == None or active == rule.active):
-				revisions[str(rule.SID)] = {}
-				revisions[str(rule.SID)]['rule'] = rule
-				revisions[str(rule.SID)]['rev'] = rule.getCurrentRevision()
+		ruleSetIDs = [self.pk] + list(RuleSet.getActiveDescendants([self]).values_list("pk", flat=True))
+		rules = Rule.objects.filter(ruleSet__in=ruleSetIDs)
+		if(active != None):
+			rules = rules.filter(active=active)
+		
+		for rule in rules.select_related("currentRevision"):
+			revisions[str(rule.SID)] = {}
+			revisions[str(rule.SID)]['rule'] = rule
+			revisions[str(rule.SID)]['rev'] = rule.getCurrentRevision()
 		
-		# Collect the sid of the rules in child-rulesets.
-		for ruleSet in self.childSets.all():
-			if ruleSet.active:
-				revisions.update(ruleSet.getRuleRevisions(active))
-
 		return revisions
 	
 	def getChildSets(self):
 		"""This method returns a list of RuleSets, which is the children-sets (and their children)
-		of this ruleset."""
-		sets = []
-		for childSet in self.childSets.all():
-			if(childSet.active):
-				sets.append(childSet)
-				sets.extend(childSet.getChildSets())
-
-		return sets	
+		of this ruleset. Inactive sets, and everything below them, is not included."""
+		return list(RuleSet.getActiveDescendants([self]))
 	
 	def getActiveRuleCount(self):
 		"""This method counts the number of active rules in this ruleset, and any child-rulesets"""
-		activeRulesCount = self.rules.filter(active=True).count()
+		return RuleSet.getRuleCounts([self])[self.pk]["activeRules"]
+	
+	def isDescendantOf(self, ruleSet):
+		"""Returns True if this ruleset is ruleSet, or is somewhere below it in the hierarchy."""
+		return RuleSetHierarchy.objects.filter(ancestor=ruleSet, descendant=self).exists()
+	
+	@staticmethod
+	def getActiveDescendants(ruleSets):
+		"""Returns a QuerySet of the active descendants of the rulesets in ruleSets (RuleSet
+		objects or primary-keys), not including the rulesets themselves. A set is only included
+		if it, and every set between it and one of the rulesets, is active; which is the sets
+		getChildSets would collect for each of the rulesets. The sets are found in a single 
+		statement."""
+		
+		ids = [getattr(s, "pk", s) for s in ruleSets]
+		if(len(ids) == 0):
+			return RuleSet.objects.none()
+		
+		quote = connection.ops.quote_name
+		names = RuleSetHierarchy.getColumnNames()
+		
+		# A descendant is excluded if there is an inactive set (p.descendant) on the path from 
+		#   the ancestor down to it.
+		where = ("%(ruleset)s.%(id)s IN (SELECT c.%(descendant)s FROM %(hierarchy)s c WHERE c.%(ancestor)s IN (%(ids)s) AND c.%(depth)s > 0 "
+				"AND NOT EXISTS (SELECT 1 FROM %(hierarchy)s p, %(hierarchy)s q, %(ruleset)s s WHERE p.%(ancestor)s = c.%(ancestor)s AND p.%(depth)s > 0 "
+				"AND q.%(ancestor)s = p.%(descendant)s AND q.%(descendant)s = c.%(descendant)s AND s.%(id)s = p.%(descendant)s AND s.%(active)s = %%s))") % dict(names, 
+				ids=", ".join(["%s"] * len(ids)), active=quote(RuleSet._meta.get_field("active").column))
+		
+		return RuleSet.objects.extra(where=[where], params=ids + [False])
+	
+	@staticmethod
+	def getRuleCounts(ruleSets, chunkSize = 500):
+		"""Counts the rules of each of the rulesets in ruleSets (RuleSet objects or primary-keys),
+		including the rules in all the sets below it, active or not. Returns a dictionary, keyed
+		by the primary-key of the ruleset, of dictionaries with the keys "rules" (the number of
+		rules), "activeRules" (the number of active rules) and "ownRules" (the number of rules 
+		in the set itself). The counts are found with a single statement per chunk of rulesets."""
+		
+		ids = [getattr(s, "pk", s) for s in ruleSets]
+		counts = dict([(i, {"rules": 0, "activeRules": 0, "ownRules": 0}) for i in ids])
+		
+		quote = connection.ops.quote_name
+		names = RuleSetHierarchy.getColumnNames()
+		names.update({"rule": quote(Rule._meta.db_table), "ruleID": quote(Rule._meta.pk.column),
+				"ruleSet": quote(Rule._meta.get_field("ruleSet").column), "ruleActive": quote(Rule._meta.get_field("active").column)})
+		
+		cursor = connection.cursor()
+		for chunk in chunks(ids, chunkSize):
+			cursor.execute(("SELECT c.%(ancestor)s, COUNT(r.%(ruleID)s), SUM(CASE WHEN r.%(ruleActive)s = %%s THEN 1 ELSE 0 END), "
+					"SUM(CASE WHEN c.%(depth)s = 0 THEN 1 ELSE 0 END) FROM %(hierarchy)s c INNER JOIN %(rule)s r ON r.%(ruleSet)s = c.%(descendant)s "
+					"WHERE c.%(ancestor)s IN (%(ids)s) GROUP BY c.%(ancestor)s") % dict(names, ids=", ".join(["%s"] * len(chunk))), [True] + chunk)
+			for ruleSetID, rules, activeRules, ownRules in cursor.fetchall():
+				counts[ruleSetID] = {"rules": int(rules), "activeRules": int(activeRules), "ownRules": int(ownRules)}
+		
+		return counts
+
+class RuleSetHierarchy(models.Model):
+	"""The transitive closure of the RuleSet hierarchy. There is a row for every pair of 
+	rulesets where ancestor is descendant, or is above it in the hierarchy. depth is the 
+	number of levels between them (0 for the row of a ruleset to itself).
+	
+	The rows is maintained by RuleSet.save, and removed together with the rulesets."""
+	
+	ancestor = models.ForeignKey('RuleSet', related_name='descendantLinks')
+	descendant = models.ForeignKey('RuleSet', related_name='ancestorLinks')
+	depth = models.IntegerField()
+	
+	class Meta:
+		unique_together = ('ancestor', 'descendant')
+	
+	def __repr__(self):
+		return "<RuleSetHierarchy ancestor:%d, descendant:%d, depth:%d>" % (self.ancestor_id, self.descendant_id, self.depth)
+	
+	def __str__(self):
+		return "<RuleSetHierarchy ancestor:%d, descendant:%d>" % (self.ancestor_id, self.descendant_id)
+	
+	@staticmethod
+	def getColumnNames():
+		"""Returns a dictionary of the quoted table- and column-names used in the raw queries on
+		the hierarchy."""
+		quote = connection.ops.quote_name
+		return {"hierarchy": quote(RuleSetHierarchy._meta.db_table), "ruleset": quote(RuleSet._meta.db_table),
+				"id": quote(RuleSet._meta.pk.column), "depth": quote(RuleSetHierarchy._meta.get_field("depth").column),
+				"ancestor": quote(RuleSetHierarchy._meta.get_field("ancestor").column),
+				"descendant": quote(RuleSetHierarchy._meta.get_field("descendant").column)}
+	
+	@staticmethod
+	def move(ruleSet):
+		"""Moves ruleSet, and everything below it, to its current parent: The links from the
+		old ancestors of the set to the subtree is removed, and links from the ancestors of the 
+		new parent is added."""
+		
+		subtree = list(RuleSetHierarchy.objects.filter(ancestor=ruleSet).values_list("descendant", "depth"))
+		subtreeIDs = [d for d, depth in subtree]
+		
+		RuleSetHierarchy.objects.filter(descendant__in=subtreeIDs).exclude(ancestor__in=subtreeIDs).delete()
+		
+		if(ruleSet.parent_id != None):
+			links = []
+			for ancestor, ancestorDepth in RuleSetHierarchy.objects.filter(descendant_id=ruleSet.parent_id).values_list("ancestor", "depth"):
+				for descendant, depth in subtree:
+					links.append(RuleSetHierarchy(ancestor_id=ancestor, descendant_id=descendant, depth=ancestorDepth + depth + 1))
+			RuleSetHierarchy.objects.bulk_create(links)
+	
+	@staticmethod
+	def addRoots(ruleSetIDs):
+		"""Adds the rulesets (primary-keys) in ruleSetIDs, which must be new rulesets without a
+		parent, to the hierarchy."""
+		RuleSetHierarchy.objects.bulk_create([RuleSetHierarchy(ancestor_id=i, descendant_id=i, depth=0) for i in ruleSetIDs])
+	
+	@staticmethod
+	def rebuild():
+		"""Recreates the whole hierarchy from the parent-relations of the rulesets. Returns the
+		number of rows created."""
+		parents = dict(RuleSet.objects.values_list("pk", "parent"))
 		
-		for child in self.childSets.all():
-			activeRulesCount += child.getActiveRuleCount()
-				
-		return activeRulesCount
+		links = []
+		for ruleSet in parents:
+			ancestor = ruleSet
+			depth = 0
+			while ancestor != None and depth <= len(parents):
+				links.append(RuleSetHierarchy(ancestor_id=ancestor, descendant_id=ruleSet, depth=depth))
+				ancestor = parents[ancestor]
+				depth += 1
+		
+		RuleSetHierarchy.objects.all().delete()
+		RuleSetHierarchy.objects.bulk_create(links, batch_size=500)
+		return len(links)
 	
 class Sensor(models.Model):
 	"""A Sensor is information on one SnortSensor installation. It 
@@ -329,6 +582,16 @@ class Sensor(models.Model):
 	ruleSets = models.ManyToManyField('RuleSet', related_name='sensors')
 	lastChecked = models.DateTimeField(null=True, default=datetime.datetime.now())
 	lastStatus = models.BooleanField(default=False)
+	
+	# The rulesets the sensor should have: The active rulesets assigned to the sensor or any of
+	#   its parents, and their active child-rulesets. It is kept up to date by 
+	#   updateEffectiveRuleSets, and should never be changed directly.
+	effectiveRuleSets = models.ManyToManyField('RuleSet', related_name='effectiveSensors')
+	
+	def __init__(self, *args, **kwargs):
+		super(Sensor, self).__init__(*args, **kwargs)
+		# The parent as it is stored in the database (and in effectiveRuleSets).
+		self.savedParentID = self.parent_id
 
 	def __repr__(self):
 		if(self.parent):
@@ -339,19 +602,34 @@ class Sensor(models.Model):
 	def __str__(self):
 		return "<Sensor name:%s, ipAddress:'%s'>" % (self.name, self.ipAddress)
 	
+	def save(self, *args, **kwargs):
+		"""Saves the sensor, and updates the effective rulesets of the sensor (and the sensors
+		below it) if the sensor is new or have got a new parent."""
+		with transaction.atomic():
+			new = (self.pk == None)
+			super(Sensor, self).save(*args, **kwargs)
+			
+			if(new or self.parent_id != self.savedParentID):
+				Sensor.updateEffectiveRuleSets([self])
+			self.savedParentID = self.parent_id
+	
+	def getRPCServer(self):
+		"""Returns an xmlrpclib.Server connected to the snowman-clientd of the sensor. The socket
+		of the connection times out after [sensor] pingTimeout seconds."""
+		port = int(Config.get("sensor", "port"))
+		timeout = int(Config.get("sensor", "pingTimeout"))
+		return xmlrpclib.Server("https://%s:%s" % (self.ipAddress, port), transport=TimeoutTransport(timeout))
+	
 	def pingSensor(self):
 		"""This method checks the status of the sensor, to see if the snowman-clientd is running. It returns a dictionary,
 		where 'status' contains a boolean value if the ping was successful, and 'message' contains a textual message of
-		what happened."""
+		what happened. As the timeout is set on the socket, the method can be used from any thread."""
 		logger = logging.getLogger(__name__)
-		port = int(Config.get("sensor", "port"))
-		timeout = int(Config.get("sensor", "pingTimeout"))
-		sensor = xmlrpclib.Server("https://%s:%s" % (self.ipAddress, port))
+		sensor = self.getRPCServer()
 		
 		try:
-			with Timeout(timeout):
-				result = sensor.ping(self.name)
-		except Timeout.Timeout:
+			result = sensor.ping(self.name)
+		except socket.timeout:
 			logger.warning("Ping to sensor %s timed out" % self.name)
 			return {'status': False, 'message': "Ping to sensor timed out"}
 		except socket.gaierror:
@@ -366,14 +644,11 @@ class Sensor(models.Model):
 	def requestUpdate(self):
 		"""This method contacts the sensor, and asks it to do an update of its ruleset."""
 		logger = logging.getLogger(__name__)
-		port = int(Config.get("sensor", "port"))
-		timeout = int(Config.get("sensor", "pingTimeout"))
-		sensor = xmlrpclib.Server("https://%s:%s" % (self.ipAddress, port))
+		sensor = self.getRPCServer()
 		
 		try:
-			with Timeout(timeout):
-				result = sensor.startUpdate(self.name)
-		except Timeout.Timeout:
+			result = sensor.startUpdate(self.name)
+		except socket.timeout:
 			logger.warning("Ping to sensor timed out")
 			return {'status': False, 'message': "Ping to sensor timed out"}
 		except socket.gaierror:
@@ -415,14 +690,107 @@ class Sensor(models.Model):
 		return childCount
 	
 	@staticmethod
-	def refreshStatus():
-		"""This method updates the status-information of all the sensors that is not autonomous."""
-		for sensor in Sensor.objects.exclude(name="All").filter(autonomous=False).all():
-			status = sensor.pingSensor()
-			sensor.lastStatus = status['status']
-			sensor.lastChecked = datetime.datetime.utcnow().replace(tzinfo=utc)
-			sensor.save()
+	def updateEffectiveRuleSets(sensors, chunkSize = 500):
+		"""Recalculates effectiveRuleSets of the sensors in sensors (Sensor objects or 
+		primary-keys), and of every sensor below them. Only the rows that have changed is 
+		written, and the rulesets added or removed is recorded in the change-log. The 
+		descendants is looked up once for each distinct combination of assigned rulesets."""
+		
+		# Find the sensors below the given sensors.
+		parents = dict(Sensor.objects.values_list("pk", "parent"))
+		children = {}
+		for sensor, parent in parents.iteritems():
+			children.setdefault(parent, []).append(sensor)
+		
+		pending = [getattr(s, "pk", s) for s in sensors]
+		affected = set()
+		while pending:
+			sensor = pending.pop()
+			if(sensor not in affected):
+				affected.add(sensor)
+				pending.extend(children.get(sensor, []))
+		
+		# The active rulesets assigned directly to each sensor.
+		assigned = {}
+		for sensor, ruleSet in Sensor.ruleSets.through.objects.filter(ruleset__active=True).values_list("sensor", "ruleset"):
+			assigned.setdefault(sensor, set()).add(ruleSet)
+		
+		# The current effective rulesets of the affected sensors.
+		through = Sensor.effectiveRuleSets.through
+		effective = {}
+		for chunk in chunks(affected, chunkSize):
+			for sensor, ruleSet in through.objects.filter(sensor__in=chunk).values_list("sensor", "ruleset"):
+				effective.setdefault(sensor, set()).add(ruleSet)
+		
+		descendants = {}
+		for sensor in affected:
+			# Collect the sets assigned to the sensor and its parents. (The walk stops if the
+			#   parents of the sensors loops).
+			ruleSets = set()
+			visited = set()
+			s = sensor
+			while s != None and s in parents and s not in visited:
+				visited.add(s)
+				ruleSets.update(assigned.get(s, []))
+				s = parents[s]
 			
+			# Add the sets below them.
+			ruleSets = frozenset(ruleSets)
+			if(ruleSets not in descendants):
+				if(ruleSets):
+					descendants[ruleSets] = ruleSets.union(RuleSet.getActiveDescendants(ruleSets).values_list("pk", flat=True))
+				else:
+					descendants[ruleSets] = ruleSets
+			ruleSets = descendants[ruleSets]
+			
+			current = effective.get(sensor, set())
+			if(current - ruleSets):
+				through.objects.filter(sensor=sensor, ruleset__in=list(current - ruleSets)).delete()
+			through.objects.bulk_create([through(sensor_id=sensor, ruleset_id=r) for r in ruleSets - current])
+			if(current != ruleSets):
+				Change.record(Change.RULESET, ruleSets=current.symmetric_difference(ruleSets), sensor=sensor)
+	
+	@staticmethod
+	def updateEffectiveRuleSetsOf(ruleSet):
+		"""Updates effectiveRuleSets of the sensors which may be affected by a change of 
+		ruleSet (that it is moved, or (de)activated): The sensors which currently have the 
+		set, and the sensors where the set, or a set above it, is assigned."""
+		sensors = set(ruleSet.effectiveSensors.values_list("pk", flat=True))
+		sensors.update(Sensor.objects.filter(ruleSets__descendantLinks__descendant=ruleSet).values_list("pk", flat=True))
+		if(sensors):
+			Sensor.updateEffectiveRuleSets(sensors)
+	
+	@staticmethod
+	def refreshStatus():
+		"""This method updates the status-information of all the sensors that is not autonomous. The sensors is pinged
+		concurrently, by at most [sensor] pingWorkers threads. lastChecked of all the sensors is updated with a single
+		query, and lastStatus is only written for the sensors where it has changed."""
+		logger = logging.getLogger(__name__)
+		sensors = list(Sensor.objects.exclude(name="All").filter(autonomous=False).all())
+		if(len(sensors) == 0):
+			return
+		
+		def ping(sensor):
+			try:
+				return bool(sensor.pingSensor()['status'])
+			except Exception as e:
+				logger.warning("Could not ping sensor %s. %s" % (sensor.name, str(e)))
+				return False
+		
+		start = time.time()
+		statuses = parallelMap(ping, sensors, int(Config.get("sensor", "pingWorkers")))
+		
+		# Write the new statuses.
+		Sensor.objects.filter(pk__in=[s.pk for s in sensors]).update(lastChecked=datetime.datetime.utcnow().replace(tzinfo=utc))
+		for status in [True, False]:
+			changed = [s for s, newStatus in zip(sensors, statuses) if newStatus == status and s.lastStatus != status]
+			for sensor in changed:
+				logger.info("Sensor %s is now %s" % (sensor.name, "reachable" if status else "unreachable"))
+			if(changed):
+				Sensor.objects.filter(pk__in=[s.pk for s in changed]).update(lastStatus=status)
+		
+		logger.debug("Pinged %d sensors in %.2f seconds" % (len(sensors), time.time() - start))
+	
 	@staticmethod
 	def getAllSensors():
 		logger = logging.getLogger(__name__)
@@ -435,6 +803,25 @@ class Sensor(models.Model):
 			raise MissingObjectError(message)
 			logger.critical(message)
 
+def sensorRuleSetsChanged(sender, instance, action, reverse, pk_set, **kwargs):
+	"""Updates the effective rulesets of the sensors, when rulesets is assigned to or removed
+	from the sensors (from either side of the relation)."""
+	if(action in ["post_add", "post_remove"]):
+		if(reverse):
+			Sensor.updateEffectiveRuleSets(pk_set)
+		else:
+			Sensor.updateEffectiveRuleSets([instance])
+	elif(action == "pre_clear" and reverse):
+		# The sensors of the ruleset is not known after the relations are cleared.
+		instance.clearedSensors = list(instance.sensors.values_list("pk", flat=True))
+	elif(action == "post_clear"):
+		if(reverse):
+			Sensor.updateEffectiveRuleSets(getattr(instance, "clearedSensors", []))
+		else:
+			Sensor.updateEffectiveRuleSets([instance])
+
+models.signals.m2m_changed.connect(sensorRuleSetsChanged, sender=Sensor.ruleSets.through)
+
 class Comment(models.Model):
 	"""
 	Comment objects are used to track important events in the system, with who, what and when.
@@ -450,3 +837,137 @@ class Comment(models.Model):
 
 	def __str__(self):
 		return "<Comment time:%s, type:'%s', comment:'%s'>" % (self.time, self.type, self.comment)
+
+class Change(models.Model):
+	"""A Change is an entry in the global change-log, which lets the sensors fetch only what
+	have changed since their last synchronization. The primary-key is the sequence-number of
+	the change, which is always increasing. There are three kinds of changes:
+	
+		RULE - The rule with the SID SID is changed (new, revised, moved, (de)activated or deleted).
+		RULESET - The ruleset with the primary-key ruleSet is added to, or removed from, the 
+			effective rulesets of the sensor with the primary-key sensor.
+		TUNING - The filters or suppresses of the sensor with the primary-key sensor (and thereby 
+			the sensors below it) is changed.
+	
+	The references are plain integers rather than foreign-keys, so that the changes are kept
+	when the objects they refer to are deleted. Old changes are removed by prune."""
+
+	RULE = 1
+	RULESET = 2
+	TUNING = 3
+	
+	kind = models.IntegerField()
+	SID = models.IntegerField(null=True)
+	ruleSet = models.IntegerField(null=True)
+	sensor = models.IntegerField(null=True)
+	time = models.DateTimeField()
+	
+	def __repr__(self):
+		return "<Change seq:%d, kind:%d, SID:%s, ruleSet:%s, sensor:%s>" % (self.pk, self.kind, 
+					str(self.SID), str(self.ruleSet), str(self.sensor))
+
+	def __str__(self):
+		return "<Change seq:%d>" % (self.pk)
+	
+	@staticmethod
+	def record(kind, SIDs = [], ruleSets = [], sensor = None):
+		"""Adds changes of the type kind to the log: One change for each SID in SIDs, or for 
+		each ruleset in ruleSets, or a single change if both lists are empty."""
+		now = datetime.datetime.utcnow().replace(tzinfo=utc)
+		if(SIDs):
+			changes = [Change(kind=kind, SID=sid, sensor=sensor, time=now) for sid in set(SIDs)]
+		elif(ruleSets):
+			changes = [Change(kind=kind, ruleSet=r, sensor=sensor, time=now) for r in set(ruleSets)]
+		else:
+			changes = [Change(kind=kind, sensor=sensor, time=now)]
+		Change.objects.bulk_create(changes, batch_size=500)
+	
+	@staticmethod
+	def getSequence(settleTime = None, kind = None):
+		"""Returns the sequence-number a sensor can safely continue from: The latest change which 
+		is older than settleTime seconds ([xmlrpc-server] changeSettleTime if not given). Changes 
+		is recorded right before their transaction is committed, so a change which is not yet 
+		visible is never older than that. Only changes of the type kind is considered, if it is
+		given. Returns 0 if there are no such changes."""
+		if(settleTime == None):
+			settleTime = int(Config.get("xmlrpc-server", "changeSettleTime"))
+		settled = datetime.datetime.utcnow().replace(tzinfo=utc) - datetime.timedelta(seconds=settleTime)
+		changes = Change.objects.filter(time__lte=settled)
+		if(kind != None):
+			changes = changes.filter(kind=kind)
+		return changes.aggregate(models.Max("pk"))["pk__max"] or 0
+	
+	@staticmethod
+	def getChanges(sensor, sequence, chunkSize = 500):
+		"""Finds what have changed for sensor since the sequence-number sequence. Returns None if
+		the changes since sequence are no longer known (they are pruned, or sequence is from
+		another database), and the sensor needs a full synchronization. Otherwise a dictionary
+		is returned, with the keys:
+		
+			changed - The active rules the sensor should have, which may have changed; a dictionary
+				mapping the SID to the Rule (with its current revision loaded).
+			removed - A list of the SID's the sensor should no longer have.
+			filters - True if the filters of the sensor may have changed.
+			sequence - The sequence-number to continue from in the next synchronization."""
+		from tuning.tools import getSensorChain
+		
+		# The sequence can be continued from if no changes after it is pruned.
+		newest = Change.objects.aggregate(models.Max("pk"), models.Min("pk"))
+		if(sequence < 0 or sequence > (newest["pk__max"] or 0) or sequence < (newest["pk__min"] or 1) - 1):
+			return None
+		
+		nextSequence = max(sequence, Change.getSequence())
+		changes = Change.objects.filter(pk__gt=sequence)
+		
+		# The SID's of the changed rules, and of the rules in the rulesets added to or removed from
+		#   the sensor.
+		sids = set(changes.filter(kind=Change.RULE).values_list("SID", flat=True))
+		ruleSets = list(set(changes.filter(kind=Change.RULESET, sensor=sensor.pk).values_list("ruleSet", flat=True)))
+		for chunk in chunks(ruleSets, chunkSize):
+			sids.update(Rule.objects.filter(ruleSet__in=chunk).values_list("SID", flat=True))
+		filters = changes.filter(kind=Change.TUNING, sensor__in=getSensorChain(sensor)).exists()
+		
+		changed = {}
+		for chunk in chunks(list(sids), chunkSize):
+			for rule in Rule.objects.filter(SID__in=chunk, ruleSet__effectiveSensors=sensor, active=True).select_related("currentRevision", "ruleSet"):
+				if(rule.getCurrentRevision() != None):
+					changed[rule.SID] = rule
+		
+		return {"changed": changed, "removed": sorted(sids.difference(changed)), "filters": filters, "sequence": nextSequence}
+	
+	@staticmethod
+	def prune(days = None):
+		"""Deletes the changes older than days days ([xmlrpc-server] changeRetention if not given).
+		The newest change is always kept, so that the sequence-numbers are never reused. Returns
+		the number of deleted changes."""
+		if(days == None):
+			days = int(Config.get("xmlrpc-server", "changeRetention"))
+		newest = Change.objects.aggregate(models.Max("pk"))["pk__max"]
+		if(newest == None):
+			return 0
+		
+		limit = datetime.datetime.utcnow().replace(tzinfo=utc) - datetime.timedelta(days=days)
+		old = Change.objects.filter(time__lt=limit, pk__lt=newest)
+		count = old.count()
+		if(count > 0):
+			old.delete()
+		return count
+
+def ruleSaved(sender, instance, **kwargs):
+	"""Records a change of the rule, when it is saved."""
+	Change.record(Change.RULE, SIDs=[instance.SID])
+
+def ruleRevisionSaved(sender, instance, **kwargs):
+	"""Records a change of the rule, when one of its revisions is saved."""
+	Change.record(Change.RULE, SIDs=[instance.rule.SID])
+
+def ruleSetDeleted(sender, instance, **kwargs):
+	"""Records a change of the rules in a ruleset which is about to be deleted. (The deletion
+	cascades to the child-sets, and this is called for each of them as well)."""
+	sids = list(instance.rules.values_list("SID", flat=True))
+	if(sids):
+		Change.record(Change.RULE, SIDs=sids)
+
+models.signals.post_save.connect(ruleSaved, sender=Rule)
+models.signals.post_save.connect(ruleRevisionSaved, sender=RuleRevision)
+models.signals.pre_delete.connect(ruleSetDeleted, sender=RuleSet)
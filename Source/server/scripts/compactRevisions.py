@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+This script deletes the old rule-revisions exceeding the maxRevisions limit in the 
+configuration, from all the rules in the database. The current revision of a rule is 
+never deleted.
+
+The updates is only compacting the rules they are changing, so this script is useful to 
+run once after lowering maxRevisions, or on a database which has grown large.
+
+Usage: compactRevisions.py [<maxRevisions>]
+"""
+
+import logging
+import os
+import sys
+
+# Add the parent folder of the script to the path
+scriptpath = os.path.realpath(__file__)
+scriptdir = os.path.dirname(scriptpath)
+parentdir = os.path.dirname(scriptdir)
+sys.path.append(parentdir)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "srm.settings")
+
+from django.db import transaction
+
+from core.models import RuleRevision
+from util.config import Config
+
+if __name__ == "__main__":
+	logger = logging.getLogger(__name__)
+	
+	# Grab the parameters.
+	try:
+		maxRevisions = int(sys.argv[1])
+	except IndexError:
+		maxRevisions = int(Config.get("update", "maxRevisions"))
+	except ValueError:
+		print "Usage: %s [<maxRevisions>]" % sys.argv[0]
+		sys.exit(1)
+	
+	if(maxRevisions <= 0):
+		print "maxRevisions is 0 (unlimited). Nothing to do."
+		sys.exit(0)
+	
+	with transaction.atomic():
+		deleted, seconds = RuleRevision.compactRevisions(maxRevisions)
+	
+	print "Deleted %d rule-revisions (keeping %d per rule) in %.2f seconds." % (deleted, maxRevisions, seconds)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+"""
+This script recreates the ruleset hierarchy (RuleSetHierarchy) from the parent-relations
+of the rulesets. The hierarchy is kept up to date when the rulesets are changed, so this 
+script is only needed once, for a database created before the hierarchy was stored.
+
+Usage: rebuildRuleSetHierarchy.py
+"""
+
+import os
+import sys
+import time
+
+# Add the parent folder of the script to the path
+scriptpath = os.path.realpath(__file__)
+scriptdir = os.path.dirname(scriptpath)
+parentdir = os.path.dirname(scriptdir)
+sys.path.append(parentdir)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "srm.settings")
+
+from django.db import transaction
+
+from core.models import RuleSetHierarchy
+
+if __name__ == "__main__":
+	start = time.time()
+	with transaction.atomic():
+		links = RuleSetHierarchy.rebuild()
+	
+	print "Created %d ruleset hierarchy links in %.2f seconds." % (links, time.time() - start)
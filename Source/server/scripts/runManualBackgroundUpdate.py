@@ -22,6 +22,7 @@ doubleFork()
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "srm.settings")
 
+from update.locks import SourceLock
 from update.models import Source
 from update.tasks import UpdateTasks
 
@@ -53,12 +54,11 @@ if __name__ == "__main__":
 			logger.warning("Could not find a source for the manual update.")
 			sys.exit(1)
 
-	if(s.locked):
+	lock = SourceLock(s)
+	if(not lock.acquire()):
 		logger.info("Could not update '%s', as there seems to already be an update going for this source." % s.name)
 		sys.exit(1)
 	else:
-		s.locked = True
-		s.save()
 		logger.info("Starting the update from %s, with PID:%d." % (s.name, os.getpid()))
 	
 	# Start doing the update.
@@ -68,5 +68,4 @@ if __name__ == "__main__":
 	except:
 		logger.warning("Something happened while doing a manual update of %s", s.name)
 	finally:
-		s.locked = False
-		s.save()
+		lock.release()
@@ -25,7 +25,9 @@ sys.path.append(parentdir)
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "srm.settings")
 
-from update.models import Update, Source, UpdateLog
+from update.locks import SourceLock
+from update.models import Update, Source
+from update.progress import ProgressReporter
 from update.tasks import UpdateTasks
 from util.config import Config
 import util.logger
@@ -49,18 +51,19 @@ if __name__ == "__main__":
 		logger.error("Could not find source with ID:%d" % sourceID)
 		sys.exit(1)
 	
-	update = Update.objects.create(source=source, time=datetime.datetime.now())
-
-	if(source.locked):
-		logger.info("Could not update '%s', as there seems to already be an update going for this source.")
+	# Lock the source before the update is created. (A lock left by a crashed update is taken over
+	#   when it is stale).
+	lock = SourceLock(source)
+	if(not lock.acquire()):
+		logger.info("Could not update '%s', as there seems to already be an update going for this source." % source.name)
 		sys.exit(1)
 	else:
-		source.locked = True
-		source.save()
 		logger.info("Starting the update from %s, with PID:%d." % (source.name, os.getpid()))
 	
+	update = Update.objects.create(source=source, time=datetime.datetime.now())
+	
 	if(source.md5url and len(source.md5url) > 0):
-		UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="1 Trying to fetch md5sum, to compare with last processed file.")
+		UpdateTasks.logProgress(update, "1 Trying to fetch md5sum, to compare with last processed file.")
 		try:
 			socket = urllib2.urlopen(source.md5url)
 			md5 = socket.read()
@@ -78,7 +81,7 @@ if __name__ == "__main__":
 	
 	
 	if(len(str(md5)) == 0 or str(md5) != str(source.lastMd5)):
-		UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="2 Downloading ruleset from source.")
+		UpdateTasks.logProgress(update, "2 Downloading ruleset from source.")
 		logger.info("Starting to download %s" % source.url)
 		storagelocation = Config.get("storage", "inputFiles")		
 		filename = storagelocation + source.url.split("/")[-1]
@@ -102,42 +105,40 @@ if __name__ == "__main__":
 				_hash.update(buffer)
 
 		except urllib2.HTTPError as e:
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="100 Error during downloading. Check log for details..")
+			UpdateTasks.logProgress(update, "100 Error during downloading. Check log for details..")
 			logger.error("Error during download: %s" % str(e))
-			source.locked = False
-			source.save()
+			lock.release()
 			sys.exit(1)
 
 		logger.debug("Downloaded-MD5:'%s'" % str(_hash.hexdigest()))
 		logger.debug("LastUpdate-MD5:'%s'" % str(source.lastMd5))
 	
 		if(str(_hash.hexdigest()) != str(source.lastMd5)):
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="7 Starting to process the download.")
+			UpdateTasks.logProgress(update, "7 Starting to process the download.")
 			logger.info("Processing the download" )
 			try:
 				UpdateTasks.runUpdate(filename, source.name, update=update)
 			except Exception as e:
 				logger.critical("Hit exception while running update: %s" % str(e))
-				UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="100 ERROR: Hit an exception while processing the update.")
+				UpdateTasks.logProgress(update, "100 ERROR: Hit an exception while processing the update.")
 				logger.debug("%s" % (traceback.format_exc()))
-				source.locked = False
-				source.save()
+				lock.release()
 				sys.exit(1)
 		
 			logger.info("Storing md5 of this update: %s" % (_hash.hexdigest()))
 			source.lastMd5 = _hash.hexdigest()
-			source.save()
+			source.save(update_fields=["lastMd5"])
 		else:
 			logger.info("The downloaded file has the same md5sum as the last file we updated from. Skipping update.")
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="100 Downloaded file is processed earlier. Finishing.")
+			UpdateTasks.logProgress(update, "100 Downloaded file is processed earlier. Finishing.")
 	else:
 		logger.info("We already have the latest version of the %s ruleset. Skipping download." % source.name)
-		UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="100 MD5 sum mathces last update. Skipping.")
+		UpdateTasks.logProgress(update, "100 MD5 sum mathces last update. Skipping.")
 
 	logger.info("Finished the update, with PID:%d, from: %s" % (os.getpid(), source.name))
-	UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="100 Finished the update.")
-	source.locked = False
-	source.save()
+	UpdateTasks.logProgress(update, "100 Finished the update.")
+	ProgressReporter.forUpdate(update).close()
+	lock.release()
 	
 	if(update.ruleRevisions.count() == 0):
 		update.delete()
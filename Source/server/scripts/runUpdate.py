@@ -5,8 +5,12 @@ so that the webpage does not need to block while processing data.
 
 The script can also be invoked manually. It is able to process a single textfile, an archive 
 (tar(gz), zip) or an unpacked folder.
+
+If "dryrun" is given as an argument, nothing is written to the database. The changes the update
+would have made is printed as JSON instead.
 """
 
+import json
 import logging
 import os
 import sys
@@ -28,11 +32,13 @@ if __name__ == "__main__":
 	try:
 		filename = sys.argv[1]
 	except IndexError:
-		print "Usage: %s <update directory> [<source>] [create]"
+		print "Usage: %s <update directory> [<source>] [create] [dryrun]" % sys.argv[0]
 		sys.exit(1)
 		
 	try:
 		sourcename = sys.argv[2]
+		if(sourcename in ["create", "dryrun"]):
+			sourcename = "Manual"
 	except IndexError:
 		sourcename = "Manual"
 
@@ -44,5 +50,9 @@ if __name__ == "__main__":
 			logger.info("Created a new source during updates: %s", s)
 
 	# Start doing the update.
-	UpdateTasks.runUpdate(filename, sourcename)
+	if("dryrun" in sys.argv):
+		plan = UpdateTasks.runUpdate(filename, sourcename, dryRun=True)
+		print json.dumps(plan, indent=2, sort_keys=True)
+	else:
+		UpdateTasks.runUpdate(filename, sourcename)
 	logger.info("Finished the update, with PID:%d, from: %s" % (os.getpid(), filename))
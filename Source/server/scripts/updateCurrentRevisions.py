@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+"""
+This script sets the current revision (Rule.currentRevision) of all the rules in the
+database. The updates keep the current revisions up to date, so this script is only
+needed once, for a database created before the current revisions were stored.
+
+Usage: updateCurrentRevisions.py
+"""
+
+import os
+import sys
+import time
+
+# Add the parent folder of the script to the path
+scriptpath = os.path.realpath(__file__)
+scriptdir = os.path.dirname(scriptpath)
+parentdir = os.path.dirname(scriptdir)
+sys.path.append(parentdir)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "srm.settings")
+
+from django.db import transaction
+
+from core.models import Rule
+
+if __name__ == "__main__":
+	start = time.time()
+	with transaction.atomic():
+		Rule.updateCurrentRevisions()
+	
+	print "Updated the current revision of %d rules in %.2f seconds." % (Rule.objects.count(), time.time() - start)
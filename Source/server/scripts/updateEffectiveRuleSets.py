@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""
+This script recalculates the effective rulesets (Sensor.effectiveRuleSets) of all the 
+sensors. The effective rulesets is kept up to date when sensors and rulesets are changed, 
+so this script is only needed once, for a database created before they were stored. The 
+ruleset hierarchy must be in place first (see rebuildRuleSetHierarchy.py).
+
+Usage: updateEffectiveRuleSets.py
+"""
+
+import os
+import sys
+import time
+
+# Add the parent folder of the script to the path
+scriptpath = os.path.realpath(__file__)
+scriptdir = os.path.dirname(scriptpath)
+parentdir = os.path.dirname(scriptdir)
+sys.path.append(parentdir)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "srm.settings")
+
+from django.db import transaction
+
+from core.models import Sensor
+
+if __name__ == "__main__":
+	start = time.time()
+	with transaction.atomic():
+		Sensor.updateEffectiveRuleSets(Sensor.objects.all())
+	
+	print "Updated the effective rulesets of %d sensors in %.2f seconds." % (Sensor.objects.count(), time.time() - start)
@@ -1,11 +1,24 @@
 import datetime
+import os
+from django.contrib.auth.models import User
 from django.test import TestCase
+from django.utils.timezone import utc
 
-from core.models import Rule, RuleRevision, Generator, RuleClass, RuleSet, Sensor, RuleReferenceType
+from core.models import Change, Rule, RuleRevision, Generator, RuleClass, RuleSet, RuleSetHierarchy, Sensor, RuleReferenceType
 from update.models import Source, Update
-from tuning.models import DetectionFilter, EventFilter, Suppress
+from tuning.models import DetectionFilter, EventFilter, Suppress, SuppressAddress
+from tuning.tools import resolveTuning
 
+from update.exceptions import LockError
+from update.locks import SourceLock
+from update.parser import Parser
+from update.persistence import bulkSave
 from update.tasks import UpdateTasks
+from update.updater import Updater
+from util.manifestcache import Manifest, ManifestCache
+from util.ruletokenizer import tokenizeRule
+from util.sensorsync import SyncJob
+from util.tools import parallelMap
 
 class Test(TestCase):
 
@@ -150,4 +163,442 @@ class Test(TestCase):
 # 			
 # 		rule = Rule.objects.get(SID=2003195)
 # 		
-# 		self.assertTrue(rule.revisions.count() == 2)
\ No newline at end of file
+# 		self.assertTrue(rule.revisions.count() == 2)
+
+class RuleTokenizerTest(TestCase):
+
+	def test_tokenizeRule(self):
+		rule = tokenizeRule('# alert tcp any any -> any 21 (msg:"A message; with semicolon"; content:"|3b|"; \
+						reference:url,www.example.com/; classtype: example-classtype ; priority:10; \
+						detection_filter:track by_src, count 30, seconds 60; threshold:type both, track by_dst, count 10, seconds 60; \
+						metadata:foo bar, ruleset community; sid:2000000; rev:10)')
+		
+		self.assertTrue(rule.sid == 2000000)
+		self.assertTrue(rule.rev == 10)
+		self.assertTrue(rule.active == False)
+		self.assertTrue(rule.msg == "A message; with semicolon")
+		self.assertTrue(rule.classtype == "example-classtype")
+		self.assertTrue(rule.priority == 10)
+		self.assertTrue(rule.ruleset == "community")
+		self.assertTrue(rule.references == [("url", "www.example.com/")])
+		self.assertTrue(rule.detectionFilter == ("by_src", "30", "60"))
+		self.assertTrue(rule.eventFilter == ("both", "by_dst", "10", "60"))
+		self.assertTrue(rule.filters == "detection_filter:track by_src, count 30, seconds 60;threshold:type both, track by_dst, count 10, seconds 60;")
+		self.assertTrue("detection_filter" not in rule.raw and rule.raw.startswith("alert tcp"))
+		
+	def test_tokenizeNonRule(self):
+		self.assertTrue(tokenizeRule("# This is just a comment") == None)
+		self.assertTrue(tokenizeRule('alert tcp any any -> any 21 (msg:"No sid"; classtype:foo; rev:1;)') == None)
+
+	def test_tokenizeEscapes(self):
+		rule = tokenizeRule('alert tcp any any -> any 21 (content:"a\\";sid:1;"; pcre:"/x\\;sid:2;/"; msg:"Escaped"; classtype:foo; SID : 3; rev:4)')
+		self.assertTrue(rule.sid == 3)
+		self.assertTrue(rule.rev == 4)
+		self.assertTrue(rule.msg == "Escaped")
+
+class StreamingUpdaterTest(TestCase):
+	
+	def test_repeatedSid(self):
+		generator = Generator.objects.create(GID=1, alertID=1, message="Generator")
+		ruleClass = RuleClass.objects.create(classtype="class", description="Class", priority=1)
+		ruleSet = RuleSet.objects.create(name="Old", description="Old", active=True)
+		old = Rule.objects.create(SID=10, active=True, generator=generator, ruleSet=ruleSet, ruleClass=ruleClass)
+		RuleRevision.objects.create(rule=old, rev=2, raw="raw 10", msg="Old", active=True)
+		
+		Sensor.objects.create(name="All")
+		source = Source.objects.create(name="StreamTest")
+		update = Update.objects.create(time=datetime.datetime.utcnow().replace(tzinfo=utc), source=source)
+		updater = Updater(update, streamSize=1)
+		updater.msgsource = "sidmsg"
+		
+		# Every new SID saves the rules recieved before it.
+		for name in ["First", "Second", "Other"]:
+			updater.addRuleSet(name)
+		updater.addRule(1, 1, "raw 1", "First", True, "First", "class")
+		updater.addRule(10, 3, "raw 10", "Old", True, "Old", "class")
+		updater.addRule(1, 1, "raw 1b", "Second", True, "Second", "class")
+		updater.addRule(10, 2, "raw 10b", "Old", True, "Other", "class")
+		updater.addRule(2, 1, "raw 2", "Third", True, "First", "class")
+		updater.addMessage(10, "From sid-msg.map")
+		updater.saveAll()
+		
+		# The last rule recieved replaces the revision saved earlier in the update.
+		rule = Rule.objects.get(SID=1)
+		self.assertEqual(rule.ruleSet.name, "Second")
+		self.assertEqual(rule.revisions.count(), 1)
+		self.assertEqual(rule.getCurrentRevision().raw, "raw 1b")
+		self.assertEqual(rule.getCurrentRevision().msg, "First")
+		
+		# A rev which is not higher than the rev before the update keeps the earlier revision.
+		self.assertEqual(sorted(old.revisions.values_list("rev", flat=True)), [2, 3])
+		self.assertEqual(Rule.objects.get(SID=10).getCurrentRevision().raw, "raw 10")
+		self.assertEqual(Rule.objects.get(SID=10).getCurrentRevision().msg, "From sid-msg.map")
+
+class ReferenceUpdateTest(TestCase):
+	
+	def test_sidMsgReferences(self):
+		Sensor.objects.create(name="All")
+		source = Source.objects.create(name="ReferenceTest")
+		for references in [[("url", "rule.example.com", True)], 
+				[("url", "rule.example.com", True), ("cve", "2014-0001", False)]]:
+			update = Update.objects.create(time=datetime.datetime.utcnow().replace(tzinfo=utc), source=source)
+			updater = Updater(update)
+			updater.addRuleSet("Set")
+			updater.addRule(1, 1, "raw 1", "Rule", True, "Set", "class")
+			for referenceType, reference, inRule in references:
+				updater.addReferenceType(referenceType, "http://")
+				updater.addReference(referenceType, reference, 1, inRule=inRule)
+			updater.saveAll()
+		
+		# The rule is unchanged in the second update, but the reference from sid-msg.map is new.
+		revision = Rule.objects.get(SID=1).getCurrentRevision()
+		self.assertEqual(Rule.objects.get(SID=1).revisions.count(), 1)
+		self.assertEqual(sorted(revision.references.values_list("reference", flat=True)), ["2014-0001", "rule.example.com"])
+
+class UpdateFileTest(TestCase):
+	
+	def test_checksumsSavedWithUpdate(self):
+		Sensor.objects.create(name="All")
+		source = Source.objects.create(name="FileTest")
+		update = Update.objects.create(time=datetime.datetime.utcnow().replace(tzinfo=utc), source=source)
+		parser = Parser(update)
+		self.assertTrue(parser.checkHash(("a.rules", "a.rules"), "abc"))
+		self.assertEqual(source.files.count(), 0)
+		
+		# The checksum is not stored if the update is not saved.
+		def fail():
+			raise RuntimeError("Failed")
+		parser.updater.recordChanges = fail
+		self.assertRaises(RuntimeError, parser.save)
+		self.assertEqual(source.files.count(), 0)
+		
+		del parser.updater.recordChanges
+		parser.save()
+		self.assertEqual(source.files.get().checksum, "abc")
+		self.assertFalse(Parser(update).checkHash(("a.rules", "a.rules"), "abc"))
+		self.assertTrue(Parser(update).checkHash(("a.rules", "a.rules"), "def"))
+
+class SourceLockTest(TestCase):
+
+	def test_lock(self):
+		source = Source.objects.create(name="LockTest")
+		first = SourceLock(source)
+		second = SourceLock(Source.objects.get(pk=source.pk))
+		second.owner = "otherhost:1"
+		
+		self.assertTrue(first.acquire())
+		self.assertTrue(second.acquire() == False)
+		self.assertTrue(Source.objects.get(pk=source.pk).isLocked())
+		
+		first.release()
+		self.assertTrue(Source.objects.get(pk=source.pk).isLocked() == False)
+		self.assertTrue(second.acquire())
+		second.release()
+		
+	def test_staleLock(self):
+		source = Source.objects.create(name="LockTest", locked=True, lockOwner="crashed:1",
+				lockHeartbeat=datetime.datetime.utcnow().replace(tzinfo=utc) - datetime.timedelta(days=1))
+		self.assertTrue(source.isLocked() == False)
+		
+		lock = SourceLock(source)
+		self.assertTrue(lock.acquire())
+		self.assertTrue(Source.objects.get(pk=source.pk).lockOwner == lock.owner)
+		lock.release()
+	
+	def test_lostLock(self):
+		source = Source.objects.create(name="LockTest")
+		lock = SourceLock(source)
+		self.assertTrue(lock.acquire())
+		SourceLock.refreshHeld(source)
+		
+		# Another update takes over the lock. The save of this update is then aborted.
+		Source.objects.filter(pk=source.pk).update(lockOwner="otherhost:1")
+		self.assertRaises(LockError, SourceLock.refreshHeld, source)
+		self.assertTrue(lock.lost)
+		
+		lock.release()
+		self.assertTrue(Source.objects.get(pk=source.pk).lockOwner == "otherhost:1")
+		SourceLock.refreshHeld(source)
+
+class BulkSaveTest(TestCase):
+	
+	def test_bulkSave(self):
+		existing = Generator.objects.create(GID=1, alertID=1, message="Old")
+		Generator.objects.create(GID=2, alertID=2, message="Other")
+		generators = [Generator(GID=1, alertID=1, message="New"), Generator(GID=1, alertID=2, message="Added"), 
+				Generator(GID=2, alertID=2, message="Other")]
+		bulkSave(Generator, generators, ["GID", "alertID"], ["message"], 1)
+		
+		self.assertTrue(generators[0].pk == existing.pk)
+		self.assertTrue(Generator.objects.get(pk=existing.pk).message == "New")
+		self.assertTrue(Generator.objects.get(pk=generators[1].pk).alertID == 2)
+		self.assertTrue(Generator.objects.get(pk=generators[2].pk).GID == 2)
+		self.assertTrue(Generator.objects.count() == 3)
+
+class RuleSetHierarchyTest(TestCase):
+	
+	def test_hierarchy(self):
+		generator = Generator.objects.create(GID=1, alertID=1, message="Generator")
+		ruleClass = RuleClass.objects.create(classtype="class", description="Class", priority=1)
+		top = RuleSet.objects.create(name="Top", description="Top", active=True)
+		middle = RuleSet.objects.create(name="Middle", parent=top, description="Middle", active=False)
+		bottom = RuleSet.objects.create(name="Bottom", parent=middle, description="Bottom", active=True)
+		other = RuleSet.objects.create(name="Other", description="Other", active=True)
+		for sid, ruleSet, active in [(1, top, True), (2, middle, True), (3, bottom, False), (4, bottom, True)]:
+			Rule.objects.create(SID=sid, active=active, generator=generator, ruleSet=ruleSet, ruleClass=ruleClass)
+		
+		self.assertEqual(len(top), 4)
+		self.assertEqual(top.getActiveRuleCount(), 3)
+		self.assertEqual(top.getChildSets(), [])
+		self.assertTrue(bottom.isDescendantOf(top))
+		
+		# Move the bottom set to the other set, so that it is no longer below an inactive set.
+		bottom.parent = other
+		bottom.save()
+		self.assertEqual(len(top), 2)
+		self.assertEqual(len(other), 2)
+		self.assertEqual(other.getChildSets(), [bottom])
+		self.assertEqual(sorted(other.getRuleRevisions(None).keys()), ["3", "4"])
+		self.assertTrue(bottom.isDescendantOf(top) == False)
+		
+		links = RuleSetHierarchy.objects.count()
+		self.assertEqual(RuleSetHierarchy.rebuild(), links)
+
+class EffectiveRuleSetTest(TestCase):
+	
+	def test_effectiveRuleSets(self):
+		top = Sensor.objects.create(name="Top")
+		sensor = Sensor.objects.create(name="Sensor", parent=top)
+		parentSet = RuleSet.objects.create(name="Parent", description="Parent", active=True)
+		childSet = RuleSet.objects.create(name="Child", parent=parentSet, description="Child", active=True)
+		otherSet = RuleSet.objects.create(name="Other", description="Other", active=True)
+		
+		top.ruleSets.add(parentSet)
+		self.assertEqual(set(sensor.effectiveRuleSets.all()), set([parentSet, childSet]))
+		
+		childSet.active = False
+		childSet.save()
+		self.assertEqual(list(sensor.effectiveRuleSets.all()), [parentSet])
+		
+		otherSet.sensors.add(sensor)
+		parentSet.sensors.clear()
+		self.assertEqual(list(sensor.effectiveRuleSets.all()), [otherSet])
+		
+		sensor.parent = None
+		sensor.save()
+		top.ruleSets.add(parentSet)
+		self.assertEqual(list(top.effectiveRuleSets.all()), [parentSet])
+		self.assertEqual(list(sensor.effectiveRuleSets.all()), [otherSet])
+	
+	def test_sensorLoop(self):
+		first = Sensor.objects.create(name="First")
+		second = Sensor.objects.create(name="Second", parent=first)
+		ruleSet = RuleSet.objects.create(name="Set", description="Set", active=True)
+		Sensor.objects.filter(pk=first.pk).update(parent=second)
+		
+		first.ruleSets.add(ruleSet)
+		self.assertEqual(list(first.effectiveRuleSets.all()), [ruleSet])
+		self.assertEqual(list(second.effectiveRuleSets.all()), [ruleSet])
+
+class TuningResolverTest(TestCase):
+	
+	def test_resolveTuning(self):
+		generator = Generator.objects.create(GID=1, alertID=1, message="Generator")
+		ruleClass = RuleClass.objects.create(classtype="class", description="Class", priority=1)
+		ruleSet = RuleSet.objects.create(name="Set", description="Set", active=True)
+		first = Rule.objects.create(SID=1, active=True, generator=generator, ruleSet=ruleSet, ruleClass=ruleClass)
+		second = Rule.objects.create(SID=2, active=True, generator=generator, ruleSet=ruleSet, ruleClass=ruleClass)
+		
+		top = Sensor.objects.create(name="Top")
+		sensor = Sensor.objects.create(name="Sensor", parent=top)
+		
+		DetectionFilter.objects.create(rule=first, sensor=top, track=1, count=1, seconds=1)
+		local = DetectionFilter.objects.create(rule=first, sensor=sensor, track=2, count=2, seconds=2)
+		inherited = EventFilter.objects.create(rule=second, sensor=top, eventFilterType=1, track=1, count=1, seconds=1)
+		suppress = Suppress.objects.create(rule=second, sensor=sensor, track=1)
+		SuppressAddress.objects.create(ipAddress="10.0.0.1").suppress.add(suppress)
+		
+		detectionFilters, eventFilters, suppresses = resolveTuning(sensor, [first, second])
+		self.assertEqual(detectionFilters, {first.pk: local})
+		self.assertEqual(eventFilters, {second.pk: inherited})
+		self.assertEqual(suppresses[second.pk].getAddresses(), ["10.0.0.1"])
+		
+		detectionFilters, eventFilters, suppresses = resolveTuning(top, [first, second])
+		self.assertEqual(detectionFilters[first.pk].sensor, top)
+		self.assertEqual(suppresses, {})
+
+class ChangeSequenceTest(TestCase):
+	
+	def test_getChanges(self):
+		generator = Generator.objects.create(GID=1, alertID=1, message="Generator")
+		ruleClass = RuleClass.objects.create(classtype="class", description="Class", priority=1)
+		ruleSet = RuleSet.objects.create(name="Set", description="Set", active=True)
+		rule = Rule.objects.create(SID=1, active=True, generator=generator, ruleSet=ruleSet, ruleClass=ruleClass)
+		RuleRevision.objects.create(rule=rule, rev=1, raw="raw", msg="msg", active=True)
+		Rule.updateCurrentRevisions()
+		sensor = Sensor.objects.create(name="Sensor")
+		
+		sensor.ruleSets.add(ruleSet)
+		changes = Change.getChanges(sensor, 0)
+		self.assertEqual(changes["changed"].keys(), [1])
+		self.assertEqual(changes["removed"], [])
+		
+		sequence = Change.getSequence(settleTime=0)
+		self.assertEqual(Change.getChanges(sensor, sequence)["changed"], {})
+		
+		sensor.ruleSets.remove(ruleSet)
+		DetectionFilter.objects.create(rule=rule, sensor=sensor, track=1, count=1, seconds=1)
+		changes = Change.getChanges(sensor, sequence)
+		self.assertEqual(changes["removed"], [1])
+		self.assertTrue(changes["filters"])
+		
+		Change.prune(days=-1)
+		self.assertEqual(Change.getChanges(sensor, 0), None)
+		self.assertNotEqual(Change.getChanges(sensor, Change.getSequence(settleTime=0)), None)
+
+	def test_unchangedTuning(self):
+		User.objects.create(username="System")
+		Sensor.objects.create(name="All")
+		source = Source.objects.create(name="TuningTest")
+		tuningChanges = []
+		for count, addresses in [(1, ["10.0.0.1"]), (1, ["10.0.0.1"]), (2, ["10.0.0.1"]), (2, ["10.0.0.2"])]:
+			update = Update.objects.create(time=datetime.datetime.utcnow().replace(tzinfo=utc), source=source)
+			updater = Updater(update)
+			updater.addRuleSet("Set")
+			updater.addRule(1, 1, "raw 1", "Rule", True, "Set", "class")
+			updater.addRule(2, 1, "raw 2", "Rule", True, "Set", "class")
+			updater.addFilter(1, "by_src", count, 60)
+			updater.addSuppress(2, "by_src", addresses)
+			updater.saveAll()
+			tuningChanges.append(Change.objects.filter(kind=Change.TUNING).count())
+		
+		# Only the updates changing the filter or the suppress is recorded.
+		self.assertEqual(tuningChanges, [1, 1, 2, 3])
+
+class ManifestCacheTest(TestCase):
+	
+	def test_sharedManifests(self):
+		generator = Generator.objects.create(GID=1, alertID=1, message="Generator")
+		ruleClass = RuleClass.objects.create(classtype="class", description="Class", priority=1)
+		ruleSet = RuleSet.objects.create(name="Set", description="Set", active=True)
+		rule = Rule.objects.create(SID=10, active=True, generator=generator, ruleSet=ruleSet, ruleClass=ruleClass)
+		revision = RuleRevision.objects.create(rule=rule, rev=3, raw="raw", msg="msg", active=True)
+		Rule.updateCurrentRevisions()
+		first = Sensor.objects.create(name="First")
+		second = Sensor.objects.create(name="Second")
+		ruleSet.sensors.add(first, second)
+		
+		cache = ManifestCache(maxSize=1024, settleTime=0)
+		manifest = cache.get(first)
+		self.assertIs(cache.get(second), manifest)
+		self.assertEqual(manifest.getRevisions(), {"10": 3})
+		self.assertEqual(manifest.getRevision(10), revision.pk)
+		self.assertEqual(manifest.getRevision(11), None)
+		
+		# Manifests larger than the cache is built, but not cached.
+		small = ManifestCache(maxSize=1, settleTime=0)
+		self.assertEqual(len(small.get(first)), 1)
+		self.assertEqual(len(small.manifests), 0)
+		
+		rule.active = False
+		rule.save()
+		self.assertEqual(len(cache.get(first)), 0)
+		self.assertEqual(len(cache.manifests), 1)
+	
+	def test_unsettledChanges(self):
+		generator = Generator.objects.create(GID=1, alertID=1, message="Generator")
+		ruleClass = RuleClass.objects.create(classtype="class", description="Class", priority=1)
+		ruleSet = RuleSet.objects.create(name="Set", description="Set", active=True)
+		rule = Rule.objects.create(SID=10, active=True, generator=generator, ruleSet=ruleSet, ruleClass=ruleClass)
+		RuleRevision.objects.create(rule=rule, rev=3, raw="raw", msg="msg", active=True)
+		Rule.updateCurrentRevisions()
+		first = Sensor.objects.create(name="First")
+		second = Sensor.objects.create(name="Second")
+		ruleSet.sensors.add(first, second)
+		
+		builds = []
+		build = Manifest.build
+		Manifest.build = staticmethod(lambda ruleSets: builds.append(ruleSets) or build(ruleSets))
+		try:
+			# None of the changes is settled yet. The manifest is still built once, and shared.
+			now = datetime.datetime.utcnow().replace(tzinfo=utc)
+			Change.objects.create(pk=1000, kind=Change.RULE, SID=20, time=now)
+			cache = ManifestCache(maxSize=1024, settleTime=60)
+			manifest = cache.get(first)
+			self.assertIs(cache.get(second), manifest)
+			self.assertEqual(len(manifest), 1)
+			self.assertEqual(len(builds), 1)
+			
+			# A change with a lower sequence-number is committed later. It is applied on top of the
+			#   cached manifest.
+			Rule.objects.filter(pk=rule.pk).update(active=False)
+			Change.objects.create(pk=999, kind=Change.RULE, SID=10, time=now)
+			manifest = cache.get(first)
+			self.assertEqual(len(manifest), 0)
+			self.assertIs(cache.get(second), manifest)
+			self.assertEqual(len(builds), 1)
+			
+			# Changes to the tuning does not give a new generation.
+			Change.objects.update(time=now - datetime.timedelta(seconds=120))
+			manifest = cache.get(first)
+			Change.record(Change.TUNING, sensor=first.pk)
+			Change.objects.update(time=now - datetime.timedelta(seconds=120))
+			self.assertIs(cache.get(second), manifest)
+			self.assertEqual(len(builds), 2)
+			self.assertEqual(len(cache.manifests), 1)
+		finally:
+			Manifest.build = staticmethod(build)
+
+	def test_missingCurrentRevisions(self):
+		generator = Generator.objects.create(GID=1, alertID=1, message="Generator")
+		ruleClass = RuleClass.objects.create(classtype="class", description="Class", priority=1)
+		ruleSet = RuleSet.objects.create(name="Set", description="Set", active=True)
+		for sid in [10, 20, 30]:
+			rule = Rule.objects.create(SID=sid, active=True, generator=generator, ruleSet=ruleSet, ruleClass=ruleClass)
+			RuleRevision.objects.create(rule=rule, rev=1, raw="raw", msg="msg", active=True)
+			latest = RuleRevision.objects.create(rule=rule, rev=2, raw="raw", msg="msg", active=True)
+		Rule.updateCurrentRevisions()
+		sensor = Sensor.objects.create(name="Sensor")
+		ruleSet.sensors.add(sensor)
+
+		# The rules of a database which is not upgraded yet does not have a current revision. The
+		#   latest active revision is used for them.
+		Rule.objects.filter(SID__in=[10, 30]).update(currentRevision=None)
+		manifest = ManifestCache(maxSize=1024, settleTime=0).get(sensor)
+		self.assertEqual(list(manifest.sids), [10, 20, 30])
+		self.assertEqual(manifest.getRevisions(), {"10": 2, "20": 2, "30": 2})
+		self.assertEqual(manifest.getRevision(30), latest.pk)
+		self.assertEqual(list(manifest.patch([ruleSet.pk], [30]).sids), [10, 20, 30])
+
+class ParallelMapTest(TestCase):
+	
+	def test_parallelMap(self):
+		self.assertEqual(parallelMap(lambda x: x * 2, range(50), 7), [x * 2 for x in range(50)])
+		self.assertEqual(parallelMap(lambda x: x, [], 7), [])
+		self.assertRaises(ZeroDivisionError, parallelMap, lambda x: 1 / x, [1, 0, 2], 2)
+
+class SyncJobTest(TestCase):
+	
+	def test_syncJob(self):
+		sensor = Sensor.objects.create(name="Sensor", ipAddress="127.0.0.1")
+		job = SyncJob.create([sensor])
+		
+		loaded = SyncJob.load(job.id)
+		self.assertEqual(loaded.getSummary(), {SyncJob.PENDING: 1, SyncJob.OK: 0, SyncJob.FAILED: 0})
+		self.assertEqual(loaded.state["sensors"][str(sensor.pk)]["name"], "Sensor")
+		self.assertEqual(SyncJob.load("../" + job.id), None)
+		os.remove(job.getStateFile())
+	
+	def test_crashedSyncJob(self):
+		sensor = Sensor.objects.create(name="Sensor", ipAddress="127.0.0.1")
+		job = SyncJob.create([sensor])
+		
+		def crash():
+			raise RuntimeError("Crashed")
+		job.syncSensors = crash
+		self.assertRaises(RuntimeError, job.run)
+		
+		loaded = SyncJob.load(job.id)
+		self.assertTrue(loaded.state["finished"] != None)
+		self.assertEqual(loaded.getSummary(), {SyncJob.PENDING: 0, SyncJob.OK: 0, SyncJob.FAILED: 1})
+		os.remove(job.getStateFile())
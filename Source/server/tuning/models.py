@@ -1,6 +1,6 @@
 from django.db import models
 
-from core.models import Rule, Sensor, Comment
+from core.models import Change, Rule, Sensor, Comment
 
 class Suppress(models.Model):
 	"""The suppress lets us suppress warnings from a specific rule on a
@@ -123,3 +123,26 @@ class EventFilter(models.Model):
 
 		return "event_filter gen_id 1, sig_id %d, type %s, track %s, count %d, seconds %d" % (self.rule.SID, EventFilter.TYPE[self.eventFilterType], track, self.count, self.seconds)
 
+def tuningChanged(sender, instance, **kwargs):
+	"""Records a change of the tuning of the sensor, when a filter or suppress is saved or deleted."""
+	Change.record(Change.TUNING, sensor=instance.sensor_id)
+
+def suppressAddressesChanged(sender, instance, action, reverse, pk_set, **kwargs):
+	"""Records a change of the tuning of the sensors, when addresses are added to or removed from
+	their suppresses."""
+	if(action not in ["post_add", "post_remove", "pre_clear"]):
+		return
+	
+	if(reverse):
+		sensors = [instance.sensor_id]
+	elif(action == "pre_clear"):
+		sensors = instance.suppress.values_list("sensor", flat=True)
+	else:
+		sensors = Suppress.objects.filter(pk__in=pk_set).values_list("sensor", flat=True)
+	for sensor in set(sensors):
+		Change.record(Change.TUNING, sensor=sensor)
+
+for model in [Suppress, DetectionFilter, EventFilter]:
+	models.signals.post_save.connect(tuningChanged, sender=model)
+	models.signals.post_delete.connect(tuningChanged, sender=model)
+models.signals.m2m_changed.connect(suppressAddressesChanged, sender=SuppressAddress.suppress.through)
@@ -2,46 +2,66 @@
 
 from core.models import Sensor, Rule
 from tuning.models import DetectionFilter, EventFilter, Suppress, SuppressAddress
+from util.tools import chunks
+
+def getSensorChain(sensor):
+	"""Returns a list of the primary-keys of sensor and its parents, starting with sensor and 
+	ending with the top of the hierarchy."""
+	parents = dict(Sensor.objects.values_list("pk", "parent"))
+	chain = []
+	s = sensor.pk
+	while s != None and s not in chain:
+		chain.append(s)
+		s = parents.get(s)
+	return chain
+
+def resolveTuning(sensor, rules, chunkSize = 500):
+	"""Finds the detection-filters, event-filters and suppresses which is in effect for the 
+	rules in rules (Rule objects or primary-keys) on sensor. A filter on the sensor itself 
+	wins over a filter on its parent, which wins over a filter on the parent's parent and so 
+	on. The filters is fetched with one query per type and chunk of rules, with the rule (and
+	for the suppresses, the addresses) already loaded.
+	
+	Returns a tuple (detectionFilters, eventFilters, suppresses) of dictionaries, keyed by the
+	primary-key of the rule. Rules without a filter of a type is not in that dictionary."""
+	
+	chain = getSensorChain(sensor)
+	rank = dict([(s, i) for i, s in enumerate(chain)])
+	ruleIDs = [getattr(r, "pk", r) for r in rules]
+	
+	result = []
+	for model in [DetectionFilter, EventFilter, Suppress]:
+		found = {}
+		for chunk in chunks(ruleIDs, chunkSize):
+			objects = model.objects.filter(sensor__in=chain, rule__in=chunk).select_related("rule").order_by("pk")
+			if(model == Suppress):
+				objects = objects.prefetch_related("addresses")
+			for o in objects:
+				if(o.rule_id not in found or rank[o.sensor_id] < rank[found[o.rule_id].sensor_id]):
+					found[o.rule_id] = o
+		result.append(found)
+	
+	return tuple(result)
 
 def getEventFilter(sensor, rule):
-	s = sensor
-	while s != None:
-		try:
-			ef = s.eventFilters.get(rule=rule)
-			return ef
-		except EventFilter.DoesNotExist:
-			s = s.parent
-	return False
+	return resolveTuning(sensor, [rule])[1].get(rule.pk, False)
 
 def getDetectionFilter(sensor, rule):
-	s = sensor
-	while s != None:
-		try:
-			df = s.detectionFilters.get(rule=rule)
-			return df
-		except DetectionFilter.DoesNotExist:
-			s = s.parent
-	return False
+	return resolveTuning(sensor, [rule])[0].get(rule.pk, False)
 
 def getSuppress(sensor, rule):
-	s = sensor
-	while s != None:
-		try:
-			sup = s.suppress.get(rule=rule)
-			return sup
-		except Suppress.DoesNotExist:
-			s = s.parent
-	return False
+	return resolveTuning(sensor, [rule])[2].get(rule.pk, False)
 
 def generateFilterConfig(rules, sensor, filters, suppresses):
 	"""Generates filter-configurations for the list of rules supplied"""
-	for sid in rules:
-		rule = rules[sid][0]
-
+	ruleList = [rules[sid][0] for sid in rules]
+	detectionFilters, eventFilters, suppressList = resolveTuning(sensor, ruleList)
+	
+	for rule in ruleList:
 		# If filters exist, add them to the appropiate files
-		eventFilter = getEventFilter(sensor, rule)
-		#detectionFilter = getDetectionFilter(sensor, rule)
-		suppress = getSuppress(sensor, rule)
+		eventFilter = eventFilters.get(rule.pk)
+		#detectionFilter = detectionFilters.get(rule.pk)
+		suppress = suppressList.get(rule.pk)
 		
 		if eventFilter:
 			filters.addLine(eventFilter.getConfigLine())
@@ -12,4 +12,10 @@ class AbnormalRuleError(Exception):
     a gid-attribute which normal rules do not contain."""
     
     def __init__(self):
-        Exception.__init__(self, "Abnormal rule encountered")        
\ No newline at end of file
+        Exception.__init__(self, "Abnormal rule encountered")        
+class LockError(Exception):
+    """Exception thrown if an update-lock could not be taken, or is lost while
+    the update is still running."""
+    
+    def __init__(self, message):
+        Exception.__init__(self, message)
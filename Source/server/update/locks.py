@@ -0,0 +1,185 @@
+#!/usr/bin/python
+"""
+update.locks
+
+The locks used to coordinate concurrent updates:
+
+ - SourceLock makes sure that only one update is running for each Source. The lock is taken
+   with a single conditional UPDATE of the source-row, and is kept alive by a heartbeat. A lock
+   which is not refreshed within [update] lockTimeout seconds is considered left behind by a
+   crashed update, and is taken over by the next update.
+
+ - ApplyLock serializes the phase where an update is written to the database, so that updates
+   from several sources can be parsed at the same time, while they are saved one at the time.
+   It uses the advisory locks of MySQL and PostgreSQL, and a lock-file for other backends. All
+   of them are released automatically if the update-process dies.
+"""
+
+import datetime
+import fcntl
+import logging
+import os
+import socket
+import threading
+import zlib
+
+from django.db import connection
+from django.db.models import Q
+from django.utils.timezone import utc
+
+from update.exceptions import LockError
+from update.models import Source
+from util.config import Config
+
+class SourceLock(object):
+	"""The update-lock of a single Source.
+
+	If the heartbeat finds that the lock is taken over by another update, the lock is marked as
+	lost. The updater calls refresh() (through refreshHeld) inside the transaction saving the
+	update, so a lost lock aborts the save instead of letting two updates write the same source."""
+
+	# The locks held by this process, keyed by the pk of the source.
+	held = {}
+
+	def __init__(self, source):
+		self.source = source
+		self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+		self.heartbeatInterval = int(Config.get("update", "lockHeartbeat"))
+		self.timeout = int(Config.get("update", "lockTimeout"))
+
+		self.thread = None
+		self.stopped = threading.Event()
+		self.lost = False
+
+	def acquire(self):
+		"""Tries to take the lock. Returns True if the lock is taken, and False if another update
+		holds it. A stale lock is taken over."""
+		logger = logging.getLogger(__name__)
+
+		now = datetime.datetime.utcnow().replace(tzinfo=utc)
+		stale = now - datetime.timedelta(seconds=self.timeout)
+
+		# The lock is free if it is not locked, or if the holder have stopped refreshing it. (Locks
+		#   without a heartbeat is left by older versions of snowman, and is always stale).
+		free = Q(locked=False) | Q(lockHeartbeat=None) | Q(lockHeartbeat__lt=stale)
+		previous = Source.objects.filter(pk=self.source.pk).values_list("locked", "lockOwner").get()
+		if(Source.objects.filter(free, pk=self.source.pk).update(locked=True, lockOwner=self.owner, lockHeartbeat=now) != 1):
+			return False
+
+		if(previous[0]):
+			logger.warning("Took over the stale update-lock of %s, held by %s" % (self.source.name, previous[1]))
+
+		self.source.locked = True
+		self.source.lockOwner = self.owner
+		self.source.lockHeartbeat = now
+		self.lost = False
+		SourceLock.held[self.source.pk] = self
+
+		self.stopped.clear()
+		self.thread = threading.Thread(target=self.heartbeat, name="lock-heartbeat")
+		self.thread.daemon = True
+		self.thread.start()
+		return True
+
+	def release(self):
+		"""Releases the lock, if it is still held by this process."""
+		if(self.thread != None):
+			self.stopped.set()
+			self.thread.join()
+			self.thread = None
+
+		if(SourceLock.held.get(self.source.pk) is self):
+			del SourceLock.held[self.source.pk]
+		Source.objects.filter(pk=self.source.pk, lockOwner=self.owner).update(locked=False, lockOwner=None, lockHeartbeat=None)
+		self.source.locked = False
+		self.source.lockOwner = None
+		self.source.lockHeartbeat = None
+
+	def refresh(self):
+		"""Refreshes the lock on the connection of the caller, and raises LockError if the lock
+		is lost. Called inside a transaction, the updated source-row stays locked until the
+		transaction is committed, so the lock cannot be taken over while it is saved."""
+		if(not self.lost):
+			now = datetime.datetime.utcnow().replace(tzinfo=utc)
+			if(Source.objects.filter(pk=self.source.pk, lockOwner=self.owner).update(lockHeartbeat=now) != 1):
+				self.lost = True
+
+		if(self.lost):
+			raise LockError("The update-lock of %s is taken over by another update" % self.source.name)
+
+	@staticmethod
+	def refreshHeld(source):
+		"""Refreshes the lock of the source, if it is held by this process. Raises LockError if
+		the lock is lost."""
+		lock = SourceLock.held.get(source.pk)
+		if(lock != None):
+			lock.refresh()
+
+	def heartbeat(self):
+		"""Refreshes the lock every heartbeatInterval seconds, until the lock is released. The
+		thread uses its own database-connection, so the heartbeat is committed even if the
+		update is in the middle of a transaction."""
+		logger = logging.getLogger(__name__)
+
+		try:
+			while not self.stopped.wait(self.heartbeatInterval):
+				try:
+					refreshed = Source.objects.filter(pk=self.source.pk, lockOwner=self.owner).update(lockHeartbeat=datetime.datetime.utcnow().replace(tzinfo=utc))
+				except Exception as e:
+					logger.warning("Could not refresh the update-lock of %s: %s" % (self.source.name, str(e)))
+					continue
+
+				if(refreshed == 0):
+					logger.error("The update-lock of %s is taken over by another update" % self.source.name)
+					self.lost = True
+					return
+		finally:
+			connection.close()
+
+class ApplyLock(object):
+	"""A lock serializing the database-work of the updates. Used as a context-manager:
+
+		with ApplyLock():
+			...save the update...
+	"""
+
+	name = "snowman-update-apply"
+
+	def __init__(self):
+		self.lockFile = None
+
+	def __enter__(self):
+		logger = logging.getLogger(__name__)
+		logger.debug("Waiting for the apply-lock")
+
+		if(connection.vendor == "mysql"):
+			# GET_LOCK waits at most the given number of seconds, so wait a year.
+			cursor = connection.cursor()
+			cursor.execute("SELECT GET_LOCK(%s, %s)", [self.name, 31536000])
+			row = cursor.fetchone()
+			if(row == None or row[0] != 1):
+				raise LockError("Could not take the apply-lock (GET_LOCK returned %s)" % (row[0] if row else None))
+		elif(connection.vendor == "postgresql"):
+			cursor = connection.cursor()
+			cursor.execute("SELECT pg_advisory_lock(%s)", [zlib.crc32(self.name)])
+		else:
+			filename = Config.get("storage", "applyLockFile")
+			directory = os.path.dirname(filename)
+			if(not os.path.isdir(directory)):
+				os.makedirs(directory)
+			self.lockFile = open(filename, "a")
+			fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+
+		logger.debug("Got the apply-lock")
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		if(connection.vendor == "mysql"):
+			connection.cursor().execute("SELECT RELEASE_LOCK(%s)", [self.name])
+		elif(connection.vendor == "postgresql"):
+			connection.cursor().execute("SELECT pg_advisory_unlock(%s)", [zlib.crc32(self.name)])
+		else:
+			fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+			self.lockFile.close()
+			self.lockFile = None
+		return False
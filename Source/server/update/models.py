@@ -4,6 +4,7 @@ import os
 import re
 
 from django.db import models, IntegrityError
+from django.utils.timezone import utc
 
 from core.models import Generator, Rule, RuleSet, RuleRevision, RuleClass,\
 	RuleReferenceType, Sensor, Comment
@@ -56,12 +57,24 @@ class Source(models.Model):
 	schedule = models.CharField(max_length=40, default="No automatic updates")
 	locked = models.BooleanField(default = False)
 	
+	# The update holding the lock (hostname:pid), and the last time it refreshed the lock. (See update.locks).
+	lockOwner = models.CharField(max_length=80, null=True)
+	lockHeartbeat = models.DateTimeField(null=True)
+	
 	def __repr__(self):
 		return "<Source name:%s, schedule:%s, url:%s, md5url:%s, lastMd5:%s>" % (self.name, str(self.schedule), self.url, self.md5url, self.lastMd5)
 	
 	def __str__(self):
 		return "<Source name:%s, schedule:%s, url:%s>" % (self.name, str(self.schedule), self.url)
 	
+	def isLocked(self):
+		"""Returns True if an update is running for this source. A lock which is not refreshed
+		within the lockTimeout is left by a crashed update, and is not counted."""
+		if(not self.locked or self.lockHeartbeat == None):
+			return False
+		timeout = datetime.timedelta(seconds=int(Config.get("update", "lockTimeout")))
+		return self.lockHeartbeat >= datetime.datetime.utcnow().replace(tzinfo=utc) - timeout
+	
 	def setSchedule(self, data, save = True):
 		"""Sets the schedule-string based on the content of a TimeSelectorForm."""
 		if(data['newSourceForm'].cleaned_data['schedule'] == 'n'):
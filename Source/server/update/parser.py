@@ -1,17 +1,82 @@
-import re, logging
+import collections
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import re
+from cStringIO import StringIO
 from os import path
-from update.models import UpdateFile
+
+from django.db import connection
+
 from update.exceptions import AbnormalRuleError, BadFormatError
-from util.tools import md5sum, Replace
+from util.tools import md5sum
 from util.patterns import ConfigPatterns
+from util.ruletokenizer import tokenizeRule
 from updater import Updater
 
+def readLines(infile):
+	"""Iterates over the lines of infile, and yields (linenumber, line) tuples. Lines ending
+	with a backslash are concatenated with the following line."""
+	
+	previous = ""
+	for i,line in enumerate(infile):
+		
+		# Concatinate the current line with the previous
+		line = previous + line
+		previous = ""
+		
+		# If the line is incomplete, store what we have, and read next line.
+		if(re.match(r"(.*)\\$",line)):
+			previous = line.rstrip("\\\n")
+		else:
+			yield i, line
+
+def tokenizeRuleFile(filePathTuple):
+	"""Tokenizes all the rules in a rule file, and returns them as a list of ParsedRule objects.
+	This function is used by the worker processes in Parser.parseRuleFiles, and does therefore
+	not touch the database."""
+	
+	logger = logging.getLogger(__name__)
+	absoluteFilepath = filePathTuple[0]
+	rules = []
+	
+	try:
+		infile = open(absoluteFilepath, "r")
+	except IOError:
+		logger.info("File '%s' not found, nothing to parse." % absoluteFilepath)
+		return rules
+	
+	for i,line in readLines(infile):
+		try:
+			rule = tokenizeRule(line)
+		except AbnormalRuleError:
+			logger.info("Skipping abnormal rule in '%s'" % absoluteFilepath)
+		except BadFormatError, e:
+			logger.error("%s in file '%s', around line %s." % (str(e), absoluteFilepath, str(i)))
+		else:
+			if rule:
+				rules.append(rule)
+	infile.close()
+	
+	return rules
+
 class Parser:
-	def __init__(self, update):
+	def __init__(self, update, dryRun = False):
 		self.update = update
-		self.updater = Updater(update)
+		self.dryRun = dryRun
+		
+		# A dry-run keeps everything in memory, as nothing can be saved in chunks.
+		if dryRun:
+			self.updater = Updater(update, streamSize=0)
+		else:
+			self.updater = Updater(update)
 	
 	def save(self):
+		"""Saves everything that is parsed. In a dry-run, nothing is saved, and the change-plan
+		of the update is returned instead."""
+		if self.dryRun:
+			return self.updater.getChangePlan()
 		self.updater.saveAll()
 	
 	def parseRuleFile(self, paths):
@@ -71,124 +136,56 @@ class Parser:
 
 		self.parseFile(self.updateFilter, paths)()
 		
-	def parseConfigFile(self, path, storeHash=True, **kwargs):
+	def parseConfigFile(self, paths, storeHash=True, **kwargs):
 		"""Method to parse an ASCII file with undefined content.
 		Each line of file is sent to updateConfig, which tries to identify
 		the content by matching the line to regex patterns defined in patterns-list."""
 		
-		# Compile the re-patterns
+		filename = path.basename(paths[0])
+		self.parseFile(self.updateConfig, paths, storeHash, filename=filename, patterns=self.getConfigPatterns(), **kwargs)()		
+	
+	def getConfigPatterns(self):
+		"""Compiles the re-patterns used by updateConfig to identify the content of a line."""
 		patterns = {}
-		patterns['rule'] = re.compile(ConfigPatterns.RULE)
 		patterns['reference'] = re.compile(ConfigPatterns.REFERENCE)
 		patterns['class'] = re.compile(ConfigPatterns.CLASS)
 		patterns['genmsg'] = re.compile(ConfigPatterns.GENMSG)
 		patterns['sidmsg'] = re.compile(ConfigPatterns.SIDMSG)
 		patterns['filter'] = re.compile(ConfigPatterns.EVENT_FILTER)
-		
-		filename = path.basename(path[0])
-		self.parseFile(self.updateConfig, path, storeHash, filename=filename, patterns=patterns, **kwargs)()		
+		return patterns
 			
-	def updateRule(self, raw, filename):
-		"""This method takes a raw rulestring, parses it, and sends each valid rule to the updater."""
+	def updateRule(self, raw, filename, rule = None):
+		"""This method takes a raw rulestring, tokenizes it, and sends each valid rule to the updater.
+		If the rulestring is already tokenized, the ParsedRule can be supplied as rule."""
 		
 		logger = logging.getLogger(__name__)
 		
-		try:
-			# Snowman is currently only handling rules with GID=1.
-			# If we find a GID element with a value other than 1, we are parsing the wrong file.
-			ruleGID = int(re.match(ConfigPatterns.GID, raw).group(1))
-			if ruleGID != 1:
-				raise AbnormalRuleError
-		except AttributeError:
-			# If no GID element is found, GID is 1.
-			ruleGID = 1
-		except ValueError:
-			raise BadFormatError("Bad rule in file '"+filename+"': GID is not numeric! Rulestring: "+raw)
-		
-		# Construct a regex to match all elements a raw rulestring 
-		# must have in order to be considered a valid rule
-		# (sid, rev, message and classtype):
-		matchPattern = ConfigPatterns.RULE
-		pattern = re.compile(matchPattern)
-		
-		# Match optional options:
-		ruleset = re.match(ConfigPatterns.RULESET, raw)
-		priority = re.match(ConfigPatterns.PRIORITY, raw)
-		references = re.findall(ConfigPatterns.RULEREFERENCE, raw)
-		eventFilter = re.match(ConfigPatterns.THRESHOLD, raw)
-		detectionFilter = re.match(ConfigPatterns.DETECTION_FILTER, raw)
-				
-		# If the raw rule matched the regex: 
-		result = pattern.match(raw)
-		if(result):
-			
-			# Assign some helpful variable-names:
-			if("#" in result.group(1)):
-				raw = raw.lstrip("# ")
-				ruleActive = False
-			else:
-				ruleActive = True
-			
-			try:	
-				ruleSID = int(result.group(2))
-				ruleRev = int(result.group(3))
-			except ValueError:
-				raise BadFormatError("Bad rule in '"+filename+"': SID or rev is not numeric! Rulestring: "+raw)
-						
-			ruleMessage = result.group(4)
-			ruleClassName = result.group(5)
-				
-			# Ruleset name set to filename if not found in raw string:
-			try:
-				rulesetName = ruleset.group(1)
-			except AttributeError:
-				rulesetName = re.sub('\.rules$', '', filename)
-				
-			if priority:
-				try:
-					rulePriority = int(priority.group(0))
-				except ValueError:
-					raise BadFormatError("Bad rule in '"+filename+"': priority is not numeric! Rulestring: "+raw)
-			else:
-				rulePriority = None
-				
-			# Remove filters from raw string before storage:
-			replace = Replace("")			
-			filters = ""
-			
-			raw = re.sub(r'detection_filter:.*?;', replace, raw)
-			filters += replace.matched or ""
-			raw = re.sub(r'threshold:.*?;', replace, raw)
-			filters += replace.matched or ""
+		# Split the rulestring into its header and options in one pass. Rules with a GID
+		# other than 1 raises AbnormalRuleError, and strings not containing a valid rule
+		# (sid, rev, message and classtype) returns None.
+		if rule == None:
+			rule = tokenizeRule(raw)
+			if rule == None:
+				return
+		
+		# Ruleset name set to filename if not found in raw string:
+		rulesetName = rule.ruleset or re.sub('\.rules$', '', filename)
 			
-			raw = " ".join(raw.split())			
-				
-			self.updater.addRuleSet(rulesetName)
-			self.updater.addRule(ruleSID, ruleRev, raw, ruleMessage, ruleActive, rulesetName, ruleClassName, rulePriority, ruleGID)	
+		self.updater.addRuleSet(rulesetName)
+		self.updater.addRule(rule.sid, rule.rev, rule.raw, rule.msg, rule.active, rulesetName, rule.classtype, rule.priority, rule.gid)	
 
-			if detectionFilter:
-				dfTrack = detectionFilter.group(1)
-				dfCount = int(detectionFilter.group(2))
-				dfSeconds = int(detectionFilter.group(3))
-				self.checkFilter(ruleGID, ruleSID, dfTrack, dfCount, dfSeconds)
-				self.updater.addFilter(ruleSID, dfTrack, dfCount, dfSeconds)
+		if rule.detectionFilter:
+			dfTrack, dfCount, dfSeconds = rule.detectionFilter
+			self.checkFilter(rule.gid, rule.sid, dfTrack, dfCount, dfSeconds)
+			self.updater.addFilter(rule.sid, dfTrack, int(dfCount), int(dfSeconds))
 
-			if eventFilter:
-				efType = eventFilter.group(1)
-				efTrack = eventFilter.group(2)
-				efCount = int(eventFilter.group(3))
-				efSeconds = int(eventFilter.group(4))
-				self.checkFilter(ruleGID, ruleSID, efTrack, efCount, efSeconds, efType)
-				self.updater.addFilter(ruleSID, efTrack, efCount, efSeconds, efType)
-				
-			if references:
-				for reference in references:
-					try:
-						referenceTypeName = reference[0]
-						referenceData = reference[1]
-						self.updater.addReference(referenceTypeName, referenceData, ruleSID)
-					except IndexError:
-						logger.warning("Skipping badly formatted reference for rule sid="+ruleSID+" in file '"+filename+"': "+str(reference))
+		if rule.eventFilter:
+			efType, efTrack, efCount, efSeconds = rule.eventFilter
+			self.checkFilter(rule.gid, rule.sid, efTrack, efCount, efSeconds, efType)
+			self.updater.addFilter(rule.sid, efTrack, int(efCount), int(efSeconds), efType)
+			
+		for referenceTypeName, referenceData in rule.references:
+			self.updater.addReference(referenceTypeName, referenceData, rule.sid, inRule=True)
 							
 	def updateClassification(self, raw):
 		"""Method for parsing classification strings.
@@ -341,56 +338,134 @@ class Parser:
 			logger = logging.getLogger(__name__)
 			logger.info("Parsing file "+absoluteFilepath+".")
 
-			if storeHash:
-				try:
-					ruleFile = self.update.source.files.get(name=relativeFilePath)
-				except UpdateFile.DoesNotExist:
-					ruleFile = self.update.source.files.create(name=relativeFilePath, isParsed=False)
-				oldHash = ruleFile.checksum
-				newHash = md5sum(absoluteFilepath)
-	
-			if not storeHash or (oldHash != newHash):
+			if not storeHash or self.checkHash(filePathTuple):
 				try:
 					infile = open(absoluteFilepath, "r")
 				except IOError:
 					logger.info("File '%s' not found, nothing to parse." % absoluteFilepath)
 					return
 				
-				if storeHash:	
-					ruleFile.isParsed = True
-					ruleFile.checksum = newHash
-					ruleFile.save()
-					
-				it = iter(enumerate(infile))
-				previous = ""
-				for i,line in it:
-					
-					# Concatinate the current line with the previous
-					line = previous + line
-					previous = ""
-					
-					# If the line is incomplete, store what we have, and read next line.
-					if(re.match(r"(.*)\\$",line)):
-						previous = line.rstrip("\\\n")
-					else:
-						try:				
-							fn(raw=line, **kwargs)
-						except AbnormalRuleError:
-							logger.info("Skipping abnormal rule in '%s'" % absoluteFilepath)
-						except BadFormatError, e:
-							# Log exception message, file name and line number
-							logger.error("%s in file '%s', around line %s." % (str(e), absoluteFilepath, str(i)))							
-			else :
-				logger.info("Skipping file '%s', new and old hashes are identical." % absoluteFilepath)
+				self.parseLines(fn, infile, absoluteFilepath, **kwargs)
+				infile.close()
 		return parse
+	
+	def parseData(self, fn, relativeFilePath, data, storeHash=True, **kwargs):
+		"""Method for parsing a file which is already read into memory, like a member
+		of an update-archive. The checksum is calculated from the data, so the file
+		is never written to, or read from, the disk. Every line is sent to the function
+		defined by fn."""
+		
+		logger = logging.getLogger(__name__)
+		logger.info("Parsing file "+relativeFilePath+".")
+		
+		if not storeHash or self.checkHash((relativeFilePath, relativeFilePath), hashlib.md5(data).hexdigest()):
+			self.parseLines(fn, StringIO(data), relativeFilePath, **kwargs)
+	
+	def parseLines(self, fn, infile, filePath, **kwargs):
+		"""Sends every line of the file-object infile to the function fn. Errors in single lines
+		are logged, and the parsing continues with the next line."""
+		
+		logger = logging.getLogger(__name__)
+		for i,line in readLines(infile):
+			try:				
+				fn(raw=line, **kwargs)
+			except AbnormalRuleError:
+				logger.info("Skipping abnormal rule in '%s'" % filePath)
+			except BadFormatError, e:
+				# Log exception message, file name and line number
+				logger.error("%s in file '%s', around line %s." % (str(e), filePath, str(i)))
+	
+	def checkHash(self, filePathTuple, newHash = None):
+		"""Compares the md5sum of the file with the checksum stored for the last update from
+		this source. If the file is changed, the new checksum is handed to the updater (which
+		stores it together with the update), and True is returned. If the file is unchanged,
+		False is returned.
+		
+		If the checksum is already calculated, it can be supplied as newHash. In a dry-run, the
+		checksum is compared, but never stored."""
+		
+		logger = logging.getLogger(__name__)
+		absoluteFilepath, relativeFilePath = filePathTuple
+		
+		newHash = newHash or md5sum(absoluteFilepath)
+		if(self.update.source.files.filter(name=relativeFilePath, checksum=newHash).exists()):
+			logger.info("Skipping file '%s', new and old hashes are identical." % absoluteFilepath)
+			return False
+		
+		if not self.dryRun:
+			self.updater.addFile(relativeFilePath, newHash)
+		return True
+	
+	def parseRuleFiles(self, paths, workers = 1, progress = None):
+		"""Parses a list of rule files, in the order they are listed. 
+		
+		If workers is more than 1 (or 0, meaning one per CPU), the files are tokenized in a pool of
+		worker processes. The workers only return the parsed rules, which are handed to the updater
+		by this process in the original file-order, so that the last file still wins if a SID is
+		present in more than one file.
+		
+		progress is an optional function which is called with the path-tuple of each file before
+		its rules are handed to the updater."""
+		
+		logger = logging.getLogger(__name__)
+		
+		if(workers == 1 or len(paths) <= 1):
+			for filePathTuple in paths:
+				if progress:
+					progress(filePathTuple)
+				self.parseRuleFile(filePathTuple)
+			return
+		
+		# The checksums are compared here, as the workers should not touch the database.
+		changed = []
+		for filePathTuple in paths:
+			logger.info("Parsing file "+filePathTuple[0]+".")
+			if self.checkHash(filePathTuple):
+				changed.append(filePathTuple)
+		
+		# Close the database-connection, so that it is not shared with the forked workers.
+		# Django reopens it the next time it is needed.
+		connection.close()
+		
+		# Only a bounded window of files is handed to the pool, so that the parsed rules waiting
+		#   for the updater is limited to about one file per worker, however many files there
+		#   are. (Pool.imap reads ahead without limit.)
+		workers = workers or multiprocessing.cpu_count()
+		pool = multiprocessing.Pool(workers)
+		files = iter(changed)
+		pending = collections.deque()
+		try:
+			for filePathTuple in itertools.islice(files, workers + 1):
+				pending.append((filePathTuple, pool.apply_async(tokenizeRuleFile, (filePathTuple,))))
+			
+			while pending:
+				filePathTuple, result = pending.popleft()
+				rules = result.get()
+				for nextFile in itertools.islice(files, 1):
+					pending.append((nextFile, pool.apply_async(tokenizeRuleFile, (nextFile,))))
+				
+				if progress:
+					progress(filePathTuple)
+				
+				filename = path.basename(filePathTuple[0])
+				for rule in rules:
+					try:
+						self.updateRule(None, filename, rule)
+					except BadFormatError, e:
+						logger.error("%s in file '%s'." % (str(e), filePathTuple[0]))
+				rules = None
+		finally:
+			pool.close()
+			pool.join()
 
 	def updateConfig(self, raw, filename, patterns):
 		"""Method to parse an ASCII configuration-file for snort, with undefined content."""
 		logger = logging.getLogger(__name__)
 
-		if patterns['rule'].match(raw):
+		rule = tokenizeRule(raw)
+		if rule:
 			logger.debug("Identified rule: %s" % raw)
-			self.updateRule(raw, filename)
+			self.updateRule(raw, filename, rule)
 		elif patterns['reference'].match(raw):
 			logger.debug("Identified reference: %s" % raw)
 			self.updateReferenceConfig(raw)
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+"""
+update.persistence
+
+Bulk write-operations used by the Updater. The objects are written with the native
+upsert-statement of the database backend (INSERT ... ON DUPLICATE KEY UPDATE on MySQL,
+INSERT ... ON CONFLICT on PostgreSQL and SQLite), so that a set of new and changed
+objects can be stored in a few statements, instead of one statement per object.
+
+Backends without upsert-support falls back to updating/creating one object at a time.
+
+The upsert-statements does not return the primary keys of the rows. bulkSave looks the
+existing rows up before the upsert, and reads back only the primary keys of the rows it
+inserted.
+"""
+
+import operator
+
+from django.db import connection
+from django.db.models import Q
+
+# SQLite does not accept more than 999 parametres in a single statement.
+MAXPARAMETRES = 999
+
+def getColumns(model, includePk):
+	"""Returns the concrete fields of model, which should be part of an insert."""
+	fields = []
+	for field in model._meta.local_concrete_fields:
+		if(field.primary_key and not includePk):
+			continue
+		fields.append(field)
+	return fields
+
+def createUpsertStatement(model, fields, keyFields, updateFields, rows):
+	"""Creates an upsert-statement for the current database-backend, inserting rows rows.
+	Returns None if the backend does not support upserts."""
+
+	quote = connection.ops.quote_name
+	table = quote(model._meta.db_table)
+	columns = ", ".join([quote(f.column) for f in fields])
+	values = ", ".join(["(%s)" % ", ".join(["%s"] * len(fields))] * rows)
+	insert = "INSERT INTO %s (%s) VALUES %s" % (table, columns, values)
+
+	updateColumns = [quote(model._meta.get_field(f).column) for f in updateFields]
+	keyColumns = [quote(model._meta.get_field(f).column) for f in keyFields]
+
+	if(connection.vendor == "mysql"):
+		if(updateColumns):
+			update = ", ".join(["%s = VALUES(%s)" % (c, c) for c in updateColumns])
+		else:
+			update = "%s = %s" % (keyColumns[0], keyColumns[0])
+		return "%s ON DUPLICATE KEY UPDATE %s" % (insert, update)
+
+	elif(connection.vendor in ["postgresql", "sqlite"]):
+		if(updateColumns):
+			update = "DO UPDATE SET " + ", ".join(["%s = excluded.%s" % (c, c) for c in updateColumns])
+		else:
+			update = "DO NOTHING"
+		return "%s ON CONFLICT (%s) %s" % (insert, ", ".join(keyColumns), update)
+
+	return None
+
+def bulkUpsert(model, objects, keyFields, updateFields, chunkSize = 500):
+	"""Inserts the model-objects in objects to the database. If an object collides with an
+	existing row on the unique key keyFields, the fields in updateFields is updated instead
+	(or nothing is done, if updateFields is empty).
+
+	The primary keys of the inserted objects are NOT set on the objects."""
+
+	objects = list(objects)
+	if(len(objects) == 0):
+		return
+
+	includePk = (model._meta.pk.name in keyFields)
+	fields = getColumns(model, includePk)
+
+	# Fall back to one object at a time if the backend have no upsert-statement.
+	if(createUpsertStatement(model, fields, keyFields, updateFields, 1) == None):
+		for o in objects:
+			keys = dict([(f, getattr(o, model._meta.get_field(f).attname)) for f in keyFields])
+			updates = dict([(f, getattr(o, model._meta.get_field(f).attname)) for f in updateFields])
+			if(model.objects.filter(**keys).exists()):
+				if(updates):
+					model.objects.filter(**keys).update(**updates)
+			else:
+				o.save(force_insert=True)
+		return
+
+	rows = max(1, min(chunkSize, MAXPARAMETRES // len(fields)))
+	cursor = connection.cursor()
+	for start in range(0, len(objects), rows):
+		chunk = objects[start:start + rows]
+		parametres = []
+		for o in chunk:
+			for f in fields:
+				parametres.append(f.get_db_prep_save(f.pre_save(o, True), connection=connection))
+		cursor.execute(createUpsertStatement(model, fields, keyFields, updateFields, len(chunk)), parametres)
+
+def bulkUpdate(model, objects, updateFields, chunkSize = 500):
+	"""Updates the fields in updateFields of the objects (which must already be stored in the
+	database), using one upsert-statement per chunk, keyed on the primary key."""
+
+	bulkUpsert(model, objects, [model._meta.pk.name], updateFields, chunkSize)
+
+def getKey(model, o, keyFields):
+	"""Returns the values of the fields in keyFields of the object o, as a tuple."""
+	return tuple([getattr(o, model._meta.get_field(f).attname) for f in keyFields])
+
+def normalize(values):
+	"""Returns the tuple values with the byte-strings decoded, so that values recieved from
+	the parser compares equal to the unicode-strings read from the database."""
+	return tuple([v.decode("utf-8", "replace") if isinstance(v, str) else v for v in values])
+
+def getExistingRows(model, keyFields, fields, keys, chunkSize = 500):
+	"""Looks up the rows of model with the keys in keys, which are tuples with the values of
+	keyFields. Returns a dictionary mapping the keys which is found to a tuple of the primary
+	key and the values of fields. Keys of several fields are matched as a whole, so that only
+	the rows asked for are read."""
+
+	keys = list(keys)
+	result = {}
+	rows = max(1, min(chunkSize, MAXPARAMETRES // len(keyFields)))
+	for start in range(0, len(keys), rows):
+		chunk = dict([(normalize(k), k) for k in keys[start:start + rows]])
+		if(len(keyFields) == 1):
+			query = Q(**{"%s__in" % keyFields[0]: [k[0] for k in chunk.itervalues()]})
+		else:
+			query = reduce(operator.or_, [Q(**dict(zip(keyFields, k))) for k in chunk.itervalues()])
+		for values in model.objects.filter(query).values_list(model._meta.pk.name, *(list(keyFields) + list(fields))):
+			key = chunk.get(normalize(values[1:len(keyFields) + 1]))
+			if(key != None):
+				result[key] = (values[0],) + tuple(values[len(keyFields) + 1:])
+	return result
+
+def bulkSave(model, objects, keyFields, updateFields, chunkSize = 500):
+	"""Saves the objects like bulkUpsert, and sets the primary key of every object. The existing
+	rows are looked up first: Objects where none of updateFields differ from the row is not
+	written, and only the primary keys of the inserted rows is read back after the upsert."""
+
+	objects = dict([(getKey(model, o, keyFields), o) for o in objects])
+	if(len(objects) == 0):
+		return
+
+	existing = getExistingRows(model, keyFields, updateFields, objects.keys(), chunkSize)
+	changed = []
+	for key, o in objects.iteritems():
+		row = existing.get(key)
+		if(row != None):
+			o.pk = row[0]
+			if(normalize(getKey(model, o, updateFields)) == normalize(row[1:])):
+				continue
+		changed.append(o)
+	bulkUpsert(model, changed, keyFields, updateFields, chunkSize)
+
+	inserted = [k for k in objects if k not in existing]
+	for key, row in getExistingRows(model, keyFields, [], inserted, chunkSize).iteritems():
+		objects[key].pk = row[0]
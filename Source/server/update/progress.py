@@ -0,0 +1,143 @@
+#!/usr/bin/python
+"""
+update.progress
+
+The progress of a running update is reported trough a ProgressReporter. Rather than writing
+an UpdateLog row for every step of the update, the reporter keeps the events in memory, and
+writes them to the database in batches. The latest progress is published to a small state-file
+(one per source), which the webinterface reads to show the status of the update.
+
+Progress-messages is given as a string on the form "<percent> <text>", as they are shown to
+the user.
+"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+from update.models import UpdateLog
+from util.config import Config
+
+class ProgressReporter(object):
+	"""Buffers the progress- and log-messages of an update. The buffer is flushed to the
+	UpdateLog when it is full, when flushInterval seconds have passed since the last flush,
+	or when the update reaches 100%. Of the progress-messages, only the latest one at the
+	time of a flush is stored in the UpdateLog."""
+
+	# The reporters of the updates running in this process, keyed by the primary-key of the update.
+	reporters = {}
+
+	# Flush the buffered messages when this many of them is waiting.
+	batchSize = 50
+
+	@classmethod
+	def forUpdate(cls, update):
+		"""Returns the reporter of the update, and creates it if needed."""
+		try:
+			return cls.reporters[update.pk]
+		except KeyError:
+			reporter = cls(update)
+			cls.reporters[update.pk] = reporter
+			return reporter
+
+	def __init__(self, update):
+		self.update = update
+		self.flushInterval = float(Config.get("update", "progressFlushInterval"))
+		self.lastFlush = time.time()
+
+		# The UpdateLog objects waiting to be written, and the latest progress which is not
+		#   yet written.
+		self.messages = []
+		self.latest = None
+
+	def progress(self, text):
+		"""Reports a progress-message ("<percent> <text>")."""
+		now = datetime.datetime.now()
+		self.latest = UpdateLog(update=self.update, time=now, logType=UpdateLog.PROGRESS, text=text)
+		self.publish(text, now)
+
+		percent, message = parseProgress(text)
+		if(percent >= 100):
+			self.flush()
+		else:
+			self.flushIfNeeded()
+
+	def message(self, text):
+		"""Adds a message to the log of the update."""
+		self.messages.append(UpdateLog(update=self.update, time=datetime.datetime.now(), logType=UpdateLog.MESSAGE, text=text))
+		self.flushIfNeeded()
+
+	def flushIfNeeded(self):
+		if(len(self.messages) >= self.batchSize or time.time() - self.lastFlush >= self.flushInterval):
+			self.flush()
+
+	def flush(self):
+		"""Writes the buffered messages, and the latest progress, to the UpdateLog."""
+		objects = self.messages
+		if(self.latest != None):
+			objects.append(self.latest)
+
+		UpdateLog.objects.bulk_create(objects)
+		self.messages = []
+		self.latest = None
+		self.lastFlush = time.time()
+
+	def close(self):
+		"""Flushes the buffers, and forgets the reporter. The state-file is kept, so that the
+		last status of the source can still be read."""
+		self.flush()
+		ProgressReporter.reporters.pop(self.update.pk, None)
+
+	def publish(self, text, now):
+		"""Writes the latest progress to the state-file of the source. The file is replaced
+		atomically, so that a reader never sees a partially written file."""
+		logger = logging.getLogger(__name__)
+
+		filename = getStateFile(self.update.source_id)
+		directory = os.path.dirname(filename)
+		try:
+			if(not os.path.isdir(directory)):
+				os.makedirs(directory)
+
+			handle, tmpname = tempfile.mkstemp(dir=directory)
+			with os.fdopen(handle, "w") as f:
+				json.dump({"update": self.update.pk, "text": text, "time": str(now)}, f)
+			os.chmod(tmpname, 0644)
+			os.rename(tmpname, filename)
+		except (IOError, OSError) as e:
+			logger.warning("Could not write the progress-file %s: %s" % (filename, str(e)))
+
+def parseProgress(text):
+	"""Splits a progress-message into (percent, text)."""
+	match = re.match(r"(\d+)\ (.*)", text)
+	if(match == None):
+		return (0, text)
+	return (int(match.group(1)), match.group(2))
+
+def getStateFile(sourceID):
+	"""Returns the path of the state-file of the source with the primary-key sourceID."""
+	return os.path.join(Config.get("storage", "progressFiles"), "source-%d.json" % sourceID)
+
+def getStatus(update):
+	"""Returns the latest progress of the update, as a dictionary with the keys progress,
+	message and time. The state-file is read if it belongs to the update, and the UpdateLog
+	is used otherwise. None is returned if no progress is reported yet."""
+
+	try:
+		with open(getStateFile(update.source_id)) as f:
+			state = json.load(f)
+		if(state["update"] == update.pk):
+			percent, message = parseProgress(state["text"])
+			return {"progress": str(percent), "message": message, "time": state["time"]}
+	except (IOError, ValueError, KeyError):
+		pass
+
+	lastLogLine = update.logEntries.filter(logType=UpdateLog.PROGRESS).last()
+	if(lastLogLine == None):
+		return None
+	percent, message = parseProgress(lastLogLine.text)
+	return {"progress": str(percent), "message": message, "time": str(lastLogLine.time)}
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+"""
+update.records
+
+Compact record-types used by the Updater to keep the recieved data in memory until it
+is saved to the database. Every record carries an explicit status (RAW, CHANGED or SAVED),
+and when the record is stored in the database, the model-object is kept in obj.
+"""
+
+# The states a record can be in.
+RAW = 0
+CHANGED = 2
+SAVED = 3
+
+class Record(object):
+	"""Base-class for the records. A record is created in the RAW state, containing the data
+	as it was recieved from the parser."""
+
+	__slots__ = ("status", "obj")
+
+	def __init__(self):
+		self.status = RAW
+		self.obj = None
+
+	def markSaved(self, obj):
+		"""Marks the record as saved, and keeps the model-object it is saved as."""
+		self.status = SAVED
+		self.obj = obj
+
+	@classmethod
+	def fromObject(cls, obj):
+		"""Creates a record in the SAVED state, for an object fetched from the database."""
+		record = cls.__new__(cls)
+		for field in cls.__slots__:
+			setattr(record, field, None)
+		record.markSaved(obj)
+		return record
+
+	def __repr__(self):
+		return "<%s status:%d, %s>" % (self.__class__.__name__, self.status,
+				", ".join(["%s:%s" % (f, str(getattr(self, f))) for f in self.__slots__]))
+
+class GeneratorRecord(Record):
+	__slots__ = ("gid", "alertID", "message")
+
+	def __init__(self, gid, alertID, message):
+		Record.__init__(self)
+		self.gid = gid
+		self.alertID = alertID
+		self.message = message
+
+class RuleRecord(Record):
+	__slots__ = ("sid", "rev", "raw", "msg", "active", "ruleset", "classtype", "priority", "gid")
+
+	def __init__(self, sid, rev, raw, msg, active, ruleset, classtype, priority, gid):
+		Record.__init__(self)
+		self.sid = sid
+		self.rev = rev
+		self.raw = raw
+		self.msg = msg
+		self.active = active
+		self.ruleset = ruleset
+		self.classtype = classtype
+		self.priority = priority
+		self.gid = gid
+
+class ClassRecord(Record):
+	__slots__ = ("classtype", "description", "priority")
+
+	def __init__(self, classtype, description, priority):
+		Record.__init__(self)
+		self.classtype = classtype
+		self.description = description
+		self.priority = priority
+
+class ReferenceTypeRecord(Record):
+	__slots__ = ("name", "urlPrefix")
+
+	def __init__(self, name, urlPrefix):
+		Record.__init__(self)
+		self.name = name
+		self.urlPrefix = urlPrefix
+
+class ReferenceRecord(Record):
+	__slots__ = ("referenceType", "reference", "sid", "inRule")
+
+	def __init__(self, referenceType, reference, sid, inRule = False):
+		Record.__init__(self)
+		self.referenceType = referenceType
+		self.reference = reference
+		self.sid = sid
+		self.inRule = inRule
+
+class RuleSetRecord(Record):
+	__slots__ = ("name",)
+
+	def __init__(self, name):
+		Record.__init__(self)
+		self.name = name
+
+class SuppressRecord(Record):
+	__slots__ = ("sid", "track", "addresses", "gid")
+
+	def __init__(self, sid, track, addresses, gid):
+		Record.__init__(self)
+		self.sid = sid
+		self.track = track
+		self.addresses = addresses
+		self.gid = gid
+
+class FilterRecord(Record):
+	"""A filter is either a detection-filter (filterType is None) or an event-filter. The
+	filters are keyed by (kind, sid), so that a rule can have one filter of each kind."""
+
+	DETECTION = 1
+	EVENT = 2
+
+	__slots__ = ("sid", "track", "count", "seconds", "filterType", "gid")
+
+	def __init__(self, sid, track, count, seconds, filterType, gid):
+		Record.__init__(self)
+		self.sid = sid
+		self.track = track
+		self.count = count
+		self.seconds = seconds
+		self.filterType = filterType
+		self.gid = gid
+
+	def getKey(self):
+		if self.filterType:
+			return (self.EVENT, self.sid)
+		return (self.DETECTION, self.sid)
@@ -9,16 +9,28 @@ import zipfile
 import ConfigParser
 
 from util.config import Config
-from update.models import Source, Update, UpdateLog
+from update.models import Source, Update
+from update.progress import ProgressReporter
 from update.parser import Parser
 
 class UpdateTasks:
 	"""This class exposes the different method which we use for processing update-files."""
 
 	@staticmethod
-	def runUpdate(filename, sourcename = "Manual", update = None):
+	def logProgress(update, text):
+		"""Reports a progress-message ("<percent> <text>") trough the ProgressReporter of the update.
+		Nothing is reported during a dry-run, as the update is then never saved."""
+		if(update.pk != None):
+			ProgressReporter.forUpdate(update).progress(text)
+
+	@staticmethod
+	def runUpdate(filename, sourcename = "Manual", update = None, dryRun = False):
 		"""This method is doing an update. It is identifying what kind of file we have, and 
-		unpacks/parses it accordingly."""
+		unpacks/parses it accordingly.
+		
+		If dryRun is True, the files are parsed and compared with the database, but nothing
+		is written to the database. The change-plan of the update is returned instead (see
+		Updater.getChangePlan)."""
 		logger = logging.getLogger(__name__)
 		
 		logger.info("%d Starting update from %s with %s" % (os.getpid(), sourcename, filename))
@@ -29,9 +41,13 @@ class UpdateTasks:
 			return 1
 		
 		# If the appropriate source is found, we create an update-object, and starts working.
-		if(update == None):
+		#   (A dry-run uses an update-object which is never saved).
+		if(update == None and dryRun):
+			update = Update(source = source, time=datetime.datetime.now())
+		elif(update == None):
 			update = Update.objects.create(source = source, time=datetime.datetime.now())
 			source = update.source
+		plan = None
 
 		# Add our custom mimetypes:
 		mimetypes.add_type('text/plain', '.rules')
@@ -42,17 +58,25 @@ class UpdateTasks:
 		filetype = mimetypes.guess_type(filename)
 		if(filetype[0] == 'text/plain'):
 			logger.debug("%d File is identified as plaintext" % os.getpid())
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="10 Started to parse the file.")
+			UpdateTasks.logProgress(update, "10 Started to parse the file.")
 			
-			fileTuple = (filename, "")			
-			update.parseConfigFile(fileTuple, storeHash=False)
+			fileTuple = (filename, "")
+			parser = Parser(update, dryRun)
+			parser.parseConfigFile(fileTuple, storeHash=False)
+			plan = parser.save()
 
 		#elif(filetype[0] == 'application/x-tar'):
+		elif(Config.get("update", "streamArchives") == "true" and 
+				(tarfile.is_tarfile(filename) or zipfile.is_zipfile(filename))):
+			logger.debug("%d File is identified as an archive, which is parsed without unpacking it" % os.getpid())
+			UpdateTasks.logProgress(update, "10 Starting to parse the archive")
+			plan = UpdateTasks.processArchive(filename, source.name, update=update, dryRun=dryRun)
+
 		elif(tarfile.is_tarfile(filename)):
 			logger.debug("%d File is identified as a tar-archive" % os.getpid())
 
 			# Create a temporary working-directory
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="9 Unpacking downloaded archive")
+			UpdateTasks.logProgress(update, "9 Unpacking downloaded archive")
 			tmpdirectory = tempfile.mkdtemp()
 
 			# Unpack the archive
@@ -63,18 +87,18 @@ class UpdateTasks:
 				logger.error("%d Could not recognize the compression used in tarfile '%s'. Update is therefore not performed." % (os.getpid(), filename))
 			else:
 				# Process the content
-				UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="10 Starting to parse the archive")
-				UpdateTasks.processFolder(tmpdirectory, source.name, update=update)
+				UpdateTasks.logProgress(update, "10 Starting to parse the archive")
+				plan = UpdateTasks.processFolder(tmpdirectory, source.name, update=update, dryRun=dryRun)
 	
 				# Delete the temporary folder
-				UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="98 Cleaning up.")
+				UpdateTasks.logProgress(update, "98 Cleaning up.")
 				shutil.rmtree(tmpdirectory)
 
 		elif(filetype[0] == 'application/zip'):
 			logger.debug("%d File is identified as a zip-archive" % os.getpid())
 
 			# Create a temporary working-directory
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="9 Unpacking downloaded archive")
+			UpdateTasks.logProgress(update, "9 Unpacking downloaded archive")
 			tmpdirectory = tempfile.mkdtemp()
 
 			# Unpack the archive
@@ -83,33 +107,180 @@ class UpdateTasks:
 				z.extractall(tmpdirectory)
 
 			# Process the content
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="10 Starting to parse the archive")
-			UpdateTasks.processFolder(tmpdirectory, source.name, update=update)
+			UpdateTasks.logProgress(update, "10 Starting to parse the archive")
+			plan = UpdateTasks.processFolder(tmpdirectory, source.name, update=update, dryRun=dryRun)
 
 			# Delete the temporary folder
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="98 Cleaning up.")
+			UpdateTasks.logProgress(update, "98 Cleaning up.")
 			shutil.rmtree(tmpdirectory)
 
 		elif(os.path.isdir(filename)):		
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="10 Starting to parse the folder")
+			UpdateTasks.logProgress(update, "10 Starting to parse the folder")
 			logger.debug("%d File is identified as a folder" % os.getpid())
-			UpdateTasks.processFolder(filename, source.name, update=update)
+			plan = UpdateTasks.processFolder(filename, source.name, update=update, dryRun=dryRun)
 		
-		UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="100 Finished the update.")
+		UpdateTasks.logProgress(update, "100 Finished the update.")
+		if(update.pk != None):
+			ProgressReporter.forUpdate(update).close()
 		logger.info("%d Finished update from %s with %s" % (os.getpid(), sourcename, filename))
+		return plan
 
 	@staticmethod
-	def processFolder(path, sourceName = "Manual", update = None):
+	def getConfigFileNames():
+		"""Returns a dictionary with the filenames (and the rule-file extension) configured in the
+		files-section of the config, keyed by the name of the config-option."""
+		logger = logging.getLogger(__name__)
+		
+		configFiles = {}
+		for filename in ["classificationFile", "genMsgFile", "referenceConfigFile", "sidMsgFile", "filterFile", "ruleExt"]:
+			try:
+				configFiles[filename] = Config.get("files", filename)
+			except ConfigParser.NoOptionError:
+				configFiles[filename] = ""
+				logger.warning("A configuration string for option '"+filename+"' in section 'files' was not found.")
+		return configFiles
+	
+	@staticmethod
+	def archiveMembers(filename):
+		"""Iterates over the regular files in a tar or zip archive, without extracting them.
+		Yields (relative filepath, file-object, progress) tuples, where progress is how large
+		part (0-1) of the archive that is read so far."""
+		
+		archive = open(filename, "rb")
+		size = float(max(os.path.getsize(filename), 1))
+		
+		try:
+			if(zipfile.is_zipfile(filename)):
+				z = zipfile.ZipFile(archive, "r")
+				members = z.infolist()
+				for i, member in enumerate(members):
+					if not member.filename.endswith("/"):
+						yield (os.path.normpath(member.filename), z.open(member), float(i) / len(members))
+			else:
+				# Open the tar-archive as a stream, so that it is read sequentially only once. 
+				tar = tarfile.open(fileobj=archive, mode="r|*")
+				for member in tar:
+					if member.isfile():
+						yield (os.path.normpath(member.name), tar.extractfile(member), archive.tell() / size)
+		finally:
+			archive.close()
+	
+	@staticmethod
+	def processArchive(filename, sourceName = "Manual", update = None, dryRun = False):
+		"""Parses a tar or zip archive member by member, without unpacking it to the disk. Each
+		member is read once, and is hashed and parsed from memory.
+		
+		Like processFolder, the classification, gen-msg and reference files is parsed before the
+		rule-files, so that what the rules depend on is known when the rules are saved (which
+		happens while parsing, in streaming-mode). The rule-files found before them are kept in
+		memory until they are found, or until the end of the archive; later rule-files is parsed
+		in the order they appear. The sid-msg and filter files override what is in the rule-files,
+		and is parsed when all the rules are parsed.
+		
+		If dryRun is True, nothing is written to the database, and the change-plan is returned."""
+		logger = logging.getLogger(__name__)
+		logger.info("Starting to process an update-archive: %s" % filename)
+		
+		source = Source.objects.get(name=sourceName)
+		if(update == None and dryRun):
+			update = Update(time=datetime.datetime.now(), source=source)
+		elif(update == None):
+			update = Update.objects.create(time=datetime.datetime.now(), source=source)
+		
+		parser = Parser(update, dryRun)
+		storeHash = (sourceName != "Manual")
+		useFileNames = (Config.get("files", "useFileNames") == "true")
+		
+		if useFileNames:
+			configFiles = UpdateTasks.getConfigFileNames()
+			dependencies = [("classificationFile", parser.updateClassification), ("genMsgFile", parser.updateGenMsg),
+					("referenceConfigFile", parser.updateReferenceConfig)]
+			overrides = [("sidMsgFile", parser.updateSidMsg), ("filterFile", parser.updateFilter)]
+		else:
+			skipGroup = []
+			try:
+				skipGroup = Config.get("files", "skipExt").split(", ")
+			except ConfigParser.NoOptionError:
+				pass
+			patterns = parser.getConfigPatterns()
+		
+		# If the same config-file is present several times, the last one is used. (A dependency
+		#   found after the rules are parsed is parsed at once).
+		found = {}
+		pendingRules = []
+		rulesParsed = False
+		
+		def parseRules(relativeFilePath, data, progress):
+			UpdateTasks.logProgress(update, "%d Parsing %s" % (int(15 + 55 * progress), relativeFilePath))
+			parser.parseData(parser.updateRule, relativeFilePath, data, filename=os.path.basename(relativeFilePath))
+		
+		def parseDependencies():
+			for option, method in dependencies:
+				if option in found:
+					UpdateTasks.logProgress(update, "15 Parsing %s" % found[option][0])
+					parser.parseData(method, found[option][0], found[option][1])
+			for rules in pendingRules:
+				parseRules(*rules)
+			del pendingRules[:]
+		
+		UpdateTasks.logProgress(update, "12 Reading the archive")
+		for relativeFilePath, member, progress in UpdateTasks.archiveMembers(filename):
+			updateFile = os.path.basename(relativeFilePath)
+			
+			if useFileNames:
+				if updateFile.endswith(configFiles["ruleExt"]):
+					if rulesParsed:
+						parseRules(relativeFilePath, member.read(), progress)
+					else:
+						pendingRules.append((relativeFilePath, member.read(), progress))
+				else:
+					for option, method in dependencies:
+						if updateFile == configFiles[option]:
+							if rulesParsed:
+								parser.parseData(method, relativeFilePath, member.read())
+							else:
+								found[option] = (relativeFilePath, member.read())
+					for option, method in overrides:
+						if updateFile == configFiles[option]:
+							found[option] = (relativeFilePath, member.read())
+					
+					# When all the dependencies is found, the rules no longer needs to wait.
+					if(not rulesParsed and all([option in found for option, method in dependencies])):
+						parseDependencies()
+						rulesParsed = True
+			
+			elif os.path.splitext(updateFile)[1] not in skipGroup:
+				UpdateTasks.logProgress(update, "%d Parsing %s" % (int(15 + 60 * progress), relativeFilePath))
+				parser.parseData(parser.updateConfig, relativeFilePath, member.read(), storeHash, filename=updateFile, patterns=patterns)
+		
+		if useFileNames:
+			if(not rulesParsed):
+				parseDependencies()
+			for option, method in overrides:
+				if option in found:
+					UpdateTasks.logProgress(update, "%d Parsing %s" % (75 if option == "filterFile" else 70, found[option][0]))
+					parser.parseData(method, found[option][0], found[option][1])
+		
+		plan = parser.save()
+		logger.info("Finished processing the update-archive: %s" % filename)
+		return plan
+
+	@staticmethod
+	def processFolder(path, sourceName = "Manual", update = None, dryRun = False):
+		"""Parses all the files in the folder path, and saves the result to the database. If
+		dryRun is True, nothing is written to the database, and the change-plan is returned."""
 		logger = logging.getLogger(__name__)
 		logger.info("Starting to process an update-folder: %s" % path)
 	
 		# We do not catch the exception here, as the caller should be responsible to decide what to
 		#   do if the source do not exist.
 		source = Source.objects.get(name=sourceName)
-		if(update == None):
+		if(update == None and dryRun):
+			update = Update(time=datetime.datetime.now(), source=source)
+		elif(update == None):
 			update = Update.objects.create(time=datetime.datetime.now(), source=source)
 			
-		parser = Parser(update)
+		parser = Parser(update, dryRun)
 			
 		if sourceName == "Manual":
 			storeHash = False
@@ -127,13 +298,7 @@ class UpdateTasks:
 			filterFilename = "filterFile"
 			ruleExt = "ruleExt"
 			
-			configFiles = {}
-			for filename in [classificationFilename,genMsgFilename,referenceConfigFilename,sidMsgFilename,filterFilename,ruleExt]:
-				try:
-					configFiles[filename] = Config.get("files", filename)
-				except ConfigParser.NoOptionError:
-					configFiles[filename] = ""
-					logger.warning("A configuration string for option '"+filename+"' in section 'files' was not found.")
+			configFiles = UpdateTasks.getConfigFileNames()
 
 			# Place to mark if we found the files
 			foundClassifications = False
@@ -145,7 +310,7 @@ class UpdateTasks:
 			# Walk through the directory structure and extract the absolute path
 			# of all interesting files:
 			noFiles = 0
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="12 Collecting files")
+			UpdateTasks.logProgress(update, "12 Collecting files")
 			for dirpath, dirnames, filenames in os.walk(path):
 				for updateFile in filenames:
 					# Create a tuple with (absolute filepath, root folder path)
@@ -178,7 +343,7 @@ class UpdateTasks:
 						filterFile = fileTuple
 						noFiles += 1
 			
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="13 Found %d files to parse" % noFiles)
+			UpdateTasks.logProgress(update, "13 Found %d files to parse" % noFiles)
 			
 			# Update must parse files in the following order:
 			# 1. Read and update the classifications
@@ -188,28 +353,28 @@ class UpdateTasks:
 			# 5. Read and update the rule messages (which includes references)	
 			
 			if(foundClassifications):
-				UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="15 Parsing %s" % classificationFile[1])
+				UpdateTasks.logProgress(update, "15 Parsing %s" % classificationFile[1])
 				parser.parseClassificationFile(classificationFile)
 			if(foundGenMsg):
-				UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="17 Parsing %s" % genMsgFile[1])
+				UpdateTasks.logProgress(update, "17 Parsing %s" % genMsgFile[1])
 				parser.parseGenMsgFile(genMsgFile)
 			if(foundReferences):
-				UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="19 Parsing %s" % referenceConfigFile[1])
+				UpdateTasks.logProgress(update, "19 Parsing %s" % referenceConfigFile[1])
 				parser.parseReferenceConfigFile(referenceConfigFile)
 			
-			current = 20
-			step = float(50) / float(len(ruleFiles))
-			for updateFile in ruleFiles:
-				UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="%d Parsing %s" % (int(current), updateFile[1]))
-				parser.parseRuleFile(updateFile)
-				current = current + step
+			progress = {'current': 20, 'step': float(50) / float(max(len(ruleFiles), 1))}
+			def ruleFileProgress(updateFile):
+				UpdateTasks.logProgress(update, "%d Parsing %s" % (int(progress['current']), updateFile[1]))
+				progress['current'] += progress['step']
+			
+			parser.parseRuleFiles(ruleFiles, int(Config.get("update", "parseWorkers")), ruleFileProgress)
 
 			if foundSidMsg:		
-				UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="70 Parsing %s" % sidMsgFile[1])
+				UpdateTasks.logProgress(update, "70 Parsing %s" % sidMsgFile[1])
 				parser.parseSidMsgFile(sidMsgFile)
 				
 			if foundFilter:
-				UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="75 Parsing %s" % filterFile[1])
+				UpdateTasks.logProgress(update, "75 Parsing %s" % filterFile[1])
 				parser.parseFilterFile(filterFile)
 
 		else:
@@ -225,7 +390,7 @@ class UpdateTasks:
 			# of all interesting files:
 			files = []
 			noFiles = 0
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="12 Collecting files")
+			UpdateTasks.logProgress(update, "12 Collecting files")
 			for dirpath, dirnames, filenames in os.walk(path):
 				for updateFile in filenames:
 					if os.path.splitext(updateFile)[1] not in skipGroup:
@@ -237,14 +402,15 @@ class UpdateTasks:
 						files.append(fileTuple)
 						noFiles += 1
 			
-			UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="13 Found %d files to parse" % noFiles)			
+			UpdateTasks.logProgress(update, "13 Found %d files to parse" % noFiles)
 
 			current = 20
 			step = float(55) / float(len(files))
 			for updateFile in files:
-				UpdateLog.objects.create(update=update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="%d Parsing %s" % (int(current), updateFile[1]))
+				UpdateTasks.logProgress(update, "%d Parsing %s" % (int(current), updateFile[1]))
 				parser.parseConfigFile(updateFile, storeHash)
 				current = current + step
 
-		parser.save()		
+		plan = parser.save()
 		logger.info("Finished processing the update-folder: %s" % path)
+		return plan
@@ -7,22 +7,29 @@ It will raise an TypeError if any of the data is of wrong types..
 """
 
 import logging
-import datetime
+import resource
 
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max
 
-from core.models import Comment, Sensor, Generator, Rule, RuleRevision, RuleSet, RuleClass, RuleReference, RuleReferenceType
+from core.models import Change, Comment, Sensor, Generator, Rule, RuleRevision, RuleSet, RuleSetHierarchy, RuleClass, RuleReference, RuleReferenceType
 from tuning.models import Suppress, SuppressAddress, DetectionFilter, EventFilter
-from update.models import RuleChanges, Update, UpdateLog
+from update.locks import ApplyLock, SourceLock
+from update.models import RuleChanges, Update, UpdateFile
+from update.progress import ProgressReporter
+from update.persistence import bulkSave, bulkUpsert, bulkUpdate, getExistingRows
+from update.records import RAW, CHANGED, SAVED, GeneratorRecord, RuleRecord, ClassRecord, ReferenceTypeRecord, \
+		ReferenceRecord, RuleSetRecord, SuppressRecord, FilterRecord
 from util.config import Config
+from util.tools import chunks
 
 class Updater():
-	RAW = 0
-	NEW = 1
-	CHANGED = 2
-	SAVED = 3
+	RAW = RAW
+	CHANGED = CHANGED
+	SAVED = SAVED
 	
-	def __init__(self, update):
+	def __init__(self, update, streamSize = None):
 		# Get config from the configfile, and if the config is not valid,
 		#   just set it to be "first"
 		self.msgsource = Config.get("update", "ruleMessageSource")
@@ -32,7 +39,11 @@ class Updater():
 		self.update = update
 		self.comment = None
 		
-		# Initialize the dictionaries to store the data in.
+		# The maximum number of SID's (or other keys) sent to the database in a single query.
+		self.chunkSize = int(Config.get("update", "queryChunkSize"))
+		
+		# Initialize the dictionaries to store the data in. The dictionaries contain records from
+		#   update.records, keyed by the natural key of the object (SID, name, or a tuple).
 		self.generators = {}
 		self.ruleSets = {}
 		self.rules = {}
@@ -41,6 +52,39 @@ class Updater():
 		self.referenceTypes = {}
 		self.suppress = {}
 		self.filters = {}
+		
+		# SID's of the rules which is skipped, as they are identical to what is already in the database.
+		self.unchangedRules = set()
+		
+		# Messages recieved for rules which is already saved. They are resolved in bulk by saveRules.
+		self.pendingMessages = {}
+		
+		# Primary keys of the rules which got a new revision in this update, and the SID's of the
+		#   rules which is created by it.
+		self.revisedRules = set()
+		self.createdRules = set()
+		
+		# SID's of the rules which is new or changed, and not yet recorded in the change-log. They
+		#   are recorded by recordChanges, at the end of the transaction saving them.
+		self.changedRules = set()
+		
+		# True if the filters or suppresses of the "All" sensor is created or changed, and the
+		#   change is not yet recorded in the change-log.
+		self.tuningChanged = False
+		
+		# In streaming-mode, the rules are saved (and removed from the cache) every time streamSize
+		#   rules is recieved, instead of when the whole update is parsed. 0 disables streaming. The
+		#   SID's of the rules which is saved and removed from the cache is kept in flushedRules. If
+		#   such a SID is recieved again, the last one still wins (see replaceRevisions).
+		if(streamSize == None):
+			streamSize = int(Config.get("update", "streamChunkSize"))
+		self.streamSize = streamSize
+		self.flushedRules = set()
+		
+		# The checksums of the parsed update-files, keyed by the name of the file. They are saved
+		#   in the transaction of saveAll, so that a file is only skipped by the next update if
+		#   this update is saved.
+		self.files = {}
 	
 	def getComment(self):
 		if not self.comment:
@@ -68,8 +112,18 @@ class Updater():
 		
 		# Add the generator to the data-structure. If a generator with the
 		# same gid-alertID exists, it will simply be overwritten.
-		key = "%d-%d" % (gid, alertID) 
-		self.generators[key] = [self.RAW, (gid, alertID, message)]
+		self.generators[(gid, alertID)] = GeneratorRecord(gid, alertID, message)
+	
+	def addFile(self, name, checksum):
+		"""
+		Adds the checksum of a parsed update-file.
+		
+		Required parametres:
+			name		string		The path of the file, relative to the update.
+			checksum	string		The md5sum of the file.
+		"""
+		
+		self.files[name] = checksum
 	
 	def addRule(self, sid, rev, raw, message, active, ruleset, classtype, priority = None, gid = 1):
 		"""
@@ -109,25 +163,30 @@ class Updater():
 		if(type(gid) != int):
 			raise TypeError("GeneratorID needs to be an integer")
 		
+		# In streaming-mode, save the rules recieved so far when the cache is full. This is done
+		#   before the new rule is added, so that the references and filters of the previous rule
+		#   is recieved before it is saved.
+		if(self.streamSize and sid not in self.rules and len(self.rules) >= self.streamSize):
+			self.flushRules()
+		
 		# If there is no rule recieved yet with this SID, just save it.
 		if(sid not in self.rules):
-			self.rules[sid] = [self.RAW, (sid, rev, raw, message, active, ruleset, classtype, 
-						priority, gid)]
+			self.rules[sid] = RuleRecord(sid, rev, raw, message, active, ruleset, classtype, priority, gid)
 		
 		# If a rule with the same SID already exists (it might be just a message):
 		else:
 			# Determine which of the message-strings we are going to use. 
+			record = self.rules[sid]
 			if(self.msgsource == "sidmsg"):
-				if(self.rules[sid][0] == self.RAW):
-					msg = self.rules[sid][1][3]
+				if(record.status == RAW):
+					msg = record.msg
 				else:
-					msg = self.rules[sid][1].msg
+					msg = record.obj.getCurrentRevision().msg
 			else:
 				msg = message	
 			
 			# Add the rule to the data-structure.
-			self.rules[sid] = [self.RAW, (sid, rev, raw, msg, active, ruleset, classtype, 
-						priority, gid)]
+			self.rules[sid] = RuleRecord(sid, rev, raw, msg, active, ruleset, classtype, priority, gid)
 	
 	def addMessage(self, sid, message):
 		"""
@@ -144,23 +203,26 @@ class Updater():
 		if(type(message) != str):
 			raise TypeError("message needs to be a string")
 		
+		# If the rule is already saved, and removed from the cache, in streaming-mode, the message
+		#   is handled like for other saved rules.
+		if(sid in self.flushedRules and sid not in self.rules):
+			if(self.msgsource == "sidmsg"):
+				self.pendingMessages[sid] = message
+		
 		# Either create an empty rule, where we add the message.
-		if(sid not in self.rules):
-			self.rules[sid] = [self.RAW, (sid, None, None, message, None, None, 
-							None, None, None)]
+		elif(sid not in self.rules):
+			self.rules[sid] = RuleRecord(sid, None, None, message, None, None, None, None, None)
 		
 		# Or, if the config says that sidmsg should be the message-source, update the
 		# existing rule.
 		elif(self.msgsource == "sidmsg"):
-			rule = self.rules[sid][1]
-			if(self.rules[sid][0] == self.RAW):
-				self.rules[sid] = [self.RAW, (sid, rule[1], rule[2], message, rule[4], 
-							rule[5], rule[6], rule[7], rule[8])]
+			record = self.rules[sid]
+			if(record.status == RAW):
+				record.msg = message
 			else:
-				rev = rule.getCurrentRevision()
-				self.rules[sid] = [self.RAW, (sid, rev.rev, rev.raw, message, rule.active, 
-							rule.ruleSet.name, rule.ruleClass.classtype, rule.priority, 
-							rule.generator.gid)]
+				# The current revision of the saved rule is needed to create a new RuleRecord. Rather
+				#   than fetching it for every message, the messages are resolved in bulk later.
+				self.pendingMessages[sid] = message
 	
 	def addClass(self, classtype, description, priority):
 		"""
@@ -179,7 +241,7 @@ class Updater():
 		if(type(priority) != int):
 			raise TypeError("priority needs to be an integer")
 
-		self.classes[classtype] = [self.RAW, (classtype, description, priority)]
+		self.classes[classtype] = ClassRecord(classtype, description, priority)
 	
 	def addReferenceType(self, name, urlPrefix):
 		"""
@@ -196,9 +258,9 @@ class Updater():
 		if(type(urlPrefix) != str):
 			raise TypeError("urlPrefix needs to be a string")
 		
-		self.referenceTypes[name] = [self.RAW, (name, urlPrefix)]
+		self.referenceTypes[name] = ReferenceTypeRecord(name, urlPrefix)
 	
-	def addReference(self, referenceType, reference, sid):
+	def addReference(self, referenceType, reference, sid, inRule = False):
 		"""
 		Adds a reference to a rule.
 		
@@ -206,6 +268,10 @@ class Updater():
 			referenceType	string	The name of the reference-type.
 			reference		string	Content of the reference
 			sid				int		ID of the rule this reference belongs to.
+		
+		Optional parametres:
+			inRule			bool	True if the reference is a part of the rulestring, and
+									not from (for example) sid-msg.map.
 		"""
 		
 		if(type(referenceType) != str):
@@ -217,8 +283,7 @@ class Updater():
 
 		reference = reference.rstrip()
 		
-		key = "%s-%s-%d" % (referenceType, reference, sid)
-		self.references[key] = [self.RAW, (referenceType, reference, sid)]
+		self.references[(referenceType, reference, sid)] = ReferenceRecord(referenceType, reference, sid, inRule)
 	
 	def addRuleSet(self, name):
 		"""
@@ -231,7 +296,7 @@ class Updater():
 		if(type(name) != str):
 			raise TypeError("name needs to be a string")
 
-		self.ruleSets[name] = [self.RAW, name]
+		self.ruleSets[name] = RuleSetRecord(name)
 	
 	def addSuppress(self, sid, track = None, addresses = None, gid = 1):
 		"""
@@ -261,7 +326,7 @@ class Updater():
 			raise TypeError("The GeneratorID needs to be an int.")
 
 		# Save the suppress to memory.
-		self.suppress[sid] = [self.RAW, (sid, track, addresses, gid)]
+		self.suppress[sid] = SuppressRecord(sid, track, addresses, gid)
 	
 	def addFilter(self, sid, track, count, seconds, filterType = None, gid = 1):
 		"""
@@ -295,83 +360,40 @@ class Updater():
 		if(type(gid) != int):
 			raise TypeError("GeneratorID needs to be an int.")
 			
-		# Generate a key which helps us keep up to one filter of each type.
-		if filterType:
-			key = "EF-%d" % sid
-		else:
-			key = "DF-%d" % sid
-		
-		# Save the parametres to memory.
-		self.filters[key] = [self.RAW, (sid, track, count, seconds, filterType, gid)]
+		# Save the parametres to memory. The key of the record makes sure we keep up to one
+		#   filter of each type.
+		record = FilterRecord(sid, track, count, seconds, filterType, gid)
+		self.filters[record.getKey()] = record
 	
 	def saveGenerators(self):
 		"""Saves all the new/changed generators to the dabase, while trying to
-		minimize the impact on DB performance."""
+		minimize the impact on DB performance. The generators are upserted in bulk,
+		and stored in the cache afterwards."""
 		logger = logging.getLogger(__name__)
 		
 		# Analyze the retrieved generators, and create list of all the generators
-		# we would need to try to fetch from the database.
+		# we need to write to the database.
 		newGenerators = {}
-		rawGid = []
-		rawAlertID = []
-		for gen in self.generators:
-			if self.generators[gen][0] == self.RAW:
-				newGenerators[gen] = self.generators[gen][1]
-				rawGid.append(self.generators[gen][1][0])
-				rawAlertID.append(self.generators[gen][1][1])
-		
-		logger.debug("Found %d new generators to be checked" % len(rawGid))
-		
-		# Try to fetch the generators from the database, and loop trough them:
-		generators = Generator.objects.filter(GID__in = rawGid, alertID__in = rawAlertID).all()
+		for key, record in self.generators.iteritems():
+			if record.status == RAW:
+				newGenerators[key] = record
+		
+		logger.debug("Found %d new generators to be saved" % len(newGenerators))
+		if(len(newGenerators) == 0):
+			return
+		
+		# Insert the generators, or update the message of the generators that already exists.
+		#   bulkSave sets the primary keys on the objects, so they can be stored in memory
+		#   without reading them back. In case somebody needs them later in the update.
+		generators = [Generator(GID=r.gid, alertID=r.alertID, message=r.message) for r in newGenerators.itervalues()]
+		bulkSave(Generator, generators, ["GID", "alertID"], ["message"], self.chunkSize)
 		for generator in generators:
-			key = "%d-%d" % (generator.GID, generator.alertID)
-			# If this is a generator that we want to look at (as we will also get 1-2 when we
-			#   look for 1-1 and 2-2... )
-			if key in newGenerators:
-				status = self.SAVED
-				rawGenerator = newGenerators.pop(key)
-				
-				# If the message is new, add the new message.
-				if(rawGenerator[2] != generator.message):
-					status = self.CHANGED
-					generator.message = rawGenerator[2]
-				
-				# If anything needed to be changed, save the object.
-				if(status == self.CHANGED):
-					generator.save()
-					status = self.SAVED
-					logger.debug("Updated %s" % str(generator))
-
-				# Store the object in the local cache, in case it is needed later.
-				self.generators[key] = [status, generator]
-		
-		# If there are any generators we could not find in the database
-		if(len(newGenerators)):
-			# Make a list of new Generator objects, a list of gid's and a list of alertID's.
-			g = []
-			gids = []
-			alertIDs = []
-			for gen in newGenerators:
-				generator = newGenerators[gen]
-				gids.append(generator[0])
-				alertIDs.append(generator[1])
-				g.append(Generator(GID=generator[0], alertID=generator[1], message=generator[2]))
-			
-			# Insert the created Generator objects to the database.
-			Generator.objects.bulk_create(g)	
-			logger.debug("Created %d new generators" % len(g))
-			
-			# Read them back out, and store them in memory. In case somebody needs them later in the
-			# update.
-			for generator in Generator.objects.filter(GID__in = gids, alertID__in = alertIDs).all():
-				key = "%d-%d" % (generator.GID, generator.alertID)
-				self.generators[key] = [self.SAVED, generator]
+			newGenerators[(generator.GID, generator.alertID)].markSaved(generator)
 	
 	def getRule(self, sid):
 		try:
-			if(self.rules[int(sid)][0] == self.SAVED):
-				return self.rules[int(sid)][1]
+			if(self.rules[int(sid)].status == SAVED):
+				return self.rules[int(sid)].obj
 		except KeyError:
 			pass
 		
@@ -381,6 +403,61 @@ class Updater():
 			logger = logging.getLogger(__name__)
 			logger.error("Rule %s in not found" % sid)
 			raise Rule.DoesNotExist
+	
+	def resolveRules(self, sids):
+		"""Returns a dictionary mapping each of the SID's in sids to its Rule object. Rules which
+		is not saved in the cache is fetched from the database in chunked queries, and stored in
+		the cache for later use. SID's which is not found in the database is not in the result.
+		
+		In streaming-mode, the fetched rules is not stored in the cache, as they would count
+		towards the size of the next chunk, and never be removed from it."""
+		
+		result = {}
+		missing = []
+		for sid in sids:
+			record = self.rules.get(sid)
+			if(record != None and record.status == SAVED):
+				result[sid] = record.obj
+			else:
+				missing.append(sid)
+		
+		for chunk in chunks(missing, self.chunkSize):
+			for rule in Rule.objects.filter(SID__in = chunk):
+				result[rule.SID] = rule
+				if(not self.streamSize and rule.SID not in self.rules):
+					self.rules[rule.SID] = RuleRecord.fromObject(rule)
+		
+		return result
+	
+	def resolveCurrentRevisions(self, sids):
+		"""Returns a dictionary mapping each of the SID's in sids to its current (the latest
+		active) RuleRevision, with the rule, its ruleset and its classification prefetched. 
+		The revisions is fetched trough Rule.currentRevision, in chunked queries."""
+		
+		result = {}
+		for chunk in chunks(sids, self.chunkSize):
+			for rule in Rule.objects.filter(SID__in = chunk).select_related("currentRevision", "ruleSet", "ruleClass"):
+				revision = rule.getCurrentRevision()
+				if(revision != None):
+					revision.rule = rule
+					result[rule.SID] = revision
+		
+		return result
+	
+	def resolvePendingMessages(self):
+		"""Creates new RuleRecords for the saved rules which have recieved a new message. Returns
+		the SID's of the records created."""
+		
+		revisions = self.resolveCurrentRevisions(self.pendingMessages.keys())
+		for sid, message in self.pendingMessages.iteritems():
+			if sid in revisions:
+				rev = revisions[sid]
+				rule = rev.rule
+				self.rules[sid] = RuleRecord(sid, rev.rev, rev.raw, message, rule.active, 
+							rule.ruleSet.name, rule.ruleClass.classtype, rule.priority, 
+							rule.generator_id)
+		self.pendingMessages = {}
+		return set(revisions.keys())
 
 	def getRuleSet(self, name):
 		"""This method fetches the ruleset with the supplied name, and returns it.
@@ -391,8 +468,8 @@ class Updater():
 		RuleSet.DoesNotExist exception is raised."""
 		
 		try:
-			if(self.ruleSets[name][0] == self.SAVED):
-				return self.ruleSets[name][1]
+			if(self.ruleSets[name].status == SAVED):
+				return self.ruleSets[name].obj
 		except KeyError:
 			pass
 		
@@ -412,124 +489,67 @@ class Updater():
 		RuleClass.DoesNotExist exception is raised."""
 		
 		try:
-			if(self.classes[name][0] == self.SAVED):
-				return self.classes[name][1]
+			if(self.classes[name].status == SAVED):
+				return self.classes[name].obj
 		except KeyError:
 			pass
 	
 		try:	
-			self.classes[name] = (self.SAVED, RuleClass.objects.get(classtype=name))
+			self.classes[name] = ClassRecord.fromObject(RuleClass.objects.get(classtype=name))
 		except RuleClass.DoesNotExist:
-			self.classes[name] = (self.SAVED, RuleClass.objects.create(classtype=name, description=name, priority=4))
+			self.classes[name] = ClassRecord.fromObject(RuleClass.objects.create(classtype=name, description=name, priority=4))
 		
-		return self.classes[name][1]
+		return self.classes[name].obj
 	
 	def saveClasses(self):
 		"""Saves all the new/changed ruleclasses to the dabase, while trying to
-		minimize the impact on DB performance."""
+		minimize the impact on DB performance. The classes are upserted in bulk,
+		and stored in the cache afterwards."""
 		logger = logging.getLogger(__name__)
 		
 		# Analyze the retrieved classes, and create list of all the classes
-		# we would need to try to fetch from the database.
+		# we need to write to the database.
 		newClasses = {}
-		classnames = []
-		for c in self.classes:
-			if self.classes[c][0] == self.RAW:
-				newClasses[c] = self.classes[c][1]
-				classnames.append(self.classes[c][1][0])
-		
-		logger.debug("Found %d new classes to be checked" % len(classnames))
-		
-		# Try to fetch the classtypes from the database, and loop trough them:
-		classes = RuleClass.objects.filter(classtype__in = classnames).all()
-		for c in classes:
-			status = self.SAVED
-			raw = newClasses.pop(c.classtype)
-			
-			# If any of the parametres have changed, update them, and set the
-			# status-flag to changed
-			if(raw[1] != c.description):
-				status = self.CHANGED
-				c.description = raw[1]
-			if(raw[2] != c.priority):
-				status = self.CHANGED
-				c.priority = raw[2]
-			
-			# If anything needed to be changed, save the object.
-			if(status == self.CHANGED):
-				c.save()
-				status = self.SAVED
-				logger.debug("Updated %s" % str(c))
-
-			# Store the object in the local cache, in case it is needed later.
-			self.classes[c.classtype] = [status, c]
-		
-		if(len(newClasses)):
-			# Make a list of new RuleClass objects, and a list of classtypes..
-			ruleClasses = []
-			classtypes = []
-			for c in newClasses:
-				classtypes.append(newClasses[c][0])
-				ruleClasses.append(RuleClass(classtype=newClasses[c][0], description=newClasses[c][1], priority=newClasses[c][2]))
-			
-			# Insert the created RuleClass objects to the database.
-			RuleClass.objects.bulk_create(ruleClasses)	
-			logger.debug("Created %d new RuleClass-es" % len(ruleClasses))
-			
-			# Read them back out, and store them in memory. In case somebody needs them later in the
-			# update.
-			for classtype in RuleClass.objects.filter(classtype__in=classtypes).all():
-				self.classes[classtype.classtype] = [self.SAVED, classtype]
+		for classtype, record in self.classes.iteritems():
+			if record.status == RAW:
+				newClasses[classtype] = record
+		
+		logger.debug("Found %d new classes to be saved" % len(newClasses))
+		if(len(newClasses) == 0):
+			return
+		
+		# Insert the classes, or update the description and priority of the classes that already exists.
+		classes = [RuleClass(classtype=r.classtype, description=r.description, priority=r.priority) for r in newClasses.itervalues()]
+		bulkSave(RuleClass, classes, ["classtype"], ["description", "priority"], self.chunkSize)
+		
+		# Store them in memory. In case somebody needs them later in the update.
+		for classtype in classes:
+			newClasses[classtype.classtype].markSaved(classtype)
 	
 	def saveReferenceTypes(self):
 		"""Saves all the new/changed RuleReferenceType's to the dabase, while trying to
-		minimize the impact on DB performance."""
+		minimize the impact on DB performance. The types are upserted in bulk,
+		and stored in the cache afterwards."""
 		logger = logging.getLogger(__name__)
 		
 		# Analyze the retrieved referencetypes, and create list of all the types
-		# we would need to try to fetch from the database.
+		# we need to write to the database.
 		newTypes = {}
-		typenames = []
-		for refType in self.referenceTypes:
-			if self.referenceTypes[refType][0] == self.RAW:
-				newTypes[refType] = self.referenceTypes[refType][1]
-				typenames.append(self.referenceTypes[refType][1][0])
-		
-		logger.debug("Found %d new RuleReferenceType's to be checked" % len(newTypes))
-		
-		# Try to fetch the referenceType from the database, and loop trough them:
-		refTypes = RuleReferenceType.objects.filter(name__in=typenames).all()
-		for t in refTypes:
-			status = self.SAVED
-			raw = newTypes.pop(t.name)
-			
-			# If any of the parametres have changed, update them, and set the
-			# status-flag to changed
-			if(raw[1] != t.urlPrefix):
-				t.urlPrefix = raw[1]
-				t.save()
-				status = self.SAVED
-				logger.debug("Updated %s" % str(t))
-
-			# Store the object in the local cache, in case it is needed later.
-			self.referenceTypes[t.name] = [status, t]
-		
-		if(len(newTypes)):
-			# Make a list of new RuleReferenceType objects, and a list of their names.
-			refTypes = []
-			typeNames = []
-			for t in newTypes:
-				typeNames.append(newTypes[t][0])
-				refTypes.append(RuleReferenceType(name=newTypes[t][0], urlPrefix=newTypes[t][1]))
-			
-			# Insert the created RuleReferenceType objects to the database.
-			RuleReferenceType.objects.bulk_create(refTypes)	
-			logger.debug("Created %d new RuleReferenceType's" % len(refTypes))
-			
-			# Read them back out, and store them in memory. In case somebody needs them later in the
-			# update.
-			for refType in RuleReferenceType.objects.filter(name__in=typeNames).all():
-				self.referenceTypes[refType.name] = [self.SAVED, refType]
+		for name, record in self.referenceTypes.iteritems():
+			if record.status == RAW:
+				newTypes[name] = record
+		
+		logger.debug("Found %d new RuleReferenceType's to be saved" % len(newTypes))
+		if(len(newTypes) == 0):
+			return
+		
+		# Insert the reference-types, or update the urlPrefix of the types that already exists.
+		refTypes = [RuleReferenceType(name=r.name, urlPrefix=r.urlPrefix) for r in newTypes.itervalues()]
+		bulkSave(RuleReferenceType, refTypes, ["name"], ["urlPrefix"], self.chunkSize)
+		
+		# Store them in memory. In case somebody needs them later in the update.
+		for refType in refTypes:
+			newTypes[refType.name].markSaved(refType)
 			
 	def saveRuleSets(self):
 		"""Saves all the new/changed RuleSet's to the dabase, while trying to
@@ -538,197 +558,328 @@ class Updater():
 		
 		# Analyze the retrieved sets, and create list of all the sets
 		# we would need to try to fetch from the database.
-		newSets = []
-		for ruleSet in self.ruleSets:
-			if self.ruleSets[ruleSet][0] == self.RAW:
-				newSets.append(ruleSet)
+		newSets = {}
+		for name, record in self.ruleSets.iteritems():
+			if record.status == RAW:
+				newSets[name] = record
 		
 		logger.debug("Found %d new RuleSet's to be checked" % len(newSets))
 		
-		# Try to fetch the referenceType from the database, and loop trough them:
-		sets = RuleSet.objects.filter(name__in=newSets).all()
-		for s in sets:
-			status = self.SAVED
-			newSets.remove(s.name)
-			self.ruleSets[s.name] = [status, s]
+		# Try to fetch the rulesets from the database, and loop trough them:
+		for chunk in chunks(newSets.keys(), self.chunkSize):
+			for s in RuleSet.objects.filter(name__in=chunk):
+				newSets.pop(s.name).markSaved(s)
 		
 		if(len(newSets)):
 			# Make a list of new RuleSet objects.
-			ruleSets = []
+			ruleSets = {}
 			for s in newSets:
-				ruleSets.append(RuleSet(name=s, active=True, description=s))
+				ruleSets[(s,)] = RuleSet(name=s, active=True, description=s)
 			
-			# Insert the created RuleReferenceType objects to the database.
-			RuleSet.objects.bulk_create(ruleSets)	
+			# Insert the created RuleSet objects to the database.
+			bulkUpsert(RuleSet, ruleSets.values(), ["name"], [], self.chunkSize)
 			logger.debug("Created %d new RuleSet's" % len(ruleSets))
 			
 			# Get a model from update, to add the rulesets to the manytomany relation.
 			throughModel = Update.ruleSets.through
 			tms = []
 			
-			# Read them back out, and store them in memory. In case somebody needs them later in the
-			# update.
-			for ruleSet in RuleSet.objects.filter(name__in=newSets).all():
-				self.ruleSets[ruleSet.name] = [self.SAVED, ruleSet]
+			# Read back the primary keys of the inserted sets, and store them in memory. In case
+			#   somebody needs them later in the update.
+			for key, row in getExistingRows(RuleSet, ["name"], [], ruleSets.keys(), self.chunkSize).iteritems():
+				ruleSet = ruleSets[key]
+				ruleSet.pk = row[0]
+				newSets[ruleSet.name].markSaved(ruleSet)
 				tms.append(throughModel(ruleset = ruleSet, update=self.update))
 			
 			throughModel.objects.bulk_create(tms)
+			RuleSetHierarchy.addRoots([tm.ruleset_id for tm in tms])
+			
+	
+	def getLatestRevisions(self, sids, withPk = False):
+		"""Returns a dictionary with the highest rev stored in the database for each of the SID's
+		in sids. The revisions is found with an aggregate query, sent in chunks of at most
+		chunkSize SID's. SID's without any revisions in the database is not in the result.
+		
+		If withPk is True, the values in the dictionary is (pk, rev) tuples, where pk is the
+		primary key of the latest RuleRevision."""
+		
+		latest = {}
+		for chunk in chunks(sids, self.chunkSize):
+			revisions = {}
+			for sid, rev in RuleRevision.objects.filter(rule__SID__in = chunk).values_list("rule__SID").annotate(Max("rev")):
+				revisions[sid] = rev
 			
+			if not withPk:
+				latest.update(revisions)
+				continue
+			
+			# Find the primary-key of the latest revisions. The query might return some older revisions
+			#   as well, if they happen to have the same rev as the latest of another rule.
+			for pk, sid, rev in RuleRevision.objects.filter(rule__SID__in = chunk, 
+					rev__in = set(revisions.values())).values_list("pk", "rule__SID", "rev"):
+				if(revisions[sid] == rev):
+					latest[sid] = (pk, rev)
+		
+		return latest
+	
+	def compareRevisions(self, records):
+		"""Compares the rev of the RuleRecords in the dictionary records (keyed by SID) with the
+		latest revisions in the database, and splits them in three dictionaries:
+		(new, updated, unchanged). new contains the rules which is not in the database,
+		updated the rules with a higher rev than the database, and unchanged the rest."""
+		
+		new = {}
+		updated = {}
+		unchanged = {}
+		latest = self.getLatestRevisions(records.keys())
+		for sid, record in records.iteritems():
+			if(sid not in latest):
+				new[sid] = record
+			elif(record.rev > latest[sid]):
+				updated[sid] = record
+			else:
+				unchanged[sid] = record
+		
+		return (new, updated, unchanged)
+	
+	def replaceRevisions(self, updated, unchanged, messages):
+		"""Used by saveRules in streaming-mode, where a SID can be recieved again after its rule is
+		saved in an earlier chunk (from a later file, or as a message from sid-msg.map). The last
+		one recieved should still win, like when everything is saved at once: If the rule got
+		its latest revision from this update, that revision is replaced instead of a new one
+		being created. With "ruleMessageSource: sidmsg", the message of the revision is kept,
+		unless the SID is in messages (the SID's with a new message from sid-msg.map).
+		
+		A rule which existed before this update keeps the revision if the new rev is not higher
+		than the revisions it had before, as it would then have been left unchanged.
+		
+		Returns a dictionary mapping the SID's of theese rules to the primary-key of the revision
+		to replace. The rules found in unchanged is moved to updated."""
+		
+		records = {}
+		for sid in self.flushedRules.intersection(updated.keys() + unchanged.keys()):
+			records[sid] = updated.get(sid) or unchanged.get(sid)
+		
+		# Find the latest revisions which is created by this update.
+		candidates = dict([(pk, sid) for sid, (pk, rev) in self.getLatestRevisions(records.keys(), withPk=True).iteritems()])
+		revisions = {}
+		for chunk in chunks(candidates.keys(), self.chunkSize):
+			for pk, msg in RuleRevision.objects.filter(pk__in=chunk, update=self.update).values_list("pk", "msg"):
+				revisions[candidates[pk]] = (pk, msg)
+		
+		previous = {}
+		for chunk in chunks(revisions.keys(), self.chunkSize):
+			for sid, rev in RuleRevision.objects.filter(rule__SID__in=chunk).exclude(update=self.update).values_list("rule__SID").annotate(Max("rev")):
+				previous[sid] = rev
+		
+		replaced = {}
+		for sid, (pk, msg) in revisions.iteritems():
+			record = records[sid]
+			if(record.rev == None or (sid in previous and record.rev <= previous[sid])):
+				continue
+			
+			replaced[sid] = pk
+			if(self.msgsource == "sidmsg" and sid not in messages):
+				record.msg = msg
+			if(sid in unchanged):
+				updated[sid] = unchanged.pop(sid)
+		
+		return replaced
 	
 	def saveRules(self):
 		"""Saves the rules recieved"""
 		logger = logging.getLogger(__name__)
+		
+		messages = self.resolvePendingMessages()
 
-		# Create a list of rule's SID
-		sids = []
+		# Create a list of rule's SID, and calculate the fingerprint of each of the rules.
 		newRules = {}
-		for rule in self.rules:
-			if(self.rules[rule][0] == self.RAW):
-				sids.append(self.rules[rule][1][0])
-				newRules[self.rules[rule][1][0]] = self.rules[rule][1]
-		
-		# Collect a list of the SID/rev pairs matching any SID we currently have the rule in RAW format.
-		revisionids = RuleRevision.objects.filter(rule__SID__in = sids).values_list("pk", flat=True).distinct()
-		sidrev = RuleRevision.objects.filter(pk__in=revisionids).values_list("rule__SID", "rev").all()
-		
-		# Compare the SID/rev of all new Rules with the results from the database, and determine which rules
-		# really is new, and which rules are updated, and which have no changes. (We still skip looking at
-		# rules where the SID/rev values is seen before.)
-		updated = {}
-		unchanged = {}
-		for sid, rev in sidrev:
-			if(sid in newRules):
-				raw = newRules.pop(sid)
-				if(raw[1] > rev):
-					updated[sid] = raw
-				else:
-					unchanged[sid] = raw
+		fingerprints = {}
+		for sid, record in self.rules.iteritems():
+			if(record.status == RAW):
+				newRules[sid] = record
+				if(record.rev != None):
+					fingerprints[sid] = Rule.calculateFingerprint(record.raw, record.msg, record.classtype, 
+							record.ruleset, record.priority, record.active, record.gid)
+		
+		# Drop all the rules which have the same fingerprint as the rule stored in the database. Nothing
+		#   about theese rules have changed since they were last seen, so there is no need to look at them. 
+		for chunk in chunks(fingerprints.keys(), self.chunkSize):
+			for sid, fingerprint in Rule.objects.filter(SID__in = chunk).exclude(fingerprint=None).values_list("SID", "fingerprint"):
+				if(fingerprints[sid] == fingerprint):
+					newRules.pop(sid)
+					self.rules.pop(sid)
+					self.unchangedRules.add(sid)
+		logger.debug("Skipped %d rules with an unchanged fingerprint" % len(self.unchangedRules))
+		
+		# Compare the SID/rev of all new Rules with the latest revisions in the database, and determine which 
+		# rules really is new, and which rules are updated, and which have no changes.
+		newRules, updated, unchanged = self.compareRevisions(newRules)
+		replaced = self.replaceRevisions(updated, unchanged, messages)
+		for sid in replaced:
+			record = updated[sid]
+			fingerprints[sid] = Rule.calculateFingerprint(record.raw, record.msg, record.classtype, 
+					record.ruleset, record.priority, record.active, record.gid)
 		
 		# Create new revisions to all the rules that needs an update.
 		activateNewRevisions = (Config.get("update", "activateNewRevisions") == "true")
 		changeRuleSet = (Config.get("update", "changeRuleset") == "true")
 		ruleChanges = []
 		newRevisions = []
+		replacedRevisions = []
 		changedSIDs = []
-		for rule in Rule.objects.filter(SID__in=updated.keys()).select_related('ruleSet', 'ruleClass').all():
-			status = self.SAVED
-			raw = updated[rule.SID]
-			changedSIDs.append(rule.SID)
+		changedRules = []
+		updatedRules = []
+		for chunk in chunks(updated.keys(), self.chunkSize):
+			updatedRules.extend(Rule.objects.filter(SID__in=chunk).select_related('ruleSet', 'ruleClass'))
+		for rule in updatedRules:
+			record = updated[rule.SID]
 
-			# Create a new rule-revision.
-			newRevisions.append(RuleRevision(rule=rule, rev=raw[1], msg=raw[3], raw=raw[2], active=activateNewRevisions))
+			# Create a new rule-revision, or replace the one created earlier in this update.
+			if(rule.SID in replaced):
+				replacedRevisions.append(RuleRevision(pk=replaced[rule.SID], rule=rule, rev=record.rev, msg=record.msg, raw=record.raw))
+				self.changedRules.add(rule.SID)
+			else:
+				changedSIDs.append(rule.SID)
+				self.revisedRules.add(rule.pk)
+				newRevisions.append(RuleRevision(rule=rule, rev=record.rev, msg=record.msg, raw=record.raw, active=activateNewRevisions))
+			
+			if(rule.fingerprint != fingerprints[rule.SID]):
+				record.status = CHANGED
+				rule.fingerprint = fingerprints[rule.SID]
 			
-			# Update ruleset and/or classification if they have changed:
-			if(rule.ruleSet.name != raw[5]):
+			# Update ruleset and/or classification if they have changed. (A rule created earlier
+			#   in this update is simply moved, like a new rule would be created in its ruleset).
+			if(rule.ruleSet.name != record.ruleset and rule.SID in self.createdRules):
+				record.status = CHANGED
+				rule.ruleSet = self.getRuleSet(record.ruleset)
+			elif(rule.ruleSet.name != record.ruleset):
 				sourceSet = rule.ruleSet
-				destSet = self.getRuleSet(raw[5])
+				destSet = self.getRuleSet(record.ruleset)
 				if(changeRuleSet):
 					moved = True
-					status = self.CHANGED
-					rule.ruleSet = self.ruleSets[raw[5]][1]
+					record.status = CHANGED
+					rule.ruleSet = destSet
 				else:
 					moved = False
 				ruleChanges.append(RuleChanges(rule=rule, originalSet=sourceSet, newSet=destSet, update=self.update, moved=moved))
 
-			if(rule.ruleClass.classtype != raw[6]):
-				status = self.CHANGED
-				rule.ruleClass = self.getRuleClass(raw[6])
+			if(rule.ruleClass.classtype != record.classtype):
+				record.status = CHANGED
+				rule.ruleClass = self.getRuleClass(record.classtype)
 
 			# Update various other parametres if they are changed:
-			if(rule.active != raw[4]):
-				status = self.CHANGED
-				rule.active = raw[4]
-			if(rule.priority != raw[7]):
-				status = self.CHANGED
-				rule.priority = raw[7]
-			if(rule.generator_id != raw[8]):
-				status = self.CHANGED
-				rule.generator_id = raw[8]
+			active = record.active
+			if(rule.SID in self.createdRules):
+				active = activateNewRevisions and record.active
+			if(rule.active != active):
+				record.status = CHANGED
+				rule.active = active
+			if(rule.priority != record.priority):
+				record.status = CHANGED
+				rule.priority = record.priority
+			if(rule.generator_id != record.gid):
+				record.status = CHANGED
+				rule.generator_id = record.gid
 				
-			# If anything is saved in the Rule-object, save it:
-			if(status == self.CHANGED):
+			# If anything is changed in the Rule-object, save it:
+			if(record.status == CHANGED):
 				logger.debug("Updated %s" % str(rule))
-				rule.save()
-				self.rules[rule.SID] = [self.SAVED, rule]
-		RuleChanges.objects.bulk_create(ruleChanges)
+				changedRules.append(rule)
+			record.markSaved(rule)
+		bulkUpdate(Rule, changedRules, ["active", "generator", "ruleSet", "ruleClass", "priority", "fingerprint"], self.chunkSize)
+		bulkUpdate(RuleRevision, replacedRevisions, ["rev", "msg", "raw"], self.chunkSize)
+		# (A rule can be changed more than once in an update when it is streamed, so the last change wins).
+		bulkUpsert(RuleChanges, ruleChanges, ["rule", "update"], ["newSet", "moved"], self.chunkSize)
+		
+		# The rules which did not get a new revision still needs their fingerprint to be stored, so that
+		#   they can be skipped in the next update. The rules already exists, so only the fingerprint
+		#   is written by the upsert.
+		fingerprinted = []
+		for sid, record in unchanged.iteritems():
+			if(sid in fingerprints):
+				fingerprinted.append(Rule(SID=sid, active=record.active, generator_id=record.gid, 
+						ruleSet=self.getRuleSet(record.ruleset), ruleClass=self.getRuleClass(record.classtype),
+						priority=record.priority, fingerprint=fingerprints[sid]))
+		bulkUpsert(Rule, fingerprinted, ["SID"], ["fingerprint"], self.chunkSize)
 
 		# Create new Rule objects for all the new rules
 		newRuleObjects = []
-		for sid in newRules:
-			if(newRules[sid][5] != None):
-				newRuleObjects.append(Rule(SID=sid, active=(activateNewRevisions and newRules[sid][4]), 
-						ruleSet=self.getRuleSet(newRules[sid][5]), ruleClass=self.getRuleClass(newRules[sid][6]),
-						priority=newRules[sid][7], generator_id=newRules[sid][8]))
-		Rule.objects.bulk_create(newRuleObjects)
+		for sid, record in newRules.iteritems():
+			if(record.ruleset != None):
+				newRuleObjects.append(Rule(SID=sid, active=(activateNewRevisions and record.active), 
+						ruleSet=self.getRuleSet(record.ruleset), ruleClass=self.getRuleClass(record.classtype),
+						priority=record.priority, generator_id=record.gid, fingerprint=fingerprints[sid]))
+		bulkUpsert(Rule, newRuleObjects, ["SID"], [], self.chunkSize)
 
 		tms = []
-		newRuleIDs = Rule.objects.filter(SID__in = newRules).values_list("pk", flat=True).distinct()
-		for id in newRuleIDs:
-			tms.append(Update.rules.through(rule_id = id, update=self.update))
-		Update.rules.through.objects.bulk_create(tms)
-		
 		newSids = []
-		for rule in Rule.objects.filter(SID__in=newRules.keys()).all():
-			newSids.append(rule.SID)
-			raw = newRules[rule.SID]
-			self.rules[rule.SID] = [self.SAVED, rule]
-			newRevisions.append(RuleRevision(rule=rule, rev=raw[1], msg=raw[3], raw=raw[2], active=activateNewRevisions))
+		for chunk in chunks(newRules.keys(), self.chunkSize):
+			for rule in Rule.objects.filter(SID__in=chunk):
+				newSids.append(rule.SID)
+				record = newRules[rule.SID]
+				record.markSaved(rule)
+				self.revisedRules.add(rule.pk)
+				tms.append(Update.rules.through(rule_id = rule.pk, update=self.update))
+				newRevisions.append(RuleRevision(rule=rule, rev=record.rev, msg=record.msg, raw=record.raw, active=activateNewRevisions))
+		Update.rules.through.objects.bulk_create(tms)
+		self.changedRules.update(newSids + changedSIDs)
+		self.createdRules.update(newSids)
 		
 		# Store the new revisions to the database
 		RuleRevision.objects.bulk_create(newRevisions)
+		Rule.updateCurrentRevisions([r.rule_id for r in newRevisions], self.chunkSize)
 		logger.debug("Created %d new RuleRevision's" % len(newRevisions))
 		
 		# Add a relation between the new revisions, and the current update. 
-		newRevIDs = RuleRevision.objects.filter(rule__SID__in = newSids + changedSIDs).values_list("pk", flat=True).distinct()
 		tms = []
-		for revID in newRevIDs:
-			tms.append(Update.ruleRevisions.through(rulerevision_id = revID, update=self.update))
+		for pk, rev in self.getLatestRevisions(newSids + changedSIDs, withPk=True).itervalues():
+			tms.append(Update.ruleRevisions.through(rulerevision_id = pk, update=self.update))
 		Update.ruleRevisions.through.objects.bulk_create(tms)
 
 		# If the config states so, retrieve the rule-objects of all the rules that have not been changed yet.
 		if(Config.get("update", "cacheUnchangedRules") == "true"):
-			for rule in Rule.objects.filter(SID__in=unchanged.keys()).all():
-				self.rules[rule.SID] = [self.SAVED, rule]
+			for chunk in chunks(unchanged.keys(), self.chunkSize):
+				for rule in Rule.objects.filter(SID__in=chunk):
+					unchanged[rule.SID].markSaved(rule)
 			
 	def saveReferences(self):
 		logger = logging.getLogger(__name__)
-		#self.references[key] = [self.RAW, (referenceType, reference, sid)]
 
 		# Create a list over the references that needs processing, and a list over the SID's
 		#   that theese references should reffer to.
 		newReferences = {}
-		for ref in self.references:
-			if(self.references[ref][0] == self.RAW):
+		for record in self.references.itervalues():
+			# The references in the rulestring is covered by the fingerprint, so rules with an
+			#   unchanged fingerprint have the same of them as before. References from sid-msg.map
+			#   is not, and is always checked.
+			if(record.status == RAW and not (record.inRule and record.sid in self.unchangedRules)):
 				try:
-					newReferences[self.references[ref][1][2]].append(self.references[ref][1])
+					newReferences[record.sid].append(record)
 				except KeyError:
-					newReferences[self.references[ref][1][2]] = [self.references[ref][1]]
+					newReferences[record.sid] = [record]
 
 		# Create a overview of the primary-key for the latest RuleRevision objects related
 		#   to the rules the reference-objects should relate to.
-		latestRevisions = {}
+		latestRevisions = self.getLatestRevisions(newReferences.keys(), withPk=True)
 		sidLookup = {}
-		revisions = RuleRevision.objects.filter(rule__SID__in=newReferences.keys()).values("pk", "rule__SID", "rev").all()
-		for revision in revisions:
-			sidLookup[revision["pk"]] = revision["rule__SID"]
-			try:
-				if(latestRevisions[revision["rule__SID"]][1] < revision["rev"]):
-					latestRevisions[revision["rule__SID"]] = (revision["pk"], revision["rev"])
-			except KeyError:
-				latestRevisions[revision["rule__SID"]] = (revision["pk"], revision["rev"])
-		pklist = [x[0] for x in latestRevisions.values()]
+		for sid, (pk, rev) in latestRevisions.iteritems():
+			sidLookup[pk] = sid
 		
 		# Remover the existing references from the newReferences dict.
-		for reference in RuleReference.objects.filter(rulerevision_id__in = pklist).all():
-			sid = sidLookup[reference.rulerevision_id]
-			try:
-				for e in newReferences[sid]:
-					if(e[1] == reference.reference):
-						newReferences[sid].remove(e)
-				if(len(newReferences[sid]) == 0):
-					newReferences.pop(sid)
-			except:
-				pass
+		for chunk in chunks(sidLookup.keys(), self.chunkSize):
+			for reference in RuleReference.objects.filter(rulerevision_id__in = chunk):
+				sid = sidLookup[reference.rulerevision_id]
+				try:
+					for e in newReferences[sid]:
+						if(e.reference == reference.reference):
+							newReferences[sid].remove(e)
+							e.markSaved(reference)
+					if(len(newReferences[sid]) == 0):
+						newReferences.pop(sid)
+				except:
+					pass
 		
 		# Create new references for whatever references that did not exist already.
 		objects = []
@@ -740,59 +891,126 @@ class Updater():
 
 			for ref in newReferences[l]:
 				try:
-					objects.append(RuleReference(reference=ref[1], referenceType=self.referenceTypes[ref[0]][1], rulerevision_id=revID))
+					objects.append(RuleReference(reference=ref.reference, referenceType=self.referenceTypes[ref.referenceType].obj, rulerevision_id=revID))
 				except KeyError:
 					logger.error("Could not add reference: %s" % str(ref))
-		RuleReference.objects.bulk_create(objects)
+		bulkUpsert(RuleReference, objects, ["reference", "referenceType", "rulerevision"], [], self.chunkSize)
 		
 	def saveSuppress(self):
+		logger = logging.getLogger(__name__)
 		allSensor = Sensor.objects.get(name="All")
 		newSuppress = {}	
 
-		for suppress in self.suppress.keys():
-			newSuppress[suppress] = self.suppress[suppress][1]
+		for sid, record in self.suppress.iteritems():
+			newSuppress[sid] = record
 
-		for suppress in Suppress.objects.filter(rule__SID__in=newSuppress.keys()).filter(sensor=allSensor).select_related('rule').all():
-			status = self.SAVED
-			if(self.suppress[suppress.rule.SID][1][1] == "by_src"):
+		changed = []
+		currentSuppress = []
+		for chunk in chunks(newSuppress.keys(), self.chunkSize):
+			currentSuppress.extend(Suppress.objects.filter(rule__SID__in=chunk).filter(sensor=allSensor).select_related('rule'))
+		
+		for suppress in currentSuppress:
+			record = newSuppress.pop(suppress.rule.SID)
+			if(record.track == "by_src"):
 				track = Suppress.SOURCE
 			else:
 				track = Suppress.DESTINATION
 			
 			if(suppress.track != track):
-				status = self.CHANGED
+				record.status = CHANGED
 				suppress.track = track
+				changed.append(suppress)
 			
-			#TODO: Check every item in the suppress.addresses list to see if any changed.
-			if(len(self.suppress[suppress.rule.SID][1][2]) != suppress.addresses.count()):
-				status = self.CHANGED
-				suppress.addresses = []
-				for address in self.suppress[suppress.rule.SID][1][2]:
-					# TODO: Try to bulk-insert this, even though it is a ManyToMany relation
-					suppress.addresses.create(ipAddress=address)
-			
-			if(status == self.CHANGED):
-				suppress.save()
-			
-			self.suppress[suppress.rule.SID] = [status, suppress]
-			newSuppress.pop(suppress.rule.SID)
+			record.markSaved(suppress)
+		bulkUpdate(Suppress, changed, ["track"], self.chunkSize)
+		if(changed):
+			self.tuningChanged = True
+		currentSuppress = dict([(s.pk, s.rule.SID) for s in currentSuppress])
 		
 		objects = []
-		for suppress in newSuppress:
-			if(self.suppress[suppress][1][1] == "by_src"):
+		rules = self.resolveRules(newSuppress.keys())
+		for sid, record in newSuppress.items():
+			if(sid not in rules):
+				logger.error("Could not add suppress, as rule %d is not found" % sid)
+				newSuppress.pop(sid)
+				continue
+			
+			if(record.track == "by_src"):
 				track = Suppress.SOURCE
 			else:
 				track = Suppress.DESTINATION
 
-			objects.append(Suppress(rule=self.rules[suppress][1], sensor=allSensor, track=track, comment=self.getComment()))
+			objects.append(Suppress(rule=rules[sid], sensor=allSensor, track=track, comment=self.getComment()))
 		Suppress.objects.bulk_create(objects)
+		if(objects):
+			self.tuningChanged = True
 		
-		for s in Suppress.objects.filter(rule__SID__in = newSuppress).select_related('rule').all():
-			self.suppress[s.rule.SID] = [self.SAVED, s]
+		for chunk in chunks(newSuppress.keys(), self.chunkSize):
+			for s in Suppress.objects.filter(rule__SID__in = chunk).filter(sensor=allSensor).select_related('rule'):
+				newSuppress[s.rule.SID].markSaved(s)
 		
-		for suppress in newSuppress:
-			for address in newSuppress[suppress]:
-				self.suppress[suppress][1].addresses.create(ipAddress=address)
+		self.saveSuppressAddresses(currentSuppress)
+	
+	def saveSuppressAddresses(self, existing):
+		"""Makes the addresses of the saved suppresses in the cache match the addresses recieved in
+		the update. The addresses currently linked to the suppresses in existing (a dictionary 
+		mapping Suppress.pk to SID) are diffed against the new addresses, so that only the links
+		that is really added or removed is written, in bulk.
+		
+		An address is stored as one SuppressAddress object per IP, which is shared by all the
+		suppresses using that IP."""
+		logger = logging.getLogger(__name__)
+		throughModel = SuppressAddress.suppress.through
+		
+		# The addresses each of the suppresses should have after the update.
+		wanted = {}
+		for record in self.suppress.itervalues():
+			if(record.status != RAW):
+				wanted[record.obj.pk] = set(record.addresses or [])
+		
+		# The addresses the existing suppresses currently have.
+		current = {}
+		for chunk in chunks(existing.keys(), self.chunkSize):
+			for link in throughModel.objects.filter(suppress_id__in = chunk).values_list("pk", "suppress_id", "suppressaddress__ipAddress"):
+				current.setdefault(link[1], {})[link[2]] = link[0]
+		
+		# Find the links to add and to remove.
+		additions = []
+		removals = []
+		for pk, addresses in wanted.iteritems():
+			links = current.get(pk, {})
+			for address in addresses.difference(links):
+				additions.append((pk, address))
+			for address in set(links).difference(addresses):
+				removals.append(links[address])
+			if(pk in existing and (addresses != set(links))):
+				self.suppress[existing[pk]].status = CHANGED
+		
+		for chunk in chunks(removals, self.chunkSize):
+			throughModel.objects.filter(pk__in = chunk).delete()
+		logger.debug("Removed %d addresses from suppresses" % len(removals))
+		
+		if(removals or additions):
+			self.tuningChanged = True
+		if(len(additions) == 0):
+			return
+		
+		# Find the SuppressAddress objects which already exists for the addresses, and create the rest.
+		addressIDs = {}
+		ips = set([a[1] for a in additions])
+		for chunk in chunks(ips, self.chunkSize):
+			for pk, ip in SuppressAddress.objects.filter(ipAddress__in = chunk).values_list("pk", "ipAddress"):
+				addressIDs[ip] = pk
+		
+		missing = ips.difference(addressIDs)
+		SuppressAddress.objects.bulk_create([SuppressAddress(ipAddress=ip) for ip in missing])
+		for chunk in chunks(missing, self.chunkSize):
+			for pk, ip in SuppressAddress.objects.filter(ipAddress__in = chunk).values_list("pk", "ipAddress"):
+				addressIDs[ip] = pk
+		
+		throughModel.objects.bulk_create([throughModel(suppress_id = pk, suppressaddress_id = addressIDs[ip]) 
+				for pk, ip in additions])
+		logger.debug("Added %d addresses to suppresses" % len(additions))
 	
 	def saveFilters(self):
 		logger = logging.getLogger(__name__)
@@ -803,101 +1021,332 @@ class Updater():
 		# Find all the filters that is "RAW", and sort them in one list for each filtertype.
 		newEventFilters = {}
 		newDetectionFilters = {}
-		for filter in self.filters:
-			if (filter.startswith("DF") and self.filters[filter][0] == self.RAW):
-				newDetectionFilters[self.filters[filter][1][0]] = self.filters[filter][1]
-			elif (filter.startswith("EF") and self.filters[filter][0] == self.RAW):
-				newEventFilters[self.filters[filter][1][0]] = self.filters[filter][1]
+		for (kind, sid), record in self.filters.iteritems():
+			if (kind == FilterRecord.DETECTION and record.status == RAW):
+				newDetectionFilters[sid] = record
+			elif (kind == FilterRecord.EVENT and record.status == RAW):
+				newEventFilters[sid] = record
 				
 		# Try to collect existing filters from the database:
-		currentEventFilters = EventFilter.objects.filter(rule__SID__in = newEventFilters.keys()).select_related('rule').all()
-		currentDetectionFilters = DetectionFilter.objects.filter(rule__SID__in = newDetectionFilters.keys()).select_related('rule').all()
+		currentEventFilters = []
+		for chunk in chunks(newEventFilters.keys(), self.chunkSize):
+			currentEventFilters.extend(EventFilter.objects.filter(rule__SID__in = chunk).filter(sensor=allSensor).select_related('rule'))
+		currentDetectionFilters = []
+		for chunk in chunks(newDetectionFilters.keys(), self.chunkSize):
+			currentDetectionFilters.extend(DetectionFilter.objects.filter(rule__SID__in = chunk).filter(sensor=allSensor).select_related('rule'))
 		
 		# Update the filters that already exists.
+		changed = []
 		for f in currentEventFilters:
-			status = self.SAVED
-			raw = newEventFilters.pop(f.rule.SID)
+			record = newEventFilters.pop(f.rule.SID)
 			
-			if(f.eventFilterType != filterTypes[raw[4]]):
-				status = self.CHANGED
-				f.eventFilterType = filterTypes[raw[4]]
-			if(f.track != trackIDs[raw[1]]):
-				status = self.CHANGED
-				f.track = trackIDs[raw[1]]
-			if(f.count != raw[2]):
-				status = self.CHANGED
-				f.count = raw[2]
-			if(f.seconds != raw[3]):
-				status = self.CHANGED
-				f.seconds = raw[3]
+			if(f.eventFilterType != filterTypes[record.filterType]):
+				record.status = CHANGED
+				f.eventFilterType = filterTypes[record.filterType]
+			if(f.track != trackIDs[record.track]):
+				record.status = CHANGED
+				f.track = trackIDs[record.track]
+			if(f.count != record.count):
+				record.status = CHANGED
+				f.count = record.count
+			if(f.seconds != record.seconds):
+				record.status = CHANGED
+				f.seconds = record.seconds
 			
-			if(status == self.CHANGED):
-				status = self.SAVED
-				f.save()
-		
+			if(record.status == CHANGED):
+				changed.append(f)
+			record.markSaved(f)
+		bulkUpdate(EventFilter, changed, ["eventFilterType", "track", "count", "seconds"], self.chunkSize)
+		if(changed):
+			self.tuningChanged = True
+		
+		changed = []
 		for f in currentDetectionFilters:
-			status = self.SAVED
-			raw = newDetectionFilters.pop(f.rule.SID)
+			record = newDetectionFilters.pop(f.rule.SID)
 			
-			if(f.track != trackIDs[raw[1]]):
-				status = self.CHANGED
-				f.track = trackIDs[raw[1]]
-			if(f.count != raw[2]):
-				status = self.CHANGED
-				f.count = raw[2]
-			if(f.seconds != raw[3]):
-				status = self.CHANGED
-				f.seconds = raw[3]
+			if(f.track != trackIDs[record.track]):
+				record.status = CHANGED
+				f.track = trackIDs[record.track]
+			if(f.count != record.count):
+				record.status = CHANGED
+				f.count = record.count
+			if(f.seconds != record.seconds):
+				record.status = CHANGED
+				f.seconds = record.seconds
 			
-			if(status == self.CHANGED):
-				status = self.SAVED
-				f.save()
+			if(record.status == CHANGED):
+				changed.append(f)
+			record.markSaved(f)
+		bulkUpdate(DetectionFilter, changed, ["track", "count", "seconds"], self.chunkSize)
+		if(changed):
+			self.tuningChanged = True
 		
 		# Create the filters that is new.
+		rules = self.resolveRules(newEventFilters.keys() + newDetectionFilters.keys())
 		objects = []
-		for f in newEventFilters:
-			rule = self.getRule(f)
+		for sid, record in newEventFilters.iteritems():
+			try:
+				rule = rules[sid]
+			except KeyError:
+				logger.error("Could not add event_filter, as rule %d is not found" % sid)
+				continue
 			objects.append(EventFilter(rule=rule, 
 					sensor=allSensor, 
-					eventFilterType=filterTypes[newEventFilters[f][4]], 
-					track=trackIDs[newEventFilters[f][1]], 
-					count=newEventFilters[f][2], 
-					seconds=newEventFilters[f][3],
+					eventFilterType=filterTypes[record.filterType], 
+					track=trackIDs[record.track], 
+					count=record.count, 
+					seconds=record.seconds,
 					comment=self.getComment()))
-		EventFilter.objects.bulk_create(objects)
+		bulkUpsert(EventFilter, objects, ["rule", "sensor"], ["eventFilterType", "track", "count", "seconds"], self.chunkSize)
 		logger.debug("Created %d new EventFilter's" % len(objects))
+		if(objects):
+			self.tuningChanged = True
 			
 		objects = []
-		for f in newDetectionFilters:
-			rule = self.getRule(f)
+		for sid, record in newDetectionFilters.iteritems():
+			try:
+				rule = rules[sid]
+			except KeyError:
+				logger.error("Could not add detection_filter, as rule %d is not found" % sid)
+				continue
 			objects.append(DetectionFilter(rule=rule, 
 					sensor=allSensor, 
-					track=trackIDs[newDetectionFilters[f][1]], 
-					count=newDetectionFilters[f][2], 
-					seconds=newDetectionFilters[f][3],
+					track=trackIDs[record.track], 
+					count=record.count, 
+					seconds=record.seconds,
 					comment=self.getComment()))
-		DetectionFilter.objects.bulk_create(objects)
+		bulkUpsert(DetectionFilter, objects, ["rule", "sensor"], ["track", "count", "seconds"], self.chunkSize)
 		logger.debug("Created %d new DetectionFilter's" % len(objects))
+		if(objects):
+			self.tuningChanged = True
+		
+	def getChangePlan(self):
+		"""Compares the data in the cache with the database, and returns a description of what
+		saveAll would have done, without writing anything to the database. The plan is a
+		dictionary (which can be serialized to JSON) with a "counts" summary, and the lists of
+		SID's/names for each kind of change."""
+
+		self.resolvePendingMessages()
+		plan = {}
+
+		# Rules: Split the raw rules on fingerprint and revision, like saveRules does.
+		fingerprints = {}
+		records = {}
+		for sid, record in self.rules.iteritems():
+			if(record.status == RAW and record.rev != None):
+				records[sid] = record
+				fingerprints[sid] = Rule.calculateFingerprint(record.raw, record.msg, record.classtype,
+						record.ruleset, record.priority, record.active, record.gid)
+
+		skipped = 0
+		for chunk in chunks(fingerprints.keys(), self.chunkSize):
+			for sid, fingerprint in Rule.objects.filter(SID__in = chunk).exclude(fingerprint=None).values_list("SID", "fingerprint"):
+				if(fingerprints[sid] == fingerprint):
+					records.pop(sid)
+					skipped += 1
+
+		new, updated, unchanged = self.compareRevisions(records)
+		moved = []
+		reclassified = []
+		for chunk in chunks(updated.keys(), self.chunkSize):
+			for sid, ruleSet, classtype in Rule.objects.filter(SID__in = chunk).values_list("SID", "ruleSet__name", "ruleClass__classtype"):
+				if(ruleSet != updated[sid].ruleset):
+					moved.append(sid)
+				if(classtype != updated[sid].classtype):
+					reclassified.append(sid)
+		plan["rules"] = {"new": sorted(new), "updated": sorted(updated), "moved": sorted(moved),
+				"reclassified": sorted(reclassified), "unchanged": len(unchanged), "fingerprintUnchanged": skipped}
+
+		# RuleSets, classes, generators and reference-types: New are the ones not in the database, and
+		#   changed the ones where any of the attributes differ.
+		names = [n for n, r in self.ruleSets.iteritems() if r.status == RAW]
+		existing = set()
+		for chunk in chunks(names, self.chunkSize):
+			existing.update(RuleSet.objects.filter(name__in = chunk).values_list("name", flat=True))
+		plan["ruleSets"] = {"new": sorted(set(names).difference(existing))}
+
+		plan["classes"] = self.getChangedObjects(self.classes, RuleClass, "classtype", ["description", "priority"])
+		plan["referenceTypes"] = self.getChangedObjects(self.referenceTypes, RuleReferenceType, "name", ["urlPrefix"])
+
+		generators = dict([(k, r) for k, r in self.generators.iteritems() if r.status == RAW])
+		current = {}
+		for key, (pk, message) in getExistingRows(Generator, ["GID", "alertID"], ["message"], generators.keys(), self.chunkSize).iteritems():
+			current[key] = message
+		plan["generators"] = {
+			"new": ["%d:%d" % k for k in sorted(generators) if k not in current],
+			"changed": ["%d:%d" % k for k in sorted(generators) if k in current and current[k] != generators[k].message],
+		}
+
+		# Filters and suppresses are compared with the ones for the "All" sensor.
+		allSensor = Sensor.objects.get(name="All")
+		filterTypes = {"limit": 1, "threshold": 2, "both": 3}
+		trackIDs = {"by_src": 1, "by_dst": 2}
+		for kind, model, key, fields in [(FilterRecord.EVENT, EventFilter, "eventFilters", ["eventFilterType", "track", "count", "seconds"]),
+				(FilterRecord.DETECTION, DetectionFilter, "detectionFilters", ["track", "count", "seconds"])]:
+			wanted = {}
+			for (k, sid), r in self.filters.iteritems():
+				if(k == kind and r.status == RAW):
+					wanted[sid] = (filterTypes.get(r.filterType), trackIDs[r.track], r.count, r.seconds)[-len(fields):]
+			current = {}
+			for chunk in chunks(wanted.keys(), self.chunkSize):
+				for values in model.objects.filter(rule__SID__in = chunk, sensor = allSensor).values_list("rule__SID", *fields):
+					current[values[0]] = tuple(values[1:])
+			plan[key] = {
+				"new": sorted([sid for sid in wanted if sid not in current]),
+				"changed": sorted([sid for sid in wanted if sid in current and current[sid] != wanted[sid]]),
+			}
+
+		wanted = dict([(sid, r) for sid, r in self.suppress.iteritems() if r.status == RAW])
+		current = {}
+		for chunk in chunks(wanted.keys(), self.chunkSize):
+			for pk, sid, track in Suppress.objects.filter(rule__SID__in = chunk, sensor = allSensor).values_list("pk", "rule__SID", "track"):
+				current[pk] = (sid, track, set())
+		throughModel = SuppressAddress.suppress.through
+		for chunk in chunks(current.keys(), self.chunkSize):
+			for pk, ip in throughModel.objects.filter(suppress_id__in = chunk).values_list("suppress_id", "suppressaddress__ipAddress"):
+				current[pk][2].add(ip)
+		changed = []
+		for sid, track, addresses in current.itervalues():
+			record = wanted.pop(sid)
+			if(track != {"by_src": Suppress.SOURCE}.get(record.track, Suppress.DESTINATION) or addresses != set(record.addresses or [])):
+				changed.append(sid)
+		plan["suppresses"] = {"new": sorted(wanted), "changed": sorted(changed)}
+
+		# Summarize the plan.
+		counts = {}
+		for key, changes in plan.iteritems():
+			for change, value in changes.iteritems():
+				counts["%s.%s" % (key, change)] = value if type(value) == int else len(value)
+		plan["counts"] = counts
+
+		return plan
+
+	def getChangedObjects(self, cache, model, keyField, fields):
+		"""Used by getChangePlan to compare the raw records in cache (keyed by the value of keyField)
+		with the objects of model in the database. Returns a dictionary with the sorted lists of
+		"new" and "changed" keys."""
+
+		records = dict([(k, r) for k, r in cache.iteritems() if r.status == RAW])
+		current = {}
+		for chunk in chunks(records.keys(), self.chunkSize):
+			filterArgs = {"%s__in" % keyField: chunk}
+			for values in model.objects.filter(**filterArgs).values_list(keyField, *fields):
+				current[values[0]] = tuple(values[1:])
+
+		changed = []
+		for key, values in current.iteritems():
+			if(values != tuple([getattr(records[key], f) for f in fields])):
+				changed.append(key)
+		return {"new": sorted([k for k in records if k not in current]), "changed": sorted(changed)}
+
+	def flushRules(self):
+		"""Used in streaming-mode to save the rules in the cache, and remove them from the cache.
+		The generators, classes, reference-types and rulesets the rules depend on is saved first,
+		and the references and filters of the rules is saved after them. The chunk is saved in
+		a single transaction, while holding the ApplyLock. The chunk is not saved if the
+		update-lock of the source is lost."""
+		logger = logging.getLogger(__name__)
 		
+		sids = set(self.rules.keys())
+		with ApplyLock(), transaction.atomic():
+			SourceLock.refreshHeld(self.update.source)
+			self.saveGenerators()
+			self.saveClasses()
+			self.saveReferenceTypes()
+			self.saveRuleSets()
+			self.saveRules()
+			self.saveReferences()
+			self.saveFilters()
+			self.recordChanges()
+		
+		# Remove the saved rules, and their references and filters, from the cache. The cache is
+		#   emptied completely, as saving the chunk might have added records for rules outside
+		#   it (rules with a new message from sid-msg.map, and rules cached for their filters).
+		self.rules = {}
+		self.flushedRules.update(sids)
+		for key in [k for k, r in self.references.iteritems() if r.sid in sids]:
+			self.references.pop(key)
+		for key in [k for k in self.filters if k[1] in sids]:
+			self.filters.pop(key)
+		
+		logger.info("Saved a chunk of %d rules" % len(sids))
+	
 	def saveAll(self):
-		"""Saves all the raw-data in the cache, in the required order"""
-		
-		UpdateLog.objects.create(update=self.update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="80 Saving the Generators")
-		self.saveGenerators()
-		UpdateLog.objects.create(update=self.update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="81 Saving the Classifications")
-		self.saveClasses()
-		UpdateLog.objects.create(update=self.update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="82 Saving the ReferenceTypes")
-		self.saveReferenceTypes()
-		UpdateLog.objects.create(update=self.update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="83 Saving the RuleSets")
-		self.saveRuleSets()
-		UpdateLog.objects.create(update=self.update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="85 Saving the Rules")
-		self.saveRules()
-		UpdateLog.objects.create(update=self.update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="90 Saving the References")
-		self.saveReferences()
-		UpdateLog.objects.create(update=self.update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="95 Saving the Suppresses")
-		self.saveSuppress()
-		UpdateLog.objects.create(update=self.update, time=datetime.datetime.now(), logType=UpdateLog.PROGRESS, text="96 Saving the Filters")
-		self.saveFilters()
+		"""Saves all the raw-data in the cache, in the required order. Everything is saved
+		in a single transaction, so that the update is either applied completely, or not
+		at all. (The progress is still visible to the webinterface while saving, trough the
+		state-file of the ProgressReporter). Only one update at the time is saving to the database,
+		as the ApplyLock is held while saving. Nothing is saved if the update-lock of the source is
+		lost to another update."""
+		
+		progress = ProgressReporter.forUpdate(self.update)
+		progress.progress("79 Waiting for other updates to finish saving")
+		with ApplyLock(), transaction.atomic():
+			SourceLock.refreshHeld(self.update.source)
+			progress.progress("80 Saving the update to the database")
+			progress.progress("80 Saving the Generators")
+			self.saveGenerators()
+			progress.progress("81 Saving the Classifications")
+			self.saveClasses()
+			progress.progress("82 Saving the ReferenceTypes")
+			self.saveReferenceTypes()
+			progress.progress("83 Saving the RuleSets")
+			self.saveRuleSets()
+			progress.progress("85 Saving the Rules")
+			self.saveRules()
+			progress.progress("90 Saving the References")
+			self.saveReferences()
+			progress.progress("95 Saving the Suppresses")
+			self.saveSuppress()
+			progress.progress("96 Saving the Filters")
+			self.saveFilters()
+			progress.progress("98 Removing old revisions")
+			self.compactRevisions()
+			self.saveFiles()
+			self.recordChanges()
+		self.logMemoryUsage()
+	
+	def saveFiles(self):
+		"""Stores the checksums of the parsed update-files."""
+		files = [UpdateFile(name=name, source=self.update.source, checksum=checksum, isParsed=True) 
+				for name, checksum in self.files.iteritems()]
+		bulkSave(UpdateFile, files, ["name", "source"], ["checksum", "isParsed"], self.chunkSize)
+	
+	def recordChanges(self):
+		"""Records the rules saved since the last call in the change-log, and the tuning of the
+		"All" sensor if any filters or suppresses is created or changed since the last call. It
+		is called last in the transaction, so that the changes is recorded as close to the commit
+		as possible."""
+		if(self.changedRules):
+			Change.record(Change.RULE, SIDs=self.changedRules)
+			self.changedRules = set()
+		if(self.tuningChanged):
+			Change.record(Change.TUNING, sensor=Sensor.objects.get(name="All").pk)
+			self.tuningChanged = False
+	
+	def compactRevisions(self):
+		"""Deletes the revisions exceeding the maxRevisions limit from the rules which got a new 
+		revision in this update."""
+		
+		maxRevisions = int(Config.get("update", "maxRevisions"))
+		deleted, seconds = RuleRevision.compactRevisions(maxRevisions, list(self.revisedRules), self.chunkSize)
+		if(deleted > 0):
+			ProgressReporter.forUpdate(self.update).message("Removed %d old rule-revisions in %.2f seconds" % (deleted, seconds))
+	
+	def logMemoryUsage(self):
+		"""Stores the peak memory-usage of the update-process (and of the parser-processes, if
+		any are used) in the UpdateLog."""
+		logger = logging.getLogger(__name__)
+		
+		# ru_maxrss is given in kilobytes.
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+		children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+		
+		text = "Peak memory usage: %.1f MB" % peak
+		if(children > 0):
+			text += " (parser-processes: %.1f MB)" % children
+		logger.info(text)
+		ProgressReporter.forUpdate(self.update).message(text)
 	
 	def debug(self):
 		""" Simple debug-method dumping all the data to stdout. """
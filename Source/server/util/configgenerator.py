@@ -9,7 +9,7 @@ import tempfile
 import tarfile
 
 from core.models import Sensor, RuleSet, RuleClass, Generator, RuleReferenceType
-from tuning.tools import getDetectionFilter, getEventFilter, getSuppress
+from tuning.tools import resolveTuning
 from util.configfile import ConfigFile
 
 class ConfigGenerator:
@@ -72,30 +72,21 @@ class ConfigGenerator:
 		filters = ConfigFile(os.path.join(self.configlocation, "filters.conf"))
 		suppresses = ConfigFile(os.path.join(self.configlocation, "suppress.conf"))
 		
-		# Get the rulesets applied to this sensor:
-		sets = {x.name: x for x in self.sensor.ruleSets.filter(active=True).all()}
-
-		# Get the rulesets applied to any parent sensor:
-		s = self.sensor.parent
-		while s != None:
-			sets.update({x.name: x for x in s.ruleSets.filter(active=True).all()})
-			s = s.parent
-
-		# Get all child-rulesets of the rulesets we already have found.
-		ruleSets = {}
-		for s in sets:
-			ruleSets.update({x.name: x for x in sets[s].getChildSets()})
-			ruleSets[s] = sets[s]
-		
-		# For every set we found, create a corresponding rules file
-		for setname in ruleSets:
+		# For every set applied to this sensor (or its parents), and their child-rulesets, create a 
+		#   corresponding rules file
+		for ruleSet in self.sensor.effectiveRuleSets.all():
+			setname = ruleSet.name
 			ruleFile = ConfigFile(os.path.join(self.configlocation, "%s.rules" % setname))
 
-			for rule in ruleSets[setname].rules.filter(active=True).all():
+			# Get the rules, and the filters and suppresses in effect for them on this sensor.
+			rules = list(ruleSet.rules.filter(active=True).select_related("currentRevision").all())
+			dFilters, eFilters, suppressList = resolveTuning(self.sensor, rules)
+			
+			for rule in rules:
 				rev = rule.getCurrentRevision()
-				dFilter = getDetectionFilter(self.sensor, rule)
-				eFilter = getEventFilter(self.sensor, rule)
-				suppress = getSuppress(self.sensor, rule)
+				dFilter = dFilters.get(rule.pk)
+				eFilter = eFilters.get(rule.pk)
+				suppress = suppressList.get(rule.pk)
 				
 				# If the rule have a detectionFilter, inject it into the rule-string:
 				if(dFilter):
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+"""
+util.manifestcache
+
+The manifest of a sensor is the list of rules it should have: The SID, rev and current
+revision of every active rule in its effective rulesets. Sensors with the same effective
+rulesets have the same manifest, so snowmand keeps the manifests in a ManifestCache shared by
+all the sessions, keyed by the effective rulesets and the data-generation.
+
+The generation is the settled sequence-number of the rule-changes in the change-log (see
+Change.getSequence); every change up to it is committed. Later changes may still be on their
+way, as the sequence-numbers is assigned before the changes are committed, so the manifest
+remembers how many changes after its generation it have seen. When more of them turns up, the
+current state of their rules is applied on top of the cached manifest, like getChangesSince
+does for a sensor. The manifest of a generation is thereby built once, also while the changes
+of an update is settling, and changes to the tuning or to the rulesets of the sensors does not
+give a new generation.
+
+The manifests are stored as sorted arrays of integers rather than as Django objects, and the
+cache is limited to [xmlrpc-server] manifestCacheSize megabytes. The least recently used
+manifests are evicted first.
+"""
+
+import array
+import bisect
+import collections
+import heapq
+import logging
+import threading
+
+from django.db import models
+
+from core.models import Change, Rule, RuleRevision
+from util.config import Config
+from util.tools import chunks
+
+class Manifest(object):
+	"""The rules a set of rulesets contains, as four parallel arrays sorted by SID."""
+
+	def __init__(self, rows):
+		"""Creates the manifest from rows of (SID, rule pk, rev, revision pk), sorted by SID."""
+		self.sids = array.array("i")
+		self.rules = array.array("i")
+		self.revs = array.array("i")
+		self.revisions = array.array("i")
+		for sid, rule, rev, revision in rows:
+			self.sids.append(sid)
+			self.rules.append(rule)
+			self.revs.append(rev)
+			self.revisions.append(revision)
+
+		# The number of changes after the generation, and the latest of them, that the manifest
+		#   includes.
+		self.pending = (0, None)
+
+	def __len__(self):
+		return len(self.sids)
+
+	def getSize(self):
+		"""Returns the approximate memory used by the manifest, in bytes."""
+		return sum([a.itemsize * len(a) for a in [self.sids, self.rules, self.revs, self.revisions]])
+
+	def find(self, sid):
+		"""Returns the index of sid in the arrays, or None if the SID is not in the manifest."""
+		i = bisect.bisect_left(self.sids, sid)
+		if(i < len(self.sids) and self.sids[i] == sid):
+			return i
+		return None
+
+	def getRevision(self, sid):
+		"""Returns the primary-key of the current revision of the rule sid, or None."""
+		i = self.find(sid)
+		return self.revisions[i] if i != None else None
+
+	def getRevisions(self):
+		"""Returns a dictionary mapping the SID's (as strings) to their rev."""
+		return dict([(str(sid), rev) for sid, rev in zip(self.sids, self.revs)])
+
+	def patch(self, ruleSets, sids):
+		"""Returns a copy of the manifest, where the rules sid in sids is replaced by their current
+		state in the rulesets with the primary-keys in ruleSets."""
+		sids = set(sids)
+		rows = [r for r in zip(self.sids, self.rules, self.revs, self.revisions) if r[0] not in sids]
+		rows.extend(Manifest.getRows(ruleSets, sids))
+		rows.sort()
+		return Manifest(rows)
+
+	@staticmethod
+	def getRows(ruleSets, sids = None, chunkSize = 500):
+		"""Returns the rows of (SID, rule pk, rev, revision pk) of the active rules in the rulesets
+		with the primary-keys in ruleSets, sorted by SID. Only the rules sid in sids is read, if
+		it is given."""
+		rules = Rule.objects.filter(ruleSet__in=ruleSets, active=True)
+		fields = ["SID", "pk", "currentRevision__rev", "currentRevision"]
+		if(sids == None):
+			rows = rules.exclude(currentRevision=None).order_by("SID").values_list(*fields).iterator()
+			missing = Manifest.getMissingRows(rules.filter(currentRevision=None).values_list("pk", flat=True), chunkSize)
+			return heapq.merge(rows, missing) if missing else rows
+		
+		rows = []
+		for chunk in chunks(sids, chunkSize):
+			rows.extend(rules.filter(SID__in=chunk).exclude(currentRevision=None).values_list(*fields))
+			rows.extend(Manifest.getMissingRows(rules.filter(SID__in=chunk, currentRevision=None).values_list("pk", flat=True), chunkSize))
+		return sorted(rows)
+	
+	@staticmethod
+	def getMissingRows(ruleIDs, chunkSize = 500):
+		"""Returns the rows of the rules in ruleIDs which is missing their currentRevision (as in a
+		database which is not upgraded yet), sorted by SID. Their latest active revision is looked
+		up instead, like Rule.getCurrentRevision does."""
+		rows = []
+		for chunk in chunks(list(ruleIDs), chunkSize):
+			latest = RuleRevision.objects.filter(rule__in=chunk, active=True).values("rule").annotate(models.Max("pk"))
+			revisions = [r["pk__max"] for r in latest]
+			rows.extend(RuleRevision.objects.filter(pk__in=revisions).values_list("rule__SID", "rule", "rev", "pk"))
+		return sorted(rows)
+
+	@staticmethod
+	def build(ruleSets):
+		"""Reads the manifest of the rulesets with the primary-keys in ruleSets from the database."""
+		return Manifest(Manifest.getRows(ruleSets))
+
+class ManifestCache(object):
+	"""A thread-safe LRU-cache of manifests. If several threads ask for the same manifest at the
+	same time, it is built by the first of them, while the others wait for it."""
+
+	def __init__(self, maxSize = None, settleTime = None):
+		if(maxSize == None):
+			maxSize = int(Config.get("xmlrpc-server", "manifestCacheSize")) * 1024 * 1024
+		self.maxSize = maxSize
+		self.settleTime = settleTime
+		self.size = 0
+		self.manifests = collections.OrderedDict()
+		self.building = {}
+		self.lock = threading.Lock()
+
+	def getKey(self, sensor):
+		"""Returns the key of the manifest of sensor: The effective rulesets, and the generation."""
+		ruleSets = frozenset(sensor.effectiveRuleSets.values_list("pk", flat=True))
+		return (ruleSets, Change.getSequence(self.settleTime, kind=Change.RULE))
+
+	def getPending(self, generation):
+		"""Returns the number of rule-changes after generation, and the latest of them."""
+		pending = Change.objects.filter(kind=Change.RULE, pk__gt=generation).aggregate(models.Count("pk"), models.Max("pk"))
+		return (pending["pk__count"], pending["pk__max"])
+
+	def get(self, sensor):
+		"""Returns the manifest of sensor, building it if it is not in the cache. The changes after
+		the generation which the cached manifest have not seen is applied to it."""
+		logger = logging.getLogger(__name__)
+		key = self.getKey(sensor)
+
+		# The pending changes is counted before the rules is read, so that changes committed
+		#   while the rules is read is applied by the next request.
+		pending = self.getPending(key[1])
+
+		while True:
+			with self.lock:
+				manifest = self.manifests.pop(key, None)
+				if(manifest != None):
+					self.manifests[key] = manifest
+					break
+
+				event = self.building.get(key)
+				if(event == None):
+					event = threading.Event()
+					self.building[key] = event
+					break
+
+			# Another thread is building the manifest. Wait for it, and look again (the manifest
+			#   is not in the cache if it failed, or was too large to be cached).
+			event.wait()
+
+		if(manifest != None):
+			if(manifest.pending[0] >= pending[0]):
+				return manifest
+			
+			# The rules of every change after the generation is read again, as it is not known
+			#   which of them the manifest have seen.
+			sids = Change.objects.filter(kind=Change.RULE, pk__gt=key[1]).values_list("SID", flat=True).distinct()
+			manifest = manifest.patch(key[0], list(sids))
+			manifest.pending = pending
+			logger.debug("Applied %d pending changes to the manifest of generation %d" % (pending[0], key[1]))
+			self.add(key, manifest)
+			return manifest
+
+		try:
+			manifest = Manifest.build(key[0])
+			manifest.pending = pending
+			logger.debug("Built a manifest of %d rules for generation %d" % (len(manifest), key[1]))
+			self.add(key, manifest)
+			return manifest
+		finally:
+			with self.lock:
+				self.building.pop(key, None)
+			event.set()
+
+	def add(self, key, manifest):
+		"""Stores the manifest (replacing an older version of it), and evicts the least recently
+		used manifests until the cache is within its size. The manifests of older generations is evicted at once, as they are never
+		asked for again."""
+		size = manifest.getSize()
+		if(size > self.maxSize):
+			return
+
+		with self.lock:
+			for k in [k for k in self.manifests if k[1] < key[1]]:
+				self.size -= self.manifests.pop(k).getSize()
+			while self.manifests and self.size + size > self.maxSize:
+				self.size -= self.manifests.popitem(last=False)[1].getSize()
+
+			# A manifest which have seen fewer of the pending changes is replaced.
+			previous = self.manifests.get(key)
+			if(previous != None and previous.pending[0] > manifest.pending[0]):
+				return
+			if(previous != None):
+				self.size -= previous.getSize()
+			self.manifests[key] = manifest
+			self.size += size
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+"""
+util.ruletokenizer
+
+A single-pass tokenizer for snort rulestrings. The rulestring is split into its
+header and its options once, and every value snowman cares about is pulled out
+of the resulting option-list. This replaces the set of regexes previously run
+against every rule-line during an update.
+"""
+
+import re
+
+from update.exceptions import AbnormalRuleError, BadFormatError
+
+# Options that are removed from the rulestring before it is stored, as they
+# are handled as separate filter-objects.
+FILTEROPTIONS = ("detection_filter", "threshold")
+
+# The options of a rule which snowman reads. The others is skipped by the tokenizer.
+OPTIONKEYS = frozenset(["gid", "sid", "rev", "msg", "classtype", "priority", "reference", "metadata"] + list(FILTEROPTIONS))
+
+# An option, up to and including its terminating semicolon. The groups is the text before the
+# first colon, the colon, and the value. Semicolons inside quoted strings, or escaped with a
+# backslash, is part of the value. The pattern is written so that it never backtracks over the
+# same text twice, as it is run against untrusted rulestrings.
+OPTION = re.compile(r'(?=([^:;"\\]*))\1(:?)([^;"\\]*(?:(?:\\.|"[^"\\]*(?:\\.[^"\\]*)*")[^;"\\]*)*);', re.DOTALL)
+
+class ParsedRule(object):
+	"""The structured result of tokenizing one rulestring.
+
+	== FIELDS ==
+	sid, rev, gid, priority: Integers (priority is None if not set).
+	msg, classtype: The alert message and the classification-name.
+	active: False if the rule is commented out.
+	ruleset: The ruleset named in the metadata-option, or None.
+	references: A list of (referenceType, reference) tuples.
+	detectionFilter: A (track, count, seconds) tuple, or None.
+	eventFilter: A (type, track, count, seconds) tuple, or None.
+	filters: The inline filter-options, as they appear in the rulestring.
+	raw: The rulestring, without filters and with normalized whitespace."""
+
+	__slots__ = ("sid", "rev", "gid", "msg", "classtype", "priority", "active", "ruleset",
+				"references", "detectionFilter", "eventFilter", "filters", "raw")
+
+	def __init__(self):
+		self.sid = None
+		self.rev = None
+		self.gid = 1
+		self.msg = None
+		self.classtype = None
+		self.priority = None
+		self.active = True
+		self.ruleset = None
+		self.references = []
+		self.detectionFilter = None
+		self.eventFilter = None
+		self.filters = ""
+		self.raw = None
+
+	def __getstate__(self):
+		"""ParsedRules are pickled as a plain tuple, to keep them compact when they are
+		passed between processes."""
+		return tuple(getattr(self, field) for field in self.__slots__)
+	
+	def __setstate__(self, state):
+		for field, value in zip(self.__slots__, state):
+			setattr(self, field, value)
+
+	def __repr__(self):
+		return "<ParsedRule SID:%s, rev:%s, active:%s, ruleset:%s, class:%s>" % (str(self.sid), str(self.rev),
+					str(self.active), str(self.ruleset), str(self.classtype))
+
+def splitOptions(raw, start, keys = OPTIONKEYS):
+	"""Splits the option-part of a rulestring, starting at the index start, into a list of
+	(key, value, begin, end) tuples. begin/end are the indexes of the option in raw,
+	including the terminating semicolon. Semicolons inside quoted strings, or escaped
+	with a backslash, does not terminate an option. Only the options with a key in keys
+	is returned."""
+
+	options = []
+	stop = raw.rfind(")")
+	if(stop < start):
+		stop = len(raw)
+
+	# The options-part is split on every semicolon. Most options contains neither quotes nor
+	#   backslashes, and is then exactly one of the pieces. The others is matched by OPTION,
+	#   which tells how many of the pieces they span.
+	pieces = raw[start:stop].split(";")
+	last = len(pieces) - 1
+	begin = start
+	i = 0
+	while i < last:
+		piece = pieces[i]
+		if('"' in piece or "\\" in piece):
+			match = OPTION.match(raw, begin, stop)
+			if(match == None):
+				break
+			end = match.end()
+			key, colon, value = match.groups()
+			if(value and not colon):
+				# The key contains a quote or a backslash.
+				key, colon, value = (key + value).rstrip(";").partition(":")
+			value = value.rstrip(";")
+			i += raw.count(";", begin, end)
+		else:
+			end = begin + len(piece) + 1
+			key, colon, value = piece.partition(":")
+			i += 1
+
+		key = key.strip().lower()
+		if key in keys:
+			options.append((key, value.strip(), begin + len(piece) - len(piece.lstrip()), end))
+		begin = end
+
+	# The last option is not required to be terminated by a semicolon.
+	if raw[begin:stop].strip():
+		option = makeOption(raw, begin, stop - 1)
+		if option[0] in keys:
+			options.append(option)
+
+	return options
+
+def makeOption(raw, begin, end):
+	"""Creates an option-tuple out of raw[begin:end+1]"""
+	text = raw[begin:end + 1]
+
+	# Skip leading whitespace, so that begin points at the option-keyword.
+	offset = len(text) - len(text.lstrip())
+	text = text.strip().rstrip(";")
+
+	key, colon, value = text.partition(":")
+	return (key.strip().lower(), value.strip(), begin + offset, end + 1)
+
+def parseFilterOption(value, keys):
+	"""Parses the value of an inline filter (eg: "type both, track by_src, count 1, seconds 60")
+	and returns a tuple with the values of keys, in the same order. None is returned if any of
+	the keys are missing."""
+
+	parametres = {}
+	for element in value.split(","):
+		parts = element.split(None, 1)
+		if(len(parts) == 2):
+			parametres[parts[0].lower()] = parts[1].strip()
+
+	try:
+		return tuple(parametres[key] for key in keys)
+	except KeyError:
+		return None
+
+def toInt(value, name, raw):
+	"""Converts value to an int, and raises a BadFormatError naming the option if it is not numeric."""
+	try:
+		return int(value)
+	except (ValueError, TypeError):
+		raise BadFormatError("Bad rule: %s is not numeric! Rulestring: %s" % (name, raw))
+
+def tokenizeRule(raw):
+	"""Tokenizes a raw rulestring, and returns a ParsedRule. If the string is not
+	a valid alert-rule (it misses the header, sid, rev, msg or classtype), None is
+	returned.
+
+	AbnormalRuleError is raised if the rule has a GID other than 1, and BadFormatError
+	is raised if any of the numeric options are not numeric."""
+
+	start = raw.find("(")
+	if(start < 0):
+		return None
+
+	rule = ParsedRule()
+	header = raw[:start]
+	options = splitOptions(raw, start + 1)
+
+	# Snowman is currently only handling rules with GID=1.
+	for key, value, begin, end in options:
+		if key == "gid":
+			rule.gid = toInt(value, "GID", raw)
+	if rule.gid != 1:
+		raise AbnormalRuleError
+
+	# A rule is an alert-rule, which might be commented out.
+	prefix, action, rest = header.partition("alert")
+	if(not action):
+		return None
+	rule.active = "#" not in prefix
+
+	removed = []
+	for key, value, begin, end in options:
+		if key == "sid":
+			rule.sid = value
+		elif key == "rev":
+			rule.rev = value
+		elif key == "msg":
+			if(len(value) >= 2 and value.startswith("\"") and value.endswith("\"")):
+				rule.msg = value[1:-1]
+		elif key == "classtype":
+			rule.classtype = value
+		elif key == "priority":
+			rule.priority = value
+		elif key == "reference":
+			referenceType, comma, reference = value.partition(",")
+			if comma:
+				rule.references.append((referenceType.strip(), reference.strip()))
+		elif key == "metadata":
+			for element in value.split(","):
+				parts = element.split(None, 1)
+				if(len(parts) == 2 and parts[0] == "ruleset"):
+					rule.ruleset = parts[1].strip()
+		elif key in FILTEROPTIONS:
+			removed.append((begin, end))
+			if key == "detection_filter":
+				rule.detectionFilter = parseFilterOption(value, ("track", "count", "seconds"))
+			else:
+				rule.eventFilter = parseFilterOption(value, ("type", "track", "count", "seconds"))
+
+	if(rule.sid == None or rule.rev == None or rule.msg == None or rule.classtype == None):
+		return None
+
+	rule.sid = toInt(rule.sid, "SID", raw)
+	rule.rev = toInt(rule.rev, "rev", raw)
+	if(rule.priority != None):
+		rule.priority = toInt(rule.priority, "priority", raw)
+
+	# Cut the filters out of the rulestring, and keep the last of each type, as they appear
+	# in the rulestring.
+	filters = {}
+	stripped = []
+	last = 0
+	for begin, end in removed:
+		stripped.append(raw[last:begin])
+		filters[raw[begin:end].partition(":")[0].strip().lower()] = raw[begin:end]
+		last = end
+	stripped.append(raw[last:])
+	rule.filters = "".join([filters[f] for f in FILTEROPTIONS if f in filters])
+
+	raw = "".join(stripped)
+	if not rule.active:
+		raw = raw.lstrip("# \t")
+	rule.raw = " ".join(raw.split())
+
+	return rule
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+"""
+util.sensorsync
+
+Asks many sensors to update their rules, in the background. A SyncJob is created by the
+webinterface, and run by the snowman-syncSensors script, so that the web-request returns at
+once. The sensors are contacted from a bounded pool of threads, optionally in waves and with
+a random delay before each request, so that the sensors does not all connect to snowmand at
+the same moment.
+
+The state of a job, with the result for every sensor, is kept in a small JSON-file which is
+replaced every time a sensor is finished. The webinterface reads it to show the status.
+"""
+
+import datetime
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+from core.models import Sensor
+from util.config import Config
+from util.tools import parallelMap
+
+class SyncJob(object):
+	"""A job asking a set of sensors to update their rules."""
+
+	# The states of a sensor in the job.
+	PENDING = "pending"
+	OK = "ok"
+	FAILED = "failed"
+
+	# Job-files older than this (in seconds) is deleted when new jobs are created.
+	keepFiles = 86400
+
+	@staticmethod
+	def create(sensors):
+		"""Creates a new job for the sensors, and stores its initial state. Returns the job."""
+		SyncJob.removeOldFiles()
+
+		job = SyncJob(uuid.uuid4().hex)
+		job.state = {"id": job.id, "started": str(datetime.datetime.now()), "finished": None, "sensors": {}}
+		for sensor in sensors:
+			job.state["sensors"][str(sensor.pk)] = {"name": sensor.name, "status": SyncJob.PENDING, "message": "", "time": None}
+		job.publish()
+		return job
+
+	@staticmethod
+	def load(jobID):
+		"""Returns the job with the id jobID, or None if there is no such job."""
+		if(re.match(r"^[0-9a-f]{32}$", str(jobID)) == None):
+			return None
+
+		job = SyncJob(jobID)
+		try:
+			with open(job.getStateFile()) as f:
+				job.state = json.load(f)
+		except (IOError, ValueError):
+			return None
+		return job
+
+	@staticmethod
+	def removeOldFiles():
+		directory = Config.get("storage", "syncJobFiles")
+		if(not os.path.isdir(directory)):
+			return
+		for filename in os.listdir(directory):
+			path = os.path.join(directory, filename)
+			try:
+				if(os.path.getmtime(path) < time.time() - SyncJob.keepFiles):
+					os.remove(path)
+			except OSError:
+				pass
+
+	def __init__(self, jobID):
+		self.id = jobID
+		self.state = None
+		self.lock = threading.Lock()
+
+	def getStateFile(self):
+		return os.path.join(Config.get("storage", "syncJobFiles"), "%s.json" % self.id)
+
+	def getSummary(self):
+		"""Returns a dictionary counting the sensors in each state."""
+		summary = {SyncJob.PENDING: 0, SyncJob.OK: 0, SyncJob.FAILED: 0}
+		for sensor in self.state["sensors"].values():
+			summary[sensor["status"]] += 1
+		return summary
+
+	def run(self):
+		"""Contacts the sensors of the job. The sensors are split into waves of [sensor]
+		syncWaveSize sensors (all in one wave if it is 0), with [sensor] syncWaveDelay seconds
+		between the waves. Within a wave, at most [sensor] syncWorkers sensors is contacted at
+		the same time, each after a random delay of up to [sensor] syncJitter seconds. The job 
+		is always marked as finished, also if it fails; sensors which were not contacted is then 
+		marked as failed."""
+		logger = logging.getLogger(__name__)
+
+		try:
+			self.syncSensors()
+		finally:
+			with self.lock:
+				for sensor in self.state["sensors"].values():
+					if(sensor["status"] == SyncJob.PENDING):
+						sensor.update({"status": SyncJob.FAILED, "message": "The sync-job stopped before the sensor was contacted."})
+				self.state["finished"] = str(datetime.datetime.now())
+				self.publish()
+		logger.info("Finished sync-job %s: %s" % (self.id, str(self.getSummary())))
+
+	def syncSensors(self):
+		"""Contacts the sensors of the job, wave by wave."""
+		logger = logging.getLogger(__name__)
+
+		workers = int(Config.get("sensor", "syncWorkers"))
+		waveSize = int(Config.get("sensor", "syncWaveSize"))
+		waveDelay = float(Config.get("sensor", "syncWaveDelay"))
+		jitter = float(Config.get("sensor", "syncJitter"))
+
+		sensors = list(Sensor.objects.filter(pk__in=[int(s) for s in self.state["sensors"]]).order_by("name"))
+		waves = [sensors[i:i + waveSize] for i in range(0, len(sensors), waveSize)] if waveSize > 0 else [sensors]
+		logger.info("Starting sync-job %s, with %d sensors in %d waves" % (self.id, len(sensors), len(waves)))
+
+		for i, wave in enumerate(waves):
+			if(i > 0):
+				time.sleep(waveDelay)
+			parallelMap(lambda sensor: self.syncSensor(sensor, jitter), wave, workers)
+
+	def syncSensor(self, sensor, jitter):
+		"""Asks a single sensor to update, and stores the result."""
+		logger = logging.getLogger(__name__)
+
+		if(jitter > 0):
+			time.sleep(random.uniform(0, jitter))
+
+		try:
+			result = sensor.requestUpdate()
+			status = SyncJob.OK if result.get('status') else SyncJob.FAILED
+			message = result.get('message', "")
+		except Exception as e:
+			logger.warning("Could not request an update from sensor %s: %s" % (sensor.name, str(e)))
+			status = SyncJob.FAILED
+			message = str(e)
+
+		with self.lock:
+			self.state["sensors"][str(sensor.pk)].update({"status": status, "message": message, "time": str(datetime.datetime.now())})
+			self.publish()
+
+	def publish(self):
+		"""Writes the state of the job to its file. The file is replaced atomically, so that a
+		reader never sees a partially written file."""
+		logger = logging.getLogger(__name__)
+
+		filename = self.getStateFile()
+		directory = os.path.dirname(filename)
+		try:
+			if(not os.path.isdir(directory)):
+				os.makedirs(directory)
+
+			handle, tmpname = tempfile.mkstemp(dir=directory)
+			with os.fdopen(handle, "w") as f:
+				json.dump(self.state, f)
+			os.chmod(tmpname, 0644)
+			os.rename(tmpname, filename)
+		except (IOError, OSError) as e:
+			logger.warning("Could not write the sync-job file %s: %s" % (filename, str(e)))
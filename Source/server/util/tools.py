@@ -2,9 +2,12 @@
 
 import hashlib
 import os
+import Queue
 import resource
 import signal
 import sys
+import threading
+import xmlrpclib
 
 def md5sum(filename, blocksize=65536):
 	"""Returns the md5 sum of the file specified.
@@ -16,6 +19,14 @@ def md5sum(filename, blocksize=65536):
 			_hash.update(block)
 	return _hash.hexdigest()
 
+def chunks(sequence, size):
+	"""Splits sequence into lists of at most size elements. Useful to keep the number of
+	parametres in "__in"-queries bounded."""
+	
+	sequence = list(sequence)
+	for i in range(0, len(sequence), size):
+		yield sequence[i:i + size]
+
 def doubleFork():
 	"""This method does a double fork, and kills both parents. So, after this method is returned,
 	you are guaranteed to be in a free-standing process, if no exceptions was raised.
@@ -75,6 +86,54 @@ class Replace:
 		self.matched = match.group(0)
 		return self.replacement
 	
+class TimeoutTransport(xmlrpclib.SafeTransport):
+	"""An xmlrpclib-transport (https) which sets a timeout on the socket of the connection. Unlike
+	Timeout, it can be used outside of the main thread."""
+	
+	def __init__(self, timeout, *args, **kwargs):
+		xmlrpclib.SafeTransport.__init__(self, *args, **kwargs)
+		self.timeout = timeout
+	
+	def make_connection(self, host):
+		connection = xmlrpclib.SafeTransport.make_connection(self, host)
+		connection.timeout = self.timeout
+		return connection
+
+def parallelMap(function, items, workers):
+	"""Calls function for every element in items, from a pool of at most workers threads, and 
+	returns a list of the results in the same order as items. If any of the calls raised an
+	exception, the first of them is raised when all the calls are finished."""
+	
+	items = list(items)
+	results = [None] * len(items)
+	errors = []
+	
+	pending = Queue.Queue()
+	for i in range(len(items)):
+		pending.put(i)
+	
+	def worker():
+		while True:
+			try:
+				i = pending.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				results[i] = function(items[i])
+			except Exception as e:
+				errors.append(e)
+	
+	threads = [threading.Thread(target=worker) for i in range(max(1, min(workers, len(items))))]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	for thread in threads:
+		thread.join()
+	
+	if(errors):
+		raise errors[0]
+	return results
+
 class Timeout():
 	"""Simple class that sets a timed-signal at enter, and removes it in exit. If the signals fire in-between, 
 	an Timeout.Timeout is raised."""
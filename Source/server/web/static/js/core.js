@@ -60,8 +60,9 @@ var delay = (function(){
 function syncAllSensors() {
 	
 	$.get('/web/sensors/syncAllSensors/',function(data){
-		if (data == "True") {
-			alert('All sensors have received signals to update.');
+		if (data.status == true) {
+			alert('Started to send update-signals to ' + data.sensors + ' sensors.');
+			delay(function(){getSyncStatus(data.job)}, 2000);
 		}
 		else {
 			alert('Something went wrong trying to sync all sensors.');
@@ -69,6 +70,37 @@ function syncAllSensors() {
 	});
 }
 
+// Polls the status of a sync-job until it is finished, and then reports the result. The polling
+// stops after maxSyncPolls attempts, or if the status can not be read.
+var maxSyncPolls = 900;
+
+function getSyncStatus(job, polls) {
+	
+	polls = polls || 0;
+	$.get('/web/sensors/getSyncStatus/' + job + '/', function(data){
+		if (data.finished == null && polls < maxSyncPolls) {
+			setTimeout(function(){getSyncStatus(job, polls + 1)}, 2000);
+		}
+		else if (data.finished == null) {
+			alert('The sync-job is still not finished. ' + data.summary.pending + ' of the sensors have not been contacted yet.');
+		}
+		else if (data.summary.failed == 0) {
+			alert('All sensors have received signals to update.');
+		}
+		else {
+			var failed = [];
+			$.each(data.sensors, function(id, sensor){
+				if (sensor.status == 'failed') {
+					failed.push(sensor.name + ': ' + sensor.message);
+				}
+			});
+			alert('Something went wrong trying to sync ' + data.summary.failed + ' of the sensors:\n' + failed.join('\n'));
+		}
+	}).fail(function(){
+		alert('Could not get the status of the sync-job.');
+	});
+}
+
 
 $(document).ready(function(){ 
 	
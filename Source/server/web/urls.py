@@ -24,6 +24,7 @@ urlpatterns += patterns('web.views.sensorviews',
     url(r'^sensors/regenerateSecret/$', 'regenerateSecret'),
     url(r'^sensors/requestUpdate/$', 'requestUpdate'),
     url(r'^sensors/syncAllSensors/$', 'syncAllSensors'),
+    url(r'^sensors/getSyncStatus/(?P<jobID>[0-9a-f]+)/$', 'getSyncStatus'),
 )
 urlpatterns += patterns('web.views.updateviews',
     url(r'^update/$', 'index'),
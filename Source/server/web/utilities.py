@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-from core.models import Sensor
+from core.models import RuleSet, Sensor
 from tuning.models import EventFilter, DetectionFilter, Suppress
 
 class UserSettings():
@@ -120,6 +120,11 @@ def ruleSetsToTemplate(ruleSetList):
 	# This list will be whats returned.
 	chewedRuleSets = []
 	
+	# We count the rules of all the rulesets (including the rules of their children) at once.
+	ruleSetList = list(ruleSetList)
+	ruleCounts = RuleSet.getRuleCounts(ruleSetList)
+	parentSets = set(RuleSet.objects.filter(parent__in=ruleSetList).values_list('parent', flat=True))
+	
 	# We iterate over all the rulesets.
 	for ruleSet in ruleSetList:
 		
@@ -128,31 +133,12 @@ def ruleSetsToTemplate(ruleSetList):
 		ruleSetName = ruleSet.name
 		ruleSetActive = ruleSet.active
 		
-		if ruleSet.childSets.count() > 0:
-			# Calculates the number of rules in the set
-			ruleSetHasChildren = True
-			
-			ruleSetRulesCount = ruleSet.rules.count()
-			if ruleSetRulesCount:
-				ruleSetHasRules = True
-			else:
-				ruleSetHasRules = False
-				
-			
-			ruleSetRulesCount = len(ruleSet)
-			ruleSetActiveRulesCount = ruleSet.getActiveRuleCount()
-			
-			ruleSetInActiveRulesCount = ruleSetRulesCount - ruleSetActiveRulesCount
-		else:
-			# We calculate the number of rules the ruleset has.
-			ruleSetHasChildren = False
-			ruleSetRulesCount = ruleSet.rules.count()
-			if ruleSetRulesCount:
-				ruleSetHasRules = True
-			else:
-				ruleSetHasRules = False
-			ruleSetActiveRulesCount = ruleSet.rules.filter(active=True).count()
-			ruleSetInActiveRulesCount = ruleSetRulesCount - ruleSetActiveRulesCount
+		# We calculate the number of rules the ruleset and its children has.
+		ruleSetHasChildren = ruleSetID in parentSets
+		ruleSetHasRules = ruleCounts[ruleSetID]['ownRules'] > 0
+		ruleSetRulesCount = ruleCounts[ruleSetID]['rules']
+		ruleSetActiveRulesCount = ruleCounts[ruleSetID]['activeRules']
+		ruleSetInActiveRulesCount = ruleSetRulesCount - ruleSetActiveRulesCount
 		
 		
 		# If the ruleset is active, we calculate how many sensors its active on.
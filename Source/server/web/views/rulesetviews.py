@@ -394,13 +394,13 @@ def editRuleSet(request):
 			logger.warning("RuleSet ID "+str(ruleSet)+" could not be found.")
 			return HttpResponse(json.dumps(response))
 		
-		# We make sure the ruleset isnt setting itself as a parent.
-		if ruleSetParent != ruleSet:
+		# We make sure the ruleset isnt setting itself, or one of its children, as a parent.
+		if not ruleSetParent.isDescendantOf(ruleSet):
 			ruleSet.parent = ruleSetParent
 			logger.info("RuleSet "+str(ruleSetParent)+" is now the parent of "+str(ruleSet)+".")
 			edited = True
-		elif ruleSetParent == ruleSet:
-			response.append({'response': 'ruleSetParentInbreeding', 'text': 'Inbreeding problem:\nA RuleSet cannot become its own parent.'})
+		else:
+			response.append({'response': 'ruleSetParentInbreeding', 'text': 'Inbreeding problem:\nA RuleSet cannot become its own parent, or the child of one of its children.'})
 			return HttpResponse(json.dumps(response))		
 			
 	# We get the rulesets current list of children.	
@@ -418,18 +418,10 @@ def editRuleSet(request):
 			logger.warning("RuleSet list of IDs "+str(children)+" could not be found.")
 			return HttpResponse(json.dumps(response))
 		
-		# We get the parent of the ruleset.
-		setParent = ruleSet.parent
-		
 		# We iterate over the children again to add them to the ruleset.
 		for child in ruleSetChildren:
-			inbreeding = False
-			
 			# We make sure the new child isnt one of the current rulesets parents. Grandfather-paradox.
-			while setParent != None:
-				if setParent == child:
-					inbreeding = True
-				setParent = setParent.parent
+			inbreeding = ruleSet.parent != None and ruleSet.parent.isDescendantOf(child)
 			
 			# If there was no inbreeding and the child isnt the ruleset itself, we add it to the list of children.
 			if not inbreeding and child != ruleSet:
@@ -467,20 +459,12 @@ def editRuleSet(request):
 				
 				logger.info("RuleSet "+str(ruleSet)+" is no longer the parent of "+str(child)+".")
 		
-		# We get the parent of the ruleset.
-		setParent = ruleSet.parent
-		
 		# We iterate over the children again to add them to the ruleset.
 		for child in newRuleSetChildren:
 			# We only add a new child if it isnt in the old child list.
 			if child not in oldRuleSetChildren:
-				inbreeding = False
-				
 				# We make sure the new child isnt one of the current rulesets parents. Grandfather-paradox.
-				while setParent != None:
-					if setParent == child:
-						inbreeding = True
-					setParent = setParent.parent
+				inbreeding = ruleSet.parent != None and ruleSet.parent.isDescendantOf(child)
 				
 				# If there was no inbreeding and the child isnt the ruleset itself, we add it to the list of children.	
 				if not inbreeding and child != ruleSet:
@@ -494,7 +478,10 @@ def editRuleSet(request):
 			
 	# If the ruleset is to not have any children and has children, we clear any current relations.
 	elif (not children and len(ruleSetChildren) > 0 ):
-		ruleSet.childSets.clear()
+		# The children is saved one at the time, so that the ruleset hierarchy is updated.
+		for child in ruleSet.childSets.all():
+			child.parent = None
+			child.save()
 		logger.info("RuleSet "+str(ruleSet)+" no longer has children.")
 		edited = True
 		
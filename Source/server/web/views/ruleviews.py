@@ -48,7 +48,7 @@ def index(request):
 		# We need to know how many rules there are total.
 		context['itemcount'] = Rule.objects.count()
 		# Get all rules, but limited by the set pagelength.
-		context['rule_list'] = Rule.objects.all().prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[:pagelength]
+		context['rule_list'] = Rule.objects.all().select_related('currentRevision').prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[:pagelength]
 
 	except Rule.DoesNotExist:
 		logger.warning("Page request /rules/ could not be resolved, objects not found.")
@@ -96,7 +96,7 @@ def getRulePage(request, pagenr):
 		# We need to know how many rules there are total.
 		context['itemcount'] = Rule.objects.count()
 		# Get all rules, within the set range.
-		context['rule_list'] = Rule.objects.all().prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
+		context['rule_list'] = Rule.objects.all().select_related('currentRevision').prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
 	except Rule.DoesNotExist:
 		logger.warning("Page request /rules/page/"+str(pagenr)+" could not be resolved, objects in range "+str(minrange)+" - "+str(maxrange)+"not found.")
 		raise Http404
@@ -156,12 +156,12 @@ def getRulesBySearch(request, pagenr):
 			# We need to know how many rules the search will produce.
 			context['itemcount'] = Rule.objects.filter(SID__istartswith=searchstring).count()
 			# Get matching rules, within the set range.
-			context['rule_list'] = Rule.objects.filter(SID__istartswith=searchstring).prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
+			context['rule_list'] = Rule.objects.filter(SID__istartswith=searchstring).select_related('currentRevision').prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
 		elif searchfield=='name':
 			# We need to know how many rules the search will produce.
 			context['itemcount'] = Rule.objects.filter(revisions__active=True, revisions__msg__icontains=searchstring).count()
 			# Get matching rules, within the set range.
-			context['rule_list'] = Rule.objects.filter(revisions__active=True, revisions__msg__icontains=searchstring).prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
+			context['rule_list'] = Rule.objects.filter(revisions__active=True, revisions__msg__icontains=searchstring).select_related('currentRevision').prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
 
 	except Rule.DoesNotExist:
 		logger.warning("Page request /rules/search for string: "+searchstring+" in field "+searchfield+" could not be resolved, objects not found.")
@@ -218,7 +218,7 @@ def getRulesByRuleSet(request, ruleSetID, pagenr):
 		# We need to know how many rules the search will produce.
 		context['itemcount'] = Rule.objects.filter(ruleSet__id=ruleSetID).count()
 		# Get matching rules, within the set range.
-		context['rule_list'] = Rule.objects.filter(ruleSet__id=ruleSetID).prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
+		context['rule_list'] = Rule.objects.filter(ruleSet__id=ruleSetID).select_related('currentRevision').prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
 		
 
 	except Rule.DoesNotExist:
@@ -275,7 +275,7 @@ def getRulesByRuleSetNewRules(request, ruleSetID, pagenr, updateID):
 		# We need to know how many rules the search will produce.
 		context['itemcount'] = Rule.objects.filter(ruleSet__id=ruleSetID, update__id=updateID).count()
 		# Get matching rules, within the set range.
-		context['rule_list'] = Rule.objects.filter(ruleSet__id=ruleSetID, update__id=updateID).prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
+		context['rule_list'] = Rule.objects.filter(ruleSet__id=ruleSetID, update__id=updateID).select_related('currentRevision').prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
 		
 
 	except Rule.DoesNotExist:
@@ -343,7 +343,7 @@ def getRulesByRuleSetNewRuleRevisions(request, ruleSetID, pagenr, updateID):
 		# We need to know how many rules the search will produce.
 		context['itemcount'] = Rule.objects.filter(ruleSet__id=ruleSetID, SID__in=revList).count()
 		# Get matching rules, within the set range.
-		context['rule_list'] = Rule.objects.filter(ruleSet__id=ruleSetID, SID__in=revList).prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
+		context['rule_list'] = Rule.objects.filter(ruleSet__id=ruleSetID, SID__in=revList).select_related('currentRevision').prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
 		
 
 	except Rule.DoesNotExist:
@@ -401,7 +401,7 @@ def getRulesByRuleClass(request, ruleClassID, pagenr):
 		# We need to know how many rules the search will produce.
 		context['itemcount'] = Rule.objects.filter(ruleClass__id=ruleClassID).count()
 		# Get matching rules, within the set range.
-		context['rule_list'] = Rule.objects.filter(ruleClass__id=ruleClassID).prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
+		context['rule_list'] = Rule.objects.filter(ruleClass__id=ruleClassID).select_related('currentRevision').prefetch_related('revisions','revisions__references','revisions__update','ruleSet', 'ruleSet__sensors', 'ruleClass')[minrange:maxrange]
 		
 
 	except Rule.DoesNotExist:
@@ -11,6 +11,7 @@ from django.contrib.auth.decorators import login_required
 from core.models import Sensor
 from util.config import Config
 from util.configgenerator import ConfigGenerator
+from util.sensorsync import SyncJob
 from util import patterns
 from web.utilities import sensorsToFormTemplate
 
@@ -462,16 +463,29 @@ def requestUpdate(request):
 
 @login_required
 def syncAllSensors(request):
+	"""This view asks all the active sensors to update their rules. The sensors are contacted by a background
+	job, so the view returns at once, with the ID of the job. The progress of the job is read from getSyncStatus."""
 	
-	allOK =[]
+	sensors = Sensor.objects.exclude(name="All").filter(active=True,autonomous=False)
+	job = SyncJob.create(sensors)
 	
-	for sensor in Sensor.objects.exclude(name="All").filter(active=True,autonomous=False):
-		try:
-			allOK.append(sensor.requestUpdate())
-		except:
-			allOK.append(False)
-		
-	if False in allOK:
-		return HttpResponse(False)
-	else:
-		return HttpResponse(True)
+	# Call the background-sync script.
+	subprocess.call(['/usr/bin/snowman-syncSensors', job.id])
+	
+	data = {'status': True, 'job': job.id, 'sensors': len(job.state['sensors'])}
+	return HttpResponse(json.dumps(data), content_type="application/json")
+
+@login_required
+def getSyncStatus(request, jobID):
+	"""This view returns the status of a sync-job as JSON:
+	 - finished: The time the job finished, or null if it is still running.
+	 - summary: The number of sensors which is pending, ok and failed.
+	 - sensors: The status, message and time of every sensor, keyed by the sensor ID."""
+	
+	job = SyncJob.load(jobID)
+	if(job == None):
+		raise Http404
+	
+	data = {'job': job.id, 'started': job.state['started'], 'finished': job.state['finished'], 
+			'summary': job.getSummary(), 'sensors': job.state['sensors']}
+	return HttpResponse(json.dumps(data), content_type="application/json")
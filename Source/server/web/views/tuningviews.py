@@ -1,7 +1,7 @@
 from django.http import Http404, HttpResponse
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
-from core.models import Rule, RuleRevision, Sensor, Generator, RuleSet, Comment
+from core.models import Change, Rule, RuleRevision, Sensor, Generator, RuleSet, Comment
 from core.exceptions import MissingObjectError
 from tuning.models import EventFilter, DetectionFilter, Suppress, SuppressAddress
 from web.utilities import tuningToTemplate
@@ -384,6 +384,9 @@ def modifyRule(request):
 			# If we find the rule, we update its active flag to reflect the new status.
 			try:
 				r = Rule.objects.filter(SID=sid).update(active=active)
+				# The update bypasses Rule.save(), so the change is recorded here.
+				if(r > 0):
+					Change.record(Change.RULE, SIDs=[int(sid)])
 				goodsids.append({'sid': sid, 'mode': mode})
 				logger.info("Rule "+str(r)+" is now "+str(mode)+"d.")
 			except Rule.DoesNotExist:
@@ -409,7 +412,10 @@ def modifyRule(request):
 		if globalmodify == "on":
 			for ruleSet in ruleSets:
 				try:
-					r = RuleSet.objects.filter(id=ruleSet).update(active=active)
+					# The ruleset is saved (not updated with a query) so that the effective rulesets of the sensors is updated.
+					r = RuleSet.objects.get(id=ruleSet)
+					r.active = active
+					r.save()
 					goodRuleSets.append({'set': ruleSet, 'mode': mode})
 					logger.info("RuleSet "+str(r)+" is now "+str(mode)+"d.")
 				except RuleSet.DoesNotExist:
@@ -14,7 +14,8 @@ from django.contrib.auth.decorators import login_required
 from django.db.models import Count
 
 from srm.settings import BASE_DIR
-from update.models import Source, Update, UpdateLog, RuleChanges
+from update import progress
+from update.models import Source, Update, RuleChanges
 from util.config import Config
 from web.views.updateforms import ManualUpdateForm, DailySelector, WeeklySelector, MonthlySelector, NewSourceForm
 from web.views.updateutils import createForm, createSourceList
@@ -52,7 +53,7 @@ def index(request):
 			
 			# Generate a message for the user
 			source = Source.objects.get(pk=request.POST['source'])
-			if(source.locked):
+			if(source.isLocked()):
 				data['uploadMessage'] = "There is already an update going for this source!"
 			else:
 				data['uploadMessage'] = "The ruleset is now uploaded, and the processing of the file is started. This might take a while however, depending on the size of the file."
@@ -297,7 +298,7 @@ def runUpdate(request, id):
 	except Source.DoesNotExist:
 		raise Http404
 	
-	if source.locked:
+	if source.isLocked():
 		data['message'] = "There is already an update running for %s!" % source.name
 	else:
 		data['message'] = "Started the update from %s." % source.name
@@ -328,14 +329,11 @@ def getStatus(request, id):
 	except Source.DoesNotExist:
 		raise Http404
 	
-	data['status'] = source.locked 
-	if source.locked:
-		lastUpdate = source.updates.last()
-		lastLogLine = lastUpdate.logEntries.filter(logType=UpdateLog.PROGRESS).last()
-		match = re.match(r"(\d+)\ (.*)", lastLogLine.text)
-		data['progress'] = match.group(1)
-		data['message'] = match.group(2)
-		data['time'] = str(lastLogLine.time)
+	data['status'] = source.isLocked()
+	if data['status']:
+		status = progress.getStatus(source.updates.last())
+		if(status != None):
+			data.update(status)
 	
 	data['updates'] = []
 	for update in source.updates.order_by('-time').all()[:5]: